@@ -0,0 +1,45 @@
+"""
+Benchmarks the write-behind persistence of OScanCesys.ArgumentController against a save on every change.
+
+A preset switch is simulated by setting NUMBER_OF_KEYS settings, first with a synchronous FileManager.save_locally after
+each of them, as ArgumentController did before, and then through ArgumentController. The same keys are then set again
+with the same values. The latency per setter and the writes counters are printed. The settings file is
+opscan_benchmark_settings.json in the usual settings folder.
+"""
+import time
+
+from nionswift_plugin.aux_files import read_data
+from nionswift_plugin.IVG.scan.OScanCesys import ArgumentController
+
+FILENAME = 'opscan_benchmark_settings'
+NUMBER_OF_KEYS = 60
+REPEATS = 5
+
+
+def switch_preset_synchronous(file_manager, offset) -> float:
+    start = time.perf_counter()
+    for key in range(NUMBER_OF_KEYS):
+        file_manager.settings['key' + str(key)] = key + offset
+        file_manager.save_locally()
+    return (time.perf_counter() - start) / NUMBER_OF_KEYS
+
+
+def switch_preset(controller, offset) -> float:
+    start = time.perf_counter()
+    for key in range(NUMBER_OF_KEYS):
+        controller.update(**{'key' + str(key): key + offset})
+    return (time.perf_counter() - start) / NUMBER_OF_KEYS
+
+
+if __name__ == "__main__":
+    file_manager = read_data.FileManager(FILENAME)
+    synchronous = sum(switch_preset_synchronous(file_manager, repeat) for repeat in range(REPEATS)) / REPEATS
+    print(f'Save on every change: {1e6 * synchronous:8.1f} us per setter, {REPEATS * NUMBER_OF_KEYS} writes.')
+
+    controller = ArgumentController(FILENAME)
+    write_behind = sum(switch_preset(controller, repeat + REPEATS) for repeat in range(REPEATS)) / REPEATS
+    same_values = switch_preset(controller, 2 * REPEATS - 1)
+    controller.flush()
+    print(f'Write-behind: {1e6 * write_behind:8.1f} us per setter ({synchronous / write_behind:.0f}x), '
+          f'{1e6 * same_values:8.1f} us when the value is unchanged. Counters: {controller.counters}.')
+    print(f'Settings on disk match: {read_data.FileManager(FILENAME).settings == controller.argument_controller}.')
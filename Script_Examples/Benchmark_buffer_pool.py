@@ -0,0 +1,60 @@
+"""
+Benchmarks aux_files.buffer_pool against allocating a new array every time live view starts.
+
+Toggling live view allocates the image or spectrum image buffer given to the camera DLL. For every shape, the script
+allocates the buffer and touches every page, as the DLL does with the first frames, NUMBER_OF_STARTS times, first with
+numpy.zeros and then with a lease and give_back from a BufferPool. The time of the first frame write is printed, and
+whether the leased buffers start on a page boundary.
+"""
+import time
+import numpy
+
+from nionswift_plugin.aux_files import buffer_pool
+
+#name: (shape, dtype)
+SHAPES = {'EELS focus': ((1600, 200), numpy.uint16), 'CCD focus': ((2048, 2048), numpy.float32),
+          'Spim 256x256': ((256, 256, 1600), numpy.float32), 'Spim 512x512': ((512, 512, 1024), numpy.uint16)}
+NUMBER_OF_STARTS = 10
+
+
+def touch(array):
+    # The DLL writes the whole buffer with the first frames
+    flat = array.reshape(-1).view(numpy.uint8)
+    flat[::4096] = 1
+
+
+def run_allocate(shape, dtype) -> float:
+    start = time.perf_counter()
+    for _ in range(NUMBER_OF_STARTS):
+        array = numpy.zeros(shape, dtype=dtype)
+        touch(array)
+        del array
+    return (time.perf_counter() - start) / NUMBER_OF_STARTS
+
+
+def run_pool(pool, shape, dtype) -> float:
+    array = pool.lease(shape, dtype)
+    pool.give_back(array)
+    del array #The buffer is only reused once the array is gone
+    start = time.perf_counter()
+    for _ in range(NUMBER_OF_STARTS):
+        array = pool.lease(shape, dtype)
+        touch(array)
+        pool.give_back(array)
+        del array
+    return (time.perf_counter() - start) / NUMBER_OF_STARTS
+
+
+if __name__ == "__main__":
+    pool = buffer_pool.BufferPool()
+    for name, (shape, dtype) in SHAPES.items():
+        allocate_time = run_allocate(shape, dtype)
+        pool_time = run_pool(pool, shape, dtype)
+        array = pool.lease(shape, dtype)
+        aligned = array.ctypes.data % buffer_pool.ALIGNMENT == 0
+        pool.give_back(array)
+        del array
+        print(f'{name:>14}: {numpy.prod(shape) * numpy.dtype(dtype).itemsize / 1e6:8.1f} MB, '
+              f'allocate {1e3 * allocate_time:8.2f} ms, pool {1e3 * pool_time:8.2f} ms per start '
+              f'({allocate_time / pool_time:5.1f}x). Page aligned: {aligned}.')
+    pool.clear()
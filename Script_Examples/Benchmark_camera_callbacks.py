@@ -0,0 +1,53 @@
+"""
+Benchmarks the data callbacks of VGCameraYves.CameraDevice on a simulated orsay camera (Cameras.dll, Windows only).
+
+The script prints, in calls per second:
+
+    - getCCDStatus, which builds a dict, against getCCDStatusValues, which reuses its ctypes arguments;
+    - the focus and spim unlockers called in a loop, as the DLL does for every frame or spectrum;
+    - the frames received from the simulated camera in Focus and Cumul at the shortest exposure.
+"""
+import time
+
+from nion.instrumentation.camera_base import CameraFrameParameters
+from nionswift_plugin.IVG.camera import VGCameraYves
+
+MANUFACTURER = 1
+MODEL = "PIXIS: 100B"
+NUMBER_OF_CALLS = 100000
+DURATION = 5.0
+EXPOSURE_MS = 0.1
+
+
+def calls_per_second(function, *args):
+    start = time.perf_counter()
+    for _ in range(NUMBER_OF_CALLS):
+        function(*args)
+    return NUMBER_OF_CALLS / (time.perf_counter() - start)
+
+
+def run_live(device, mode):
+    settings = dict(device.current_camera_settings.as_dict(), acquisition_mode=mode, exposure_ms=EXPOSURE_MS)
+    device.current_camera_settings = CameraFrameParameters(settings)
+    device.start_live()
+    time.sleep(DURATION)
+    frames = device.frame_number
+    device.stop_live()
+    print(f'{mode:>6}: {frames / DURATION:10.1f} frames/s, {device.frame_accumulator.count} frames accumulated.')
+
+
+if __name__ == "__main__":
+    device = VGCameraYves.CameraDevice(MANUFACTURER, MODEL, "", True, "orsay_camera_benchmark", "Benchmark", "eels")
+    camera = device.camera
+    print(f'getCCDStatus: {calls_per_second(camera.getCCDStatus):12.0f} calls/s.')
+    print(f'getCCDStatusValues: {calls_per_second(camera.getCCDStatusValues):12.0f} calls/s.')
+
+    device.imagedata = None
+    print(f'Focus unlocker: {calls_per_second(device._CameraDevice__data_unlocker, 0, False):12.0f} calls/s.')
+    print(f'Spim unlocker (Newton): '
+          f'{calls_per_second(device._CameraDevice__spim_data_unlocker, 0, True, True):12.0f} calls/s.')
+    print(f'Spim unlocker: '
+          f'{calls_per_second(device._CameraDevice__spim_data_unlockerA, 0, True, 1, 0, True):12.0f} calls/s.')
+
+    for mode in ['Focus', 'Cumul']:
+        run_live(device, mode)
@@ -0,0 +1,68 @@
+"""
+Benchmarks the memory-mapped spectrum image sink of aux_files.disk_spim against an in-memory cube.
+
+A synthetic SPIM is written row by row, as the camera DLL does, and advance is called after every row as grab_partial
+does. The script prints the sustained write rate and the resident memory at the end of the acquisition. psutil is used
+for the resident memory if present, otherwise only the peak given by the resource module (Unix) is printed.
+"""
+import time
+import numpy
+
+from nionswift_plugin.aux_files import disk_spim
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SHAPES = [(256, 256, 1025), (512, 512, 1025), (1024, 1024, 1025)]
+DTYPE = numpy.float32
+
+
+def resident_memory():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def write_rows(data, sink, row):
+    start = time.perf_counter()
+    for index in range(data.shape[0]):
+        data[index] = row
+        if sink is not None:
+            sink.advance(index + 1)
+    if sink is not None:
+        sink.flush()
+    return time.perf_counter() - start
+
+
+def run_shape(shape):
+    row = numpy.random.rand(*shape[1:]).astype(DTYPE)
+    nbytes = int(numpy.prod(shape)) * numpy.dtype(DTYPE).itemsize
+
+    rss = resident_memory()
+    sink = disk_spim.DiskSpectrumImage(shape, DTYPE)
+    elapsed = write_rows(sink.data, sink, row)
+    print(f'{shape} {nbytes / 1e9:6.2f} GB on disk: {nbytes / elapsed / 1e9:.2f} GB/s, resident memory grew by '
+          f'{(resident_memory() - rss) / 1e6:.0f} MB.')
+    sink.close()
+
+    if nbytes < disk_spim.MEMORY_THRESHOLD:
+        rss = resident_memory()
+        data = numpy.zeros(shape, dtype=DTYPE)
+        elapsed = write_rows(data, None, row)
+        print(f'{shape} {nbytes / 1e9:6.2f} GB in memory: {nbytes / elapsed / 1e9:.2f} GB/s, resident memory grew by '
+              f'{(resident_memory() - rss) / 1e6:.0f} MB.')
+        del data
+
+
+if __name__ == "__main__":
+    for shape in SHAPES:
+        run_shape(shape)
@@ -0,0 +1,88 @@
+"""
+Benchmarks the per-frame cost of aux_files.frame_accumulation against full reductions.
+
+For each frame shape, the script times:
+
+    - 'sum': numpy.sum of the frame, as the beam current was computed before;
+    - 'full reductions': sum, mean and variance recomputed with numpy over all the frames kept so far;
+    - 'numpy' and 'numba': FrameAccumulator.add with statistics and each kernel, which also gives the frame counts;
+    - 'count only': FrameAccumulator.add without statistics, when FRAME_STATISTICS is 0.
+
+Then tp3func.TimePix3 runs in Focus against tp3_vi.ServalSimulator, unthrottled, and the script prints the frame rate
+and the time spent in get_current, which takes the counts from the accumulator when statistics are on.
+"""
+import time
+import numpy
+
+from nionswift_plugin.aux_files import frame_accumulation
+from nionswift_plugin.IVG.tp3 import tp3func, tp3_vi
+
+SHAPES = [(256, 1024), (1024, 1024), (2048, 2048)]
+NUMBER_OF_FRAMES = 50
+KEPT_FRAMES = 10 #Frames kept for the full reductions
+DURATION = 5.0
+SERVAL_URL = 'http://127.0.0.1:' + str(tp3_vi.SERVAL_PORT)
+
+
+def time_per_frame(frames, function):
+    function(frames[0]) #Compilation
+    start = time.perf_counter()
+    for frame in frames:
+        function(frame)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def full_reductions(kept):
+    def reduce(frame):
+        kept.append(frame)
+        del kept[:-KEPT_FRAMES]
+        stack = numpy.stack(kept).astype(numpy.float64)
+        return frame.sum(), stack.sum(axis=0), stack.mean(axis=0), stack.var(axis=0)
+    return reduce
+
+
+def run_shape(shape):
+    frames = [numpy.random.poisson(2.0, shape).astype(numpy.uint32) for _ in range(NUMBER_OF_FRAMES)]
+    results = {'sum': time_per_frame(frames, numpy.sum),
+               'full reductions': time_per_frame(frames, full_reductions(list()))}
+    for name, kernel in [('numpy', frame_accumulation.update_frame_statistics_numpy),
+                         ('numba', getattr(frame_accumulation, 'update_frame_statistics_numba', None))]:
+        if kernel is None:
+            continue
+        frame_accumulation.update_frame_statistics = kernel
+        accumulator = frame_accumulation.FrameAccumulator(statistics=True, ema_alpha=0.1)
+        results[name] = time_per_frame(frames, accumulator.add)
+    results['count only'] = time_per_frame(frames, frame_accumulation.FrameAccumulator(statistics=False).add)
+    for name, value in results.items():
+        print(f'{shape} {name:>16}: {value * 1e3:8.2f} ms per frame, {1 / value:10.1f} frames/s.')
+
+
+def run_simulated_camera():
+    times = list()
+    camera = None
+
+    def message(value):
+        if value == 1:
+            start = time.perf_counter()
+            camera.get_current(camera.create_specimage(), camera.get_frame())
+            times.append(time.perf_counter() - start)
+
+    camera = tp3func.TimePix3(SERVAL_URL, False, message)
+    camera.startFocus(0.001, '2d', 0)
+    time.sleep(DURATION)
+    camera.stopSpim(True)
+    if times:
+        print(f'Simulated Timepix3: {len(times) / DURATION:.1f} frames/s, get_current takes '
+              f'{numpy.mean(times) * 1e3:.3f} ms per frame (mean), {numpy.max(times) * 1e3:.3f} ms (max). '
+              f'{camera.frame_accumulator.count} frames counted.')
+
+
+if __name__ == "__main__":
+    for shape in SHAPES:
+        run_shape(shape)
+    simulator = tp3_vi.ServalSimulator()
+    simulator.start()
+    try:
+        run_simulated_camera()
+    finally:
+        simulator.stop()
@@ -0,0 +1,61 @@
+"""
+Benchmarks OScanCesys.Device.read_partial on the OpenScan emulator (FPGAConfig.DebugClass) for large frames.
+
+Live view is simulated by calling read_partial in a loop for DURATION seconds, as the scan hardware source does, for a
+free running and a synchronized scan. The former path is run on the same device: every poll transferred every channel
+with receive_total_frame, and a synchronized poll slept TIMEOUT_IS_SYNC. The script prints the number of polls, the
+images and bytes transferred, and the latency, which is the mean time of a read_partial call.
+"""
+import time
+
+from nion.instrumentation import scan_base
+from nionswift_plugin.IVG.scan import OScanCesys
+
+SIZES = [(1024, 1024), (2048, 2048)]
+DURATION = 5.0
+
+
+def run_former(device, frame_parameters):
+    is_synchronized_scan = frame_parameters.get_parameter("external_clock_mode", 0) != 0
+    polls = transfers = transferred = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        if is_synchronized_scan:
+            time.sleep(OScanCesys.TIMEOUT_IS_SYNC)
+        for channel_id in range(2):
+            image = device.scan_engine.receive_total_frame(channel_id)
+            transfers += 1
+            transferred += image.nbytes
+        polls += 1
+    return polls, transfers, transferred, (time.perf_counter() - start) / polls
+
+
+def run(device, frame_parameters):
+    device.set_frame_parameters(frame_parameters)
+    device.start_frame(True)
+    before = dict(device.transfer_counters)
+    polls, frame_number, pixels_to_skip = 0, None, 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        data_elements, complete, bad, sub_area, frame_number, pixels_to_skip = \
+            device.read_partial(frame_number, pixels_to_skip)
+        if complete:
+            frame_number, pixels_to_skip = None, 0
+        polls += 1
+    device.stop()
+    counters = {key: device.transfer_counters[key] - before[key] for key in before}
+    return polls, counters["transfers"] * len(data_elements), counters["bytes"], (time.perf_counter() - start) / polls
+
+
+if __name__ == "__main__":
+    device = OScanCesys.Device(None)
+    for size in SIZES:
+        for is_synchronized_scan in [False, True]:
+            frame_parameters = scan_base.ScanFrameParameters({"size": size, "pixel_time_us": 1.0, "fov_nm": 100.0})
+            frame_parameters.set_parameter("external_clock_mode", int(is_synchronized_scan))
+            device.set_frame_parameters(frame_parameters)
+            name = f'{size} {"synchronized" if is_synchronized_scan else "free running"}'
+            for path, function in [('former', run_former), ('incremental', run)]:
+                polls, transfers, transferred, latency = function(device, frame_parameters)
+                print(f'{name:>30} {path:>11}: {polls:6d} polls, {transfers:6d} images, '
+                      f'{transferred / 1e6:9.1f} MB transferred, {1e3 * latency:8.2f} ms per poll.')
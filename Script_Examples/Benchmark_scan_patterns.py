@@ -0,0 +1,62 @@
+"""
+Benchmarks scan.scan_patterns.PatternCache against fetching the pattern arrays for every frame, on random scan patterns.
+
+A random scan of SIZE pixels is programmed once and NUMBER_OF_FRAMES frames are prepared, as OScanCesys.read_partial
+and CameraTask.prepare do: the mask array is put in the frame metadata, the scan pixels are sorted by acquisition index
+for SpimReorder and the ordered array is converted for the Timepix3 server. Before the change, the arrays were fetched,
+converted and the mask stored as a list for every frame. The script prints the time per frame and the size of the
+metadata entry, as JSON, as saved with the data item.
+"""
+import json, tempfile, time
+import numpy
+
+from nionswift_plugin.IVG.scan import scan_patterns
+
+SIZES = [(512, 512), (1024, 1024)]
+NUMBER_OF_FRAMES = 10
+
+
+class RandomScan:
+    """
+    Stands for FPGAConfig.ScanDevice in random scan mode.
+    """
+
+    def __init__(self, size):
+        self.mask = numpy.random.permutation(size[0] * size[1])
+        self.ordered = numpy.argsort(self.mask)
+
+    def get_ordered_array(self):
+        return self.ordered
+
+    def get_mask_array(self):
+        return self.mask
+
+
+def run_former(device):
+    start = time.perf_counter()
+    for frame in range(NUMBER_OF_FRAMES):
+        metadata = {"decode_list": numpy.asarray(device.get_mask_array()).tolist()}
+        numpy.argsort(numpy.asarray(device.get_mask_array()), kind='stable')
+        device.get_ordered_array().astype('uint32')
+    return (time.perf_counter() - start) / NUMBER_OF_FRAMES, len(json.dumps(metadata))
+
+
+def run(device, folder):
+    cache = scan_patterns.PatternCache(folder=folder, budget=scan_patterns.FOLDER_BUDGET)
+    start = time.perf_counter()
+    for frame in range(NUMBER_OF_FRAMES):
+        pattern = cache.get('random', device.get_ordered_array, device.get_mask_array)
+        metadata = {"scan_pattern": pattern.reference}
+        pattern.get_order()
+        numpy.ascontiguousarray(pattern.ordered, dtype=numpy.uint32)
+    return (time.perf_counter() - start) / NUMBER_OF_FRAMES, len(json.dumps(metadata))
+
+
+if __name__ == "__main__":
+    folder = tempfile.mkdtemp()
+    for size in SIZES:
+        device = RandomScan(size)
+        for name, function in [('former', run_former), ('cached', lambda device: run(device, folder))]:
+            per_frame, metadata_size = function(device)
+            print(f'{str(size):>12} {name:>6}: {1e3 * per_frame:8.2f} ms per frame, '
+                  f'{metadata_size / 1e3:10.1f} kB of metadata.')
@@ -0,0 +1,50 @@
+"""
+Benchmarks the change tracking of OScanCesys.ScanEngine.set_frame_parameters on the OpenScan emulator.
+
+Without a CESYS board, ScanEngine runs over FPGAConfig.DebugClass. Parameter tweaks made during live scanning are
+replayed: same parameters, field of view only, an input multiplexer, a rotation and a new pixel time. For each tweak,
+the script prints the time of set_frame_parameters and which reconfigurations were sent. Before the change, every tweak
+but the first one reprogrammed the scan with change_scan_parameters.
+"""
+import time
+
+from nion.instrumentation import scan_base
+from nionswift_plugin.IVG.scan import OScanCesys
+
+REPEATS = 20
+
+
+def fov(engine, frame_parameters, index):
+    frame_parameters.fov_nm = 100.0 + index
+
+
+def mux(engine, frame_parameters, index):
+    engine.input1_mux = index % 2
+
+
+def rotation(engine, frame_parameters, index):
+    frame_parameters.rotation_rad = 0.01 * index
+
+
+def pixel_time(engine, frame_parameters, index):
+    frame_parameters.pixel_time_us = 1.0 + index % 2
+
+
+TWEAKS = {'Unchanged': lambda engine, frame_parameters, index: None, 'FOV only': fov, 'Input mux': mux,
+          'Rotation': rotation, 'Pixel time': pixel_time}
+
+
+if __name__ == "__main__":
+    engine = OScanCesys.ScanEngine()
+    frame_parameters = scan_base.ScanFrameParameters({"size": (512, 512), "pixel_time_us": 1.0, "fov_nm": 100.0})
+    engine.set_frame_parameters(frame_parameters)
+    for name, tweak in TWEAKS.items():
+        before = dict(engine.reconfigurations)
+        elapsed = 0.0
+        for index in range(REPEATS):
+            tweak(engine, frame_parameters, index + 1)
+            start = time.perf_counter()
+            engine.set_frame_parameters(frame_parameters)
+            elapsed += time.perf_counter() - start
+        sent = {key: engine.reconfigurations[key] - before[key] for key in before}
+        print(f'{name:>12}: {1e3 * elapsed / REPEATS:8.3f} ms per set_frame_parameters. Sent {sent}.')
@@ -0,0 +1,72 @@
+"""
+Benchmarks scan.sequence_buffer.SequenceBuffer against the list that VGScanYves and OScanCesys used as sequence buffer.
+
+A multi-frame sequence of NUMBER_OF_FRAMES frames of SIZE pixels and NUMBER_OF_CHANNELS channels is simulated, as the
+scan hardware source does: frames are pushed as they complete, the most recent one is read with get_buffer_data and,
+in the sequence, frames are popped once SEQUENCE_LAG frames are waiting. Live view (no sequence) is run as well. The
+script prints the time per frame over the first and the last thousand frames, and the number of frames held.
+"""
+import time
+import numpy
+
+from nionswift_plugin.IVG.scan import sequence_buffer
+
+SIZE = (256, 256)
+NUMBER_OF_CHANNELS = 2
+NUMBER_OF_FRAMES = 20000
+SEQUENCE_LAG = 5000
+VIEW_BUFFER_SIZE = 20
+
+
+class ListBuffer:
+    """
+    The former buffer of the scan devices.
+    """
+
+    def __init__(self):
+        self.buffer = list()
+        self.sequence_size = 0
+
+    def clear(self, sequence_size):
+        self.sequence_size = sequence_size
+        self.buffer = list()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def push(self, data_elements):
+        if len(self.buffer) > 0 and len(self.buffer[-1]) != len(data_elements):
+            self.buffer = list()
+        self.buffer.append(data_elements)
+        while len(self.buffer) > self.sequence_size + VIEW_BUFFER_SIZE:
+            del self.buffer[self.sequence_size]
+
+    def pop(self):
+        self.sequence_size -= 1
+        return self.buffer.pop(0)
+
+    def get_buffer_data(self, start, count):
+        return self.buffer[start: start + count if count < -start else None]
+
+
+def run(buffer, sequence_size):
+    frame = [{"data": numpy.zeros(SIZE, numpy.float32), "properties": {"channel_id": channel}}
+             for channel in range(NUMBER_OF_CHANNELS)]
+    buffer.clear(sequence_size)
+    times = numpy.zeros(NUMBER_OF_FRAMES)
+    for index in range(NUMBER_OF_FRAMES):
+        start = time.perf_counter()
+        buffer.push(list(frame))
+        buffer.get_buffer_data(-1, 1)
+        if sequence_size and len(buffer) > SEQUENCE_LAG:
+            buffer.pop()
+        times[index] = time.perf_counter() - start
+    return 1e6 * times[:1000].mean(), 1e6 * times[-1000:].mean(), len(buffer)
+
+
+if __name__ == "__main__":
+    for name, sequence_size in [('Live view', 0), ('Sequence', NUMBER_OF_FRAMES)]:
+        for buffer_name, buffer in [('list', ListBuffer()), ('SequenceBuffer', sequence_buffer.SequenceBuffer())]:
+            first, last, held = run(buffer, sequence_size)
+            print(f'{name:>10} {buffer_name:>15}: {first:7.2f} us per frame at the start, {last:7.2f} us at the end. '
+                  f'{held} frames held.')
@@ -0,0 +1,83 @@
+"""
+Benchmarks the prediction error of VGCameraYves.CameraDevice.get_acquire_sequence_metrics on a simulated orsay camera
+(Cameras.dll, Windows only).
+
+For each binning and exposure, the script predicts the time and memory of a sequence of NUMBER_OF_FRAMES frames with
+the readout time of the camera, calibrates the readout time with CALIBRATION_TIME seconds of Focus, predicts again and
+then measures the sequence in Focus. The errors of both predictions are printed. Finally, a sequence twice as large as
+the available memory must be refused by acquire_sequence_prepare.
+"""
+import time
+
+from nion.instrumentation.camera_base import CameraFrameParameters
+from nionswift_plugin.IVG.camera import VGCameraYves
+
+MANUFACTURER = 1
+MODEL = "PIXIS: 100B"
+BINNINGS = [(1, 1), (1, 2), (2, 4), (1, 100)]
+EXPOSURES_MS = [1.0, 10.0, 50.0]
+NUMBER_OF_FRAMES = 200
+CALIBRATION_TIME = 2.0
+
+
+def set_settings(device, binning, exposure_ms):
+    settings = dict(device.current_camera_settings.as_dict(), acquisition_mode='Focus', exposure_ms=exposure_ms,
+                    h_binning=binning[0], v_binning=binning[1])
+    device.camera.setBinning(*binning)
+    device.current_camera_settings = CameraFrameParameters(settings)
+    return settings
+
+
+def predict(device, settings):
+    parameters = CameraFrameParameters(dict(settings, acquisition_frame_count=NUMBER_OF_FRAMES,
+                                            storage_frame_count=NUMBER_OF_FRAMES))
+    return device.get_acquire_sequence_metrics(parameters)
+
+
+def measure(device):
+    device.start_live()
+    while device.frame_accumulator.count < 1:
+        time.sleep(0.001)
+    start = time.perf_counter()
+    while device.frame_accumulator.count < NUMBER_OF_FRAMES + 1:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    memory = device.imagedata.nbytes * NUMBER_OF_FRAMES
+    device.stop_live()
+    return elapsed, memory
+
+
+def error(predicted, measured):
+    return 100 * (predicted - measured) / measured
+
+
+def check_refused(device):
+    metrics = predict(device, device.current_camera_settings.as_dict())
+    if "max_frame_count" not in metrics:
+        print('psutil is not installed, sequences are not checked against the available memory.')
+        return
+    try:
+        device.acquire_sequence_prepare(2 * metrics["max_frame_count"])
+    except MemoryError as e:
+        print(f'Refused: {e}')
+    else:
+        raise AssertionError('A sequence larger than the available memory was accepted.')
+    device.acquire_sequence_prepare(NUMBER_OF_FRAMES)
+
+
+if __name__ == "__main__":
+    device = VGCameraYves.CameraDevice(MANUFACTURER, MODEL, "", True, "orsay_camera_benchmark", "Benchmark", "eels")
+    for binning in BINNINGS:
+        for exposure_ms in EXPOSURES_MS:
+            settings = set_settings(device, binning, exposure_ms)
+            before = predict(device, settings)
+            device.start_live()
+            time.sleep(CALIBRATION_TIME)
+            device.stop_live()
+            after = predict(device, settings)
+            elapsed, memory = measure(device)
+            print(f'Binning {binning}, {exposure_ms:5.1f} ms: measured {elapsed:7.3f} s and {memory / 1e6:8.2f} MB. '
+                  f'Time error {error(before["acquisition_time"], elapsed):+7.1f}% with the camera readout, '
+                  f'{error(after["acquisition_time"], elapsed):+7.1f}% calibrated. '
+                  f'Memory error {error(after["acquisition_memory"], memory):+6.1f}%.')
+    check_refused(device)
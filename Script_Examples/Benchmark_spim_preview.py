@@ -0,0 +1,159 @@
+"""
+Benchmarks the SPIM preview latency of VGCameraYves.CameraTask: the time between a scan row being complete and
+grab_partial returning it.
+
+Two simulated back-ends feed the SpimProgress of a stand-in camera device:
+
+    - 'dll': a thread writes one spectrum per dwell time and calls the progress as __spim_data_unlockerA does;
+    - 'tp3': tp3func.TimePix3 in HYPERSPEC_FRAME_BASED against tp3_vi.ServalSimulator, through the message 2 callback.
+
+For each dwell time, grab_partial is called in a loop as acquire_synchronized_continue does, and the mean, p99 and
+maximum latencies are printed. The target is below 100 ms.
+"""
+import argparse, threading, time
+import numpy
+
+from nion.utils import Registry
+from nion.instrumentation.camera_base import CameraFrameParameters
+from nionswift_plugin.IVG.camera import VGCameraYves
+from nionswift_plugin.IVG.tp3 import tp3func, tp3_vi
+
+SCAN_SHAPE = (64, 64)
+SPECTRUM_SIZE = 1024
+DWELL_TIMES_MS = [0.01, 0.1, 1.0, 10.0]
+TARGET_LATENCY = 0.1
+SERVAL_URL = 'http://127.0.0.1:' + str(tp3_vi.SERVAL_PORT)
+
+
+class ScanDevice:
+    scan_device_id = 'orsay_scan_device'
+
+
+class ScanController:
+    scan_device = ScanDevice()
+
+
+class StemController:
+    scan_controller = ScanController()
+
+
+class SimulatedCamera:
+    """
+    Camera DLL stand-in. startSpim starts a thread writing one spectrum per dwell time.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.row_times = list()
+        self.__thread = None
+
+    def getImageSize(self):
+        return SPECTRUM_SIZE, 1
+
+    def set_scan_size(self, scan_shape):
+        pass
+
+    def startSpim(self, count, spectra_per_pixel, exposure, two_d):
+        self.row_times = list()
+        self.__thread = threading.Thread(target=self.__run, args=(count, exposure), daemon=True)
+
+    def resumeSpim(self, mode):
+        self.__thread.start()
+
+    def __run(self, count, exposure):
+        spectrum = numpy.random.rand(SPECTRUM_SIZE).astype(numpy.float32)
+        data = self.device.spimimagedata.reshape((count, SPECTRUM_SIZE))
+        start = time.perf_counter()
+        for index in range(count):
+            data[index] = spectrum
+            while time.perf_counter() - start < (index + 1) * exposure:
+                pass
+            if (index + 1) % SCAN_SHAPE[1] == 0:
+                self.row_times.append(time.perf_counter())
+            self.device.frame_number = index + 1
+            self.device.spim_progress.update(index + 1, index + 1 < count)
+
+
+class CameraDevice:
+    """
+    What CameraTask needs from VGCameraYves.CameraDevice.
+    """
+
+    def __init__(self, dwell_time_ms: float, soft_binning: bool = False):
+        self.isMedipix = False
+        self.frame_number = 0
+        self.spimimagedata = None
+        self.spim_progress = VGCameraYves.SpimProgress()
+        self.current_camera_settings = CameraFrameParameters({'exposure_ms': dwell_time_ms, 'flipped': False,
+                                                              'soft_binning': soft_binning, 'processing': None})
+        self.camera = SimulatedCamera(self)
+
+    def get_data_type(self, summed_rows: int = 1, accumulated: bool = False):
+        return numpy.float32
+
+
+def run_task(device, row_times) -> list:
+    task = VGCameraYves.CameraTask(device, device.current_camera_settings, SCAN_SHAPE)
+    task.prepare()
+    task.start()
+    latencies = list()
+    is_complete = False
+    last_rows = 0
+    while not is_complete:
+        is_complete, is_canceled, rows = task.grab_partial(update_period=1.0)
+        now = time.perf_counter()
+        latencies += [now - row_time for row_time in row_times()[last_rows:rows]]
+        last_rows = rows
+    return latencies
+
+
+def run_dll(dwell_time_ms: float) -> list:
+    device = CameraDevice(dwell_time_ms)
+    return run_task(device, lambda: device.camera.row_times)
+
+
+def run_tp3(dwell_time_ms: float) -> list:
+    device = CameraDevice(dwell_time_ms, soft_binning=True) #Timepix3 SPIMs are 1D
+    row_times = list()
+
+    def message(value):
+        if value == 2:
+            device.frame_number = camera.get_frame()
+            rows = device.frame_number // SCAN_SHAPE[1]
+            row_times.extend([time.perf_counter()] * (rows - len(row_times)))
+            device.spim_progress.update(device.frame_number)
+
+    camera = tp3func.TimePix3(SERVAL_URL, False, message)
+    camera.setAccumulationNumber(SCAN_SHAPE[1])
+    device.camera = camera
+    try:
+        return run_task(device, lambda: row_times)
+    finally:
+        camera.stopSpim(True)
+
+
+def report(name: str, dwell_time_ms: float, latencies: list):
+    latencies = numpy.array(latencies) * 1e3
+    flag = 'ok' if latencies.max() < TARGET_LATENCY * 1e3 else 'ABOVE TARGET'
+    print(f'{name:>4} {dwell_time_ms:6.2f} ms dwell: {latencies.size} rows, latency {latencies.mean():6.1f} ms (mean), '
+          f'{numpy.percentile(latencies, 99):6.1f} ms (p99), {latencies.max():6.1f} ms (max). {flag}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SPIM preview latency benchmark.')
+    parser.add_argument('--backends', nargs='*', default=['dll', 'tp3'], choices=['dll', 'tp3'])
+    parser.add_argument('--dwell-times', nargs='*', type=float, default=DWELL_TIMES_MS)
+    args = parser.parse_args()
+    Registry.register_component(StemController(), {"stem_controller"})
+
+    if 'dll' in args.backends:
+        for dwell_time_ms in args.dwell_times:
+            report('dll', dwell_time_ms, run_dll(dwell_time_ms))
+    if 'tp3' in args.backends:
+        simulator = tp3_vi.ServalSimulator()
+        simulator.start()
+        try:
+            for dwell_time_ms in args.dwell_times:
+                report('tp3', dwell_time_ms, run_tp3(dwell_time_ms))
+        finally:
+            simulator.stop()
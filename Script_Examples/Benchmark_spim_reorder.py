@@ -0,0 +1,77 @@
+"""
+Benchmarks the per-update cost of putting a random-pattern SPIM in scan order.
+
+The previous path indexed the whole SPIM with the decode list on every partial update. aux_files.spim_reorder only
+copies the spectra acquired since the previous update. The acquisition is simulated by advancing the number of acquired
+spectra by UPDATE_ROWS scan rows at every update. The script prints the mean and maximum time per update for both.
+
+Before timing, check_camera_decode puts a camera SPIM in scan order with the decode and order of a ScanPattern, as
+CameraTask does, and checks it against the decode of camera data in SpectrumReordering.py, (mask - 1) % scan_size.
+"""
+import tempfile, time
+import numpy
+
+from nionswift_plugin.aux_files import spim_reorder
+from nionswift_plugin.IVG.scan import scan_patterns
+
+SHAPES = [(128, 128, 1024), (256, 256, 1024), (512, 512, 1024)]
+UPDATE_ROWS = 4
+DTYPE = numpy.float32
+
+
+def run_full_copy(source, decode_array, scan_shape):
+    times = list()
+    flat = source.reshape((scan_shape[0] * scan_shape[1], -1))
+    for acquired in range(0, flat.shape[0], UPDATE_ROWS * scan_shape[1]):
+        start = time.perf_counter()
+        flat[decode_array].reshape(source.shape)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_incremental(source, decode_array, scan_shape):
+    times = list()
+    reorder = spim_reorder.SpimReorder(source, scan_shape, decode_array)
+    number_of_pixels = scan_shape[0] * scan_shape[1]
+    for acquired in range(0, number_of_pixels + 1, UPDATE_ROWS * scan_shape[1]):
+        start = time.perf_counter()
+        reorder.update(acquired)
+        times.append(time.perf_counter() - start)
+    flat = source.reshape((number_of_pixels, -1))
+    assert numpy.array_equal(reorder.data.reshape(flat.shape), flat[decode_array])
+    reorder.close()
+    return times
+
+
+def check_camera_decode(shape):
+    scan_shape = shape[:2]
+    scan_size = scan_shape[0] * scan_shape[1]
+    source = numpy.random.rand(*shape).astype(DTYPE)
+    mask = numpy.random.permutation(scan_size)
+    pattern = scan_patterns.ScanPattern('check', lambda: mask, lambda: mask, tempfile.mkdtemp(),
+                                         scan_patterns.FOLDER_BUDGET)
+    reorder = spim_reorder.SpimReorder(source, scan_shape, pattern.get_camera_decode(scan_size),
+                                       pattern.get_order(scan_size))
+    reorder.update(scan_size)
+    #Decode of SpectrumReordering.py for camera data
+    decode_list = (numpy.array(mask, dtype='int') - 1) % scan_size
+    expected = source.reshape((scan_size, -1))[decode_list, :].reshape(shape)
+    assert numpy.array_equal(reorder.data, expected), 'The live reorder does not match SpectrumReordering.py.'
+    reorder.close()
+    print(f'{shape} live reorder matches SpectrumReordering.py.')
+
+
+def report(name, shape, times):
+    times = numpy.array(times) * 1e3
+    print(f'{shape} {name:>12}: {times.mean():8.2f} ms per update (mean), {times.max():8.2f} ms (max), '
+          f'{times.sum():8.1f} ms in total.')
+
+
+if __name__ == "__main__":
+    check_camera_decode((16, 32, 64))
+    for shape in SHAPES:
+        scan_shape = shape[:2]
+        source = numpy.random.rand(*shape).astype(DTYPE)
+        decode_array = numpy.random.permutation(scan_shape[0] * scan_shape[1])
+        report('full copy', shape, run_full_copy(source, decode_array, scan_shape))
+        report('incremental', shape, run_incremental(source, decode_array, scan_shape))
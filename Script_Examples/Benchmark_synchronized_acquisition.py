@@ -0,0 +1,135 @@
+"""
+Benchmarks camera.synchronized_acquisition with simulated cameras.
+
+Every simulated camera is a CameraTask from VGCameraYves over a stand-in DLL. Arming takes ARM_TIME, as allocating and
+starting a spectrum image does, and the camera waits for the scan trigger before writing one spectrum per dwell time.
+The cameras are first acquired one after the other, as spectro.py does, and then together with SynchronizedAcquisition.
+The per-device timing report and the dead time removed are printed.
+"""
+import threading, time
+import numpy
+
+from nion.utils import Registry
+from nion.instrumentation import camera_base
+from nion.instrumentation.camera_base import CameraFrameParameters
+from nionswift_plugin.IVG.camera import VGCameraYves, synchronized_acquisition
+
+SCAN_SHAPE = (32, 32)
+DWELL_TIME_MS = 1.0
+ARM_TIME = 0.5
+#name: number of energy channels
+CAMERAS = {'orsay_camera_eels': 1024, 'orsay_camera_eire': 1340, 'orsay_camera_timepix3': 1025}
+
+
+class ScanDevice:
+    scan_device_id = 'orsay_scan_device'
+
+
+class ScanController:
+    scan_device = ScanDevice()
+
+
+class StemController:
+    scan_controller = ScanController()
+
+
+class SimulatedCamera:
+    def __init__(self, device, size: int, trigger: threading.Event):
+        self.device = device
+        self.size = size
+        self.trigger = trigger
+        self.__thread = None
+
+    def getImageSize(self):
+        return self.size, 1
+
+    def set_scan_size(self, scan_shape):
+        pass
+
+    def startSpim(self, count, spectra_per_pixel, exposure, two_d):
+        time.sleep(ARM_TIME)
+        self.__thread = threading.Thread(target=self.__run, args=(count, exposure), daemon=True)
+
+    def resumeSpim(self, mode):
+        self.__thread.start()
+
+    def stopSpim(self, immediate):
+        pass
+
+    def __run(self, count, exposure):
+        self.trigger.wait()
+        data = self.device.spimimagedata.reshape((count, self.size))
+        spectrum = numpy.random.rand(self.size).astype(data.dtype)
+        start = time.perf_counter()
+        for index in range(count):
+            data[index] = spectrum
+            while time.perf_counter() - start < (index + 1) * exposure:
+                pass
+            self.device.spim_progress.update(index + 1, index + 1 < count)
+
+
+class CameraDevice:
+    """
+    The synchronized acquisition part of VGCameraYves.CameraDevice over a SimulatedCamera.
+    """
+
+    def __init__(self, size: int, trigger: threading.Event):
+        self.isMedipix = False
+        self.frame_number = 0
+        self.spimimagedata = None
+        self.spim_progress = VGCameraYves.SpimProgress()
+        self.current_camera_settings = CameraFrameParameters({'exposure_ms': DWELL_TIME_MS, 'flipped': False,
+                                                              'soft_binning': False, 'processing': None})
+        self.camera = SimulatedCamera(self, size, trigger)
+        self.__task = None
+
+    def get_data_type(self, summed_rows: int = 1, accumulated: bool = False):
+        return numpy.float32
+
+    def acquire_synchronized_begin(self, camera_frame_parameters, scan_shape, **kwargs):
+        self.__task = VGCameraYves.CameraTask(self, camera_frame_parameters, scan_shape)
+        self.__task.prepare()
+        self.__task.start()
+        return camera_base.PartialData(self.__task.xdata, False, False, 0)
+
+    def acquire_synchronized_continue(self, *, update_period: float = 1.0, **kwargs):
+        is_complete, is_canceled, valid_count = self.__task.grab_partial(update_period=update_period)
+        return camera_base.PartialData(self.__task.xdata, is_complete, is_canceled, valid_count)
+
+    def acquire_synchronized_end(self, **kwargs):
+        self.camera.stopSpim(True)
+        self.__task = None
+
+    def acquire_synchronized_cancel(self):
+        self.spim_progress.wake()
+
+
+def create_devices():
+    trigger = threading.Event()
+    return {name: CameraDevice(size, trigger) for name, size in CAMERAS.items()}, trigger
+
+
+def run_one_after_the_other() -> float:
+    start = time.perf_counter()
+    for name in CAMERAS:
+        devices, trigger = create_devices()
+        acquisition = synchronized_acquisition.SynchronizedAcquisition({name: devices[name]}, SCAN_SHAPE, trigger.set)
+        acquisition.run()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    Registry.register_component(StemController(), {"stem_controller"})
+    sequential = run_one_after_the_other()
+    print(f'One after the other: {sequential:.3f} s.')
+
+    devices, trigger = create_devices()
+    acquisition = synchronized_acquisition.SynchronizedAcquisition(devices, SCAN_SHAPE, trigger.set)
+    data = acquisition.run()
+    report = acquisition.get_report()
+    print(f'Synchronized: {report["wall_time"]:.3f} s, {sequential - report["wall_time"]:.3f} s of dead time removed '
+          f'({report["dead_time_removed"]:.3f} s from the per-device timings).')
+    for name, timing in report["devices"].items():
+        print(f'{name:>22}: armed in {timing["arm_time"]:.3f} s, acquired in {timing["acquisition_time"]:.3f} s, '
+              f'first rows after {timing["first_rows_time"]:.3f} s, {timing["updates"]} updates. '
+              f'Data shape {data[name].data_shape}.')
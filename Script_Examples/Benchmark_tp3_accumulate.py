@@ -0,0 +1,61 @@
+"""
+Benchmarks the EVENT_HYPERSPEC histogramming backends of tp3accumulate on synthetic uint32 event indices.
+
+Histograms have the real SPIM shapes (yspim_size, xspim_size, SPIM_SIZE) and the dtype Timepix3DataManager picks for
+them. Events are fed in batches, as they come from the socket, from 10^6 up to 10^9 events in total. The legacy
+numpy.unique path is kept as the reference. The first call of every numba backend is done before timing.
+"""
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3accumulate
+
+SPIM_SIZE = 1025
+SHAPES = [(64, 64), (256, 256), (512, 512)]
+TOTAL_EVENTS = [10 ** 6, 10 ** 7, 10 ** 8, 10 ** 9]
+BATCH_SIZES = [8000, 10 ** 6]
+
+
+def histogram_dtype(shape):
+    max_val = max(shape)
+    if max_val <= 64:
+        return numpy.uint32
+    elif max_val <= 1024:
+        return numpy.uint16
+    return numpy.uint8
+
+
+def legacy_unique(array, event_list):
+    unique, counts = numpy.unique(event_list, return_counts=True)
+    array[unique] += counts.astype(array.dtype)
+
+
+def run_shape(shape, batch_size, total_events):
+    array = numpy.zeros(shape[0] * shape[1] * SPIM_SIZE, dtype=histogram_dtype(shape))
+    batch = numpy.random.randint(0, array.size, batch_size, dtype=numpy.uint32)
+    number_of_batches = max(total_events // batch_size, 1)
+    engine = tp3accumulate.AccumulationEngine()
+    candidates = [(name, backend.accumulate) for name, backend in engine.backends.items()]
+    candidates += [('Engine', engine.accumulate), ('LegacyUnique', legacy_unique)]
+    for name, function in candidates:
+        function(array, batch[:16])
+        # Slow paths are extrapolated from the first second, the others run the whole total.
+        start = time.perf_counter()
+        done = 0
+        while done < number_of_batches:
+            function(array, batch)
+            done += 1
+            if time.perf_counter() - start > 1.0 and name in ['NumbaSerial', 'LegacyUnique', 'Bincount']:
+                break
+        elapsed = time.perf_counter() - start
+        rate = done * batch_size / elapsed
+        print(f'{shape + (SPIM_SIZE,)} batch {batch_size:>8} total {total_events:.0e}: {name:>14} '
+              f'{rate:.3g} events/s, {total_events / rate:.3f} s for the whole total.')
+    print(f'Engine usage: {engine.usage}.')
+
+
+if __name__ == "__main__":
+    for shape in SHAPES:
+        for batch_size in BATCH_SIZES:
+            for total_events in TOTAL_EVENTS:
+                run_shape(shape, batch_size, total_events)
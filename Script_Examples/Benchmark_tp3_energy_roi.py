@@ -0,0 +1,67 @@
+"""
+Benchmarks the energy ROI and binning of tp3accumulate.EnergyWindow on synthetic EVENT_HYPERSPEC streams.
+
+Events are drawn as in a core-loss spectrum image: a background decaying over the whole spectrum, and an edge above
+EDGE_CHANNEL. The full cube of SPIM_SIZE channels is compared with cubes cropped to a window around the edge, with and
+without binning. For each case, the script prints the memory of the cube, the event rate including the cropping, and
+whether the cropped cube is equal to the same window of the full cube.
+"""
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3accumulate
+
+SPIM_SIZE = 1025
+SHAPES = [(64, 64), (256, 256)]
+EVENTS_PER_PROBE = 1000
+EDGE_CHANNEL = 600
+BACKGROUND_DECAY = 300.0
+#name: (start, end, binning)
+WINDOWS = {'Full spectrum': (0, SPIM_SIZE, 1), 'ROI 200': (EDGE_CHANNEL - 50, EDGE_CHANNEL + 150, 1),
+           'ROI 200, bin 2': (EDGE_CHANNEL - 50, EDGE_CHANNEL + 150, 2),
+           'ROI 100, bin 4': (EDGE_CHANNEL - 20, EDGE_CHANNEL + 80, 4)}
+BATCH_SIZE = 10 ** 6
+
+
+def create_events(shape):
+    number_of_probes = shape[0] * shape[1]
+    number_of_events = number_of_probes * EVENTS_PER_PROBE
+    probe = numpy.random.randint(0, number_of_probes, number_of_events).astype(numpy.int64)
+    channel = numpy.random.exponential(BACKGROUND_DECAY, number_of_events)
+    edge = numpy.random.rand(number_of_events) < 0.2
+    channel[edge] = EDGE_CHANNEL + numpy.random.exponential(BACKGROUND_DECAY, numpy.count_nonzero(edge))
+    channel = numpy.clip(channel, 0, SPIM_SIZE - 1).astype(numpy.int64)
+    return (probe * SPIM_SIZE + channel).astype(numpy.uint32)
+
+
+def run(shape, events, window):
+    engine = tp3accumulate.AccumulationEngine('NumbaSerial')
+    cube = numpy.zeros(shape[0] * shape[1] * window.channels, dtype=numpy.uint32)
+    engine.accumulate(cube, window.apply(events[:BATCH_SIZE // 10])) #Compiling
+    cube[:] = 0
+    start = time.perf_counter()
+    for batch in range(0, events.size, BATCH_SIZE):
+        engine.accumulate(cube, window.apply(events[batch:batch + BATCH_SIZE]))
+    elapsed = time.perf_counter() - start
+    return cube.reshape(shape + (window.channels,)), elapsed
+
+
+def expected(full, start, end, binning):
+    cropped = full[..., start:end]
+    padding = -cropped.shape[-1] % binning
+    cropped = numpy.pad(cropped, [(0, 0), (0, 0), (0, padding)])
+    return cropped.reshape(cropped.shape[:-1] + (-1, binning)).sum(axis=-1)
+
+
+if __name__ == "__main__":
+    for shape in SHAPES:
+        events = create_events(shape)
+        full, _ = run(shape, events, tp3accumulate.EnergyWindow(SPIM_SIZE))
+        print(f'Scan {shape}, {events.size} events.')
+        for name, (start, end, binning) in WINDOWS.items():
+            window = tp3accumulate.EnergyWindow(SPIM_SIZE, start, end, binning)
+            cube, elapsed = run(shape, events, window)
+            same = numpy.array_equal(cube, expected(full, window.start, window.end, window.binning))
+            print(f'{name:>16}: {window.channels:5d} channels, {cube.nbytes / 1e6:8.1f} MB '
+                  f'({full.nbytes / cube.nbytes:5.1f}x less), {events.size / elapsed:.3g} events/s. '
+                  f'Same as the cropped full cube: {same}.')
@@ -0,0 +1,48 @@
+"""
+Benchmarks tp3gaps.correct_gaps against the strided loops that Timepix3DataManager.correct_data_or_not used before.
+
+The loops did one pair of strided slices per gap over the flat data, and only for the frame modes. The same loops are
+run here, on the flat array, for a binned frame, a 2D frame, a FASTCHRONO and event hyperspec cubes, and compared with
+the single vectorized call on the reshaped array. The time per correction and whether both give the same result are
+printed.
+"""
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3gaps
+
+#name: (shape, dtype). The last axis is the energy axis
+SHAPES = {'Binned frame': ((1024,), numpy.uint32), '2D frame': ((256, 1024), numpy.uint16),
+          'FASTCHRONO': ((2048, 1024), numpy.uint32), 'Hyperspec 64x64': ((64, 64, 1025), numpy.uint32),
+          'Hyperspec 256x256': ((256, 256, 1025), numpy.uint16)}
+REPEATS = 20
+
+
+def correct_loops(data, length):
+    """
+    The loops of correct_data_or_not, with the stride set to the length of the energy axis.
+    """
+    for start_index in [255, 511, 767]:
+        data[start_index::length] = (2 * data[start_index - 1::length] + data[start_index + 2::length]) / 3.0
+        data[start_index + 1::length] = (2 * data[start_index + 2::length] + data[start_index - 1::length]) / 3.0
+
+
+def run(function, data) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        function(data)
+    return (time.perf_counter() - start) / REPEATS
+
+
+if __name__ == "__main__":
+    for name, (shape, dtype) in SHAPES.items():
+        data = numpy.random.randint(0, 100, shape).astype(dtype)
+        length = shape[-1]
+        loops, vectorized = data.copy().reshape(-1), data.copy()
+        correct_loops(loops, length)
+        tp3gaps.correct_gaps(vectorized)
+        same = numpy.array_equal(loops, vectorized.reshape(-1))
+        loops_time = run(lambda array: correct_loops(array.reshape(-1), length), data.copy())
+        vectorized_time = run(tp3gaps.correct_gaps, data.copy())
+        print(f'{name:>18}: loops {1e3 * loops_time:8.3f} ms, vectorized {1e3 * vectorized_time:8.3f} ms '
+              f'({loops_time / vectorized_time:5.1f}x). Same result: {same}.')
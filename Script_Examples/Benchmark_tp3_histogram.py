@@ -0,0 +1,68 @@
+"""
+Benchmarks the overflow-promoting histogram of tp3accumulate against fixed-dtype cubes.
+
+Events are drawn as in an EELS spectrum image: most of them in a bright zero-loss peak a few channels wide, the rest
+spread over the whole spectrum. The OverflowHistogram starting in uint8 is compared with uint8, uint16 and uint32 cubes
+filled by the serial numba kernel, which wrap silently. For each case, the script prints the memory, the event rate and
+the number of bins whose counts are wrong when compared to an exact uint64 reference.
+"""
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3accumulate
+
+SPIM_SIZE = 1025
+SHAPES = [(64, 64), (256, 256)]
+EVENTS_PER_PROBE = [100, 1000, 10000]
+ZLP_CHANNEL = 100
+ZLP_WIDTH = 3.0
+ZLP_FRACTION = 0.8
+BATCH_SIZE = 10 ** 6
+
+
+def create_events(shape, events_per_probe):
+    number_of_probes = shape[0] * shape[1]
+    number_of_events = number_of_probes * events_per_probe
+    probe = numpy.random.randint(0, number_of_probes, number_of_events).astype(numpy.int64)
+    channel = numpy.random.randint(0, SPIM_SIZE, number_of_events)
+    zlp = numpy.random.rand(number_of_events) < ZLP_FRACTION
+    channel[zlp] = numpy.clip(numpy.random.normal(ZLP_CHANNEL, ZLP_WIDTH, numpy.count_nonzero(zlp)), 0,
+                              SPIM_SIZE - 1).astype(channel.dtype)
+    return (probe * SPIM_SIZE + channel).astype(numpy.uint32)
+
+
+def run(name, size, events, reference, accumulate, counts, memory):
+    start = time.perf_counter()
+    for batch in range(0, events.size, BATCH_SIZE):
+        accumulate(events[batch:batch + BATCH_SIZE])
+    elapsed = time.perf_counter() - start
+    wrong = numpy.count_nonzero(counts().astype(numpy.uint64) != reference)
+    print(f'{name:>18}: {memory() / 1e6:8.1f} MB, {events.size / elapsed:.3g} events/s, {wrong} wrong bins '
+          f'out of {size}.')
+
+
+def run_shape(shape, events_per_probe):
+    size = shape[0] * shape[1] * SPIM_SIZE
+    events = create_events(shape, events_per_probe)
+    reference = numpy.bincount(events, minlength=size).astype(numpy.uint64)
+    print(f'{shape + (SPIM_SIZE,)} with {events_per_probe} events per probe. Brightest bin has {reference.max()} counts.')
+
+    for dtype in [numpy.uint8, numpy.uint16, numpy.uint32]:
+        data = numpy.zeros(size, dtype=dtype)
+        tp3accumulate.update_spim_numba(data, events[:16])
+        data[:] = 0
+        run(f'Fixed {numpy.dtype(dtype).name}', size, events, reference,
+            lambda batch: tp3accumulate.update_spim_numba(data, batch), lambda: data, lambda: data.nbytes)
+
+    histogram = tp3accumulate.OverflowHistogram(numpy.zeros(size, dtype=numpy.uint8))
+    engine = tp3accumulate.AccumulationEngine()
+    run('Overflow uint8', size, events, reference, lambda batch: histogram.accumulate(batch, engine),
+        histogram.get_counts, lambda: histogram.memory_bytes)
+    print(f'{histogram.number_of_tiles} tiles of {histogram.tile_size} bins promoted. {histogram.hot_events} events '
+          f'went through the saturating kernel.')
+
+
+if __name__ == "__main__":
+    for shape in SHAPES:
+        for events_per_probe in EVENTS_PER_PROBE:
+            run_shape(shape, events_per_probe)
@@ -0,0 +1,283 @@
+"""
+Throughput and latency benchmark of tp3func.TimePix3 for every acquisition mode.
+
+Each mode is started with its own start* method against tp3_vi.ServalSimulator, which plays Serval and the TCP stream
+on localhost. The scan modes use a stand-in stem controller whose scan counts frames with time. Each mode runs for
+--duration seconds, then the script records:
+
+    - sustained frames/s, events/s and bandwidth, from the client counters;
+    - the time from the socket to the sendmessage callback for the jsonimage modes (timeAtFrame is the send time), and
+      the queue and decode times of the event pipeline for the event modes;
+    - the CPU use of each core and of the process, and the peak resident memory (psutil, if present).
+
+Results are written as json to --output. With --compare, a previous result file is read and modes that are slower by
+more than --tolerance are reported, and the exit code is 1.
+
+python Benchmark_tp3_modes.py --duration 5 --output tp3_modes.json --compare tp3_modes_reference.json
+"""
+import argparse, json, logging, os, platform, sys, threading, time
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3func, tp3_vi
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+SERVAL_URL = 'http://127.0.0.1:' + str(tp3_vi.SERVAL_PORT)
+SCAN_SIZE = 64
+CHRONO_SIZE = 100
+SCAN_FRAMES = 10 ** 6 #Large enough so the scan modes are stopped by the duration
+FRAME_TIME = 0.05
+SAMPLE_PERIOD = 0.1
+
+
+class FrameParameters:
+    def __init__(self, size: int):
+        self.size = (size, size)
+        self.subscan_pixel_size = None
+        self.pixel_time_us = 1.0
+
+
+class ScanEngine:
+    def __init__(self, size: int):
+        self.size = size
+
+    def get_ordered_array(self):
+        return numpy.arange(self.size * self.size, dtype=numpy.uint32)
+
+
+class ScanDevice:
+    def __init__(self, size: int):
+        self.current_frame_parameters = FrameParameters(size)
+        self.scan_engine = ScanEngine(size)
+
+
+class ScanController:
+    """
+    Scan that completes one frame every FRAME_TIME seconds once the sequence starts.
+    """
+
+    def __init__(self, hardware_source_id: str, size: int):
+        self.hardware_source_id = hardware_source_id
+        self.scan_device = ScanDevice(size)
+        self.is_playing = False
+        self.__start = time.perf_counter()
+
+    def start_playing(self):
+        self.is_playing = True
+        self.__start = time.perf_counter()
+
+    def stop_playing(self):
+        self.is_playing = False
+
+    def get_current_frame_parameters(self):
+        return self.scan_device.current_frame_parameters
+
+    def set_sequence_buffer_size(self, size: int):
+        pass
+
+    def start_sequence_mode(self, frame_parameters, count: int):
+        self.start_playing()
+
+    def get_sequence_buffer_count(self) -> int:
+        return int((time.perf_counter() - self.__start) / FRAME_TIME)
+
+
+class StemController:
+    def __init__(self, hardware_source_id: str):
+        self.scan_controller = ScanController(hardware_source_id, SCAN_SIZE)
+
+    def TryGetVal(self, name: str):
+        return True, 1.0
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Samples the resident memory of the process while the mode runs.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak_rss = 0
+        self.__stop = threading.Event()
+        self.__process = psutil.Process() if psutil is not None else None
+
+    def run(self):
+        while not self.__stop.wait(SAMPLE_PERIOD):
+            if self.__process is not None:
+                self.peak_rss = max(self.peak_rss, self.__process.memory_info().rss)
+
+    def stop(self):
+        self.__stop.set()
+        self.join()
+
+
+def start_focus(camera):
+    camera.setAccumulationNumber(CHRONO_SIZE)
+    return camera.startFocus(0.01, '2d', 0)
+
+
+def start_fastchrono(camera):
+    camera.setAccumulationNumber(CHRONO_SIZE)
+    return camera.startChrono(0.01, '1d', 0)
+
+
+def start_coinc_chrono(camera):
+    camera.setAccumulationNumber(CHRONO_SIZE)
+    camera.setWidthTime(CHRONO_SIZE)
+    return camera.startChrono(0.01, '1d', 1)
+
+
+def start_hyperspec_frame_based(camera):
+    camera.setAccumulationNumber(SCAN_SIZE)
+    camera.set_scan_size((SCAN_SIZE, SCAN_SIZE))
+    return camera.startSpim(SCAN_SIZE * SCAN_SIZE, 1, 0.001, False)
+
+
+def start_spim_from_scan(sub_mode):
+    def start(camera):
+        camera.setAccumulationNumber(SCAN_FRAMES)
+        camera.setTp3Mode(sub_mode)
+        return camera.StartSpimFromScan()
+    return start
+
+
+def start_4d_from_scan(camera):
+    camera.setAccumulationNumber(SCAN_FRAMES)
+    return camera.Start4DFromScan()
+
+
+#name: (mode, hardware_source_id of the scan, start function, is a jsonimage mode)
+MODES = {
+    'FRAME': (tp3func.FRAME, 'orsay_scan_device', start_focus, True),
+    'FASTCHRONO': (tp3func.FASTCHRONO, 'orsay_scan_device', start_fastchrono, True),
+    'COINC_CHRONO': (tp3func.COINC_CHRONO, 'orsay_scan_device', start_coinc_chrono, True),
+    'HYPERSPEC_FRAME_BASED': (tp3func.HYPERSPEC_FRAME_BASED, 'orsay_scan_device', start_hyperspec_frame_based, True),
+    'EVENT_HYPERSPEC': (tp3func.EVENT_HYPERSPEC, 'orsay_scan_device', start_spim_from_scan(0), False),
+    'EVENT_HYPERSPEC_COINC': (tp3func.EVENT_HYPERSPEC_COINC, 'orsay_scan_device', start_spim_from_scan(1), False),
+    'EVENT_4DRAW': (tp3func.EVENT_4DRAW, 'orsay_scan_device', start_spim_from_scan(2), False),
+    'EVENT_LIST_SCAN': (tp3func.EVENT_LIST_SCAN, 'open_scan_device', start_spim_from_scan(0), False),
+    'FRAME_4DMASKED': (tp3func.FRAME_4DMASKED, 'orsay_scan_device', start_4d_from_scan, False),
+}
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {'mean': None, 'p50': None, 'p99': None, 'max': None}
+    values = numpy.array(values) * 1e3
+    return {'mean': float(values.mean()), 'p50': float(numpy.percentile(values, 50)),
+            'p99': float(numpy.percentile(values, 99)), 'max': float(values.max())}
+
+
+def run_mode(name: str, duration: float, simulator: tp3_vi.ServalSimulator) -> dict:
+    mode, hardware_source_id, start, is_jsonimage = MODES[name]
+    latencies = list()
+    camera = None
+
+    def message(value):
+        header = camera.frame_counters['last_header']
+        if 'timeAtFrame' in header:
+            latencies.append(time.time() - header['timeAtFrame'])
+
+    camera = tp3func.TimePix3(SERVAL_URL, False, message)
+    camera.set_controller(StemController(hardware_source_id))
+    sent_before = simulator.counters
+    sampler = ResourceSampler()
+    sampler.start()
+    cpu_time = time.process_time()
+    if psutil is not None:
+        psutil.cpu_percent(percpu=True)
+
+    start_time = time.perf_counter()
+    if not start(camera):
+        sampler.stop()
+        logging.info(f'***BENCHMARK***: {name} could not be started.')
+        return {'name': name, 'mode': mode, 'started': False}
+    time.sleep(duration)
+    frame_counters = camera.frame_counters
+    stream_counters = camera.stream_counters
+    elapsed = time.perf_counter() - start_time
+    camera.stopSpim(True)
+
+    cpu_per_core = psutil.cpu_percent(percpu=True) if psutil is not None else None
+    process_cpu = (time.process_time() - cpu_time) / elapsed * 100
+    sampler.stop()
+    sent_after = simulator.counters
+
+    if is_jsonimage:
+        bytes_received = frame_counters['bytes_received']
+        frames_received = frame_counters['frames_received']
+        events_received = 0
+    else:
+        bytes_received = stream_counters['bytes_received']
+        frames_received = sent_after['frames_sent'] - sent_before['frames_sent']
+        events_received = 0
+        if mode != tp3func.FRAME_4DMASKED:
+            events_received = bytes_received // (8 if mode == tp3func.EVENT_4DRAW else 4)
+    return {
+        'name': name,
+        'mode': mode,
+        'started': True,
+        'duration_s': elapsed,
+        'frames_per_second': frames_received / elapsed,
+        'events_per_second': events_received / elapsed,
+        'bandwidth_MBps': bytes_received / elapsed / 1e6,
+        'bytes_sent': sent_after['bytes_sent'] - sent_before['bytes_sent'],
+        'socket_to_message_ms': percentiles(latencies),
+        'pipeline': {key: value for key, value in stream_counters.items()} if not is_jsonimage else None,
+        'process_cpu_percent': process_cpu,
+        'cpu_percent_per_core': cpu_per_core,
+        'peak_rss_MB': sampler.peak_rss / 1e6 if psutil is not None else None,
+    }
+
+
+def compare(results: list, reference_file: str, tolerance: float) -> bool:
+    with open(reference_file) as reference:
+        reference = {result['name']: result for result in json.load(reference)['results']}
+    ok = True
+    for result in results:
+        previous = reference.get(result['name'])
+        if previous is None or not result.get('started') or not previous.get('started'):
+            continue
+        ratio = result['bandwidth_MBps'] / max(previous['bandwidth_MBps'], 1e-9)
+        flag = 'REGRESSION' if ratio < 1 - tolerance else 'ok'
+        ok &= flag == 'ok'
+        print(f'{result["name"]:>22}: {result["bandwidth_MBps"]:10.1f} MB/s, {ratio:5.2f}x the reference. {flag}')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Timepix3 throughput and latency benchmark.')
+    parser.add_argument('--modes', nargs='*', default=list(MODES.keys()), choices=list(MODES.keys()))
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--event-rate', type=float, default=0, help='Simulator event rate. 0 is unthrottled.')
+    parser.add_argument('--frame-rate', type=float, default=0, help='Simulator frame rate. 0 is unthrottled.')
+    parser.add_argument('--output', default='tp3_modes.json')
+    parser.add_argument('--compare', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    simulator = tp3_vi.ServalSimulator(event_rate=args.event_rate, frame_rate=args.frame_rate)
+    simulator.start()
+    results = list()
+    try:
+        for name in args.modes:
+            result = run_mode(name, args.duration, simulator)
+            results.append(result)
+            if result['started']:
+                print(f'{name:>22}: {result["frames_per_second"]:10.1f} frames/s, '
+                      f'{result["events_per_second"]:.3g} events/s, {result["bandwidth_MBps"]:10.1f} MB/s, '
+                      f'latency {result["socket_to_message_ms"]["p50"]} ms (p50), peak RSS {result["peak_rss_MB"]} MB.')
+    finally:
+        simulator.stop()
+
+    with open(args.output, 'w') as output:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'platform': platform.platform(),
+                   'python': sys.version, 'cpu_count': os.cpu_count(), 'duration_s': args.duration,
+                   'results': results}, output, indent=4)
+    print(f'Results written to {args.output}.')
+    if args.compare is not None and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,68 @@
+"""
+Benchmarks the sparse EVENT_4DRAW storage of tp3sparse against the dense uint8 cube used before.
+
+A synthetic 4D-STEM stream is made of a bright disk (the direct beam) with a few scattered events per probe position,
+sent in batches of uint64 indices as they come from the socket. For each scan shape, the script prints the memory the
+dense cube would need, the memory taken by the sparse store and its preview, the ingest rate, and the time to densify a
+probe position and to integrate a virtual bright field.
+"""
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3sparse, tp3accumulate
+
+DETECTOR_SHAPE = (512, 512)
+SHAPES = [(64, 64), (256, 256), (512, 512)]
+EVENTS_PER_PROBE = [10, 100, 1000]
+BATCH_SIZE = 10 ** 6
+DISK_RADIUS = 20
+
+
+def create_probe_events(events_per_probe):
+    angle = numpy.random.uniform(0, 2 * numpy.pi, events_per_probe)
+    radius = DISK_RADIUS * numpy.sqrt(numpy.random.uniform(0, 1, events_per_probe))
+    y = (DETECTOR_SHAPE[0] // 2 + radius * numpy.sin(angle)).astype(numpy.uint64)
+    x = (DETECTOR_SHAPE[1] // 2 + radius * numpy.cos(angle)).astype(numpy.uint64)
+    scattered = numpy.random.rand(events_per_probe) < 0.1
+    y[scattered] = numpy.random.randint(0, DETECTOR_SHAPE[0], numpy.count_nonzero(scattered))
+    x[scattered] = numpy.random.randint(0, DETECTOR_SHAPE[1], numpy.count_nonzero(scattered))
+    return y * numpy.uint64(DETECTOR_SHAPE[1]) + x
+
+
+def run_shape(shape, events_per_probe):
+    number_of_probes = shape[0] * shape[1]
+    detector_size = DETECTOR_SHAPE[0] * DETECTOR_SHAPE[1]
+    store = tp3sparse.SparseEventStore(shape[0], shape[1], DETECTOR_SHAPE)
+    engine = tp3accumulate.AccumulationEngine()
+    pattern = create_probe_events(events_per_probe)
+    probes_per_batch = max(BATCH_SIZE // events_per_probe, 1)
+
+    start = time.perf_counter()
+    for first in range(0, number_of_probes, probes_per_batch):
+        probes = numpy.arange(first, min(first + probes_per_batch, number_of_probes), dtype=numpy.uint64)
+        batch = (probes[:, numpy.newaxis] * numpy.uint64(detector_size) + pattern).reshape(-1)
+        store.add_events(batch, engine)
+    ingest = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store.get_diffraction(shape[0] // 2, shape[1] // 2)
+    densify = time.perf_counter() - start
+
+    mask = numpy.zeros(DETECTOR_SHAPE, dtype=numpy.float32)
+    yy, xx = numpy.indices(DETECTOR_SHAPE)
+    mask[(yy - DETECTOR_SHAPE[0] // 2) ** 2 + (xx - DETECTOR_SHAPE[1] // 2) ** 2 < DISK_RADIUS ** 2] = 1
+    start = time.perf_counter()
+    store.integrate(mask)
+    integrate = time.perf_counter() - start
+
+    dense_bytes = number_of_probes * detector_size
+    print(f'{shape} x {DETECTOR_SHAPE} with {events_per_probe:>5} events/probe: dense {dense_bytes / 1e9:8.2f} GB, '
+          f'sparse {store.memory_bytes / 1e9:6.2f} GB (preview binned by {store.preview_binning}), '
+          f'dropped {store.dropped_events}. Ingest {store.total_events / ingest:.3g} events/s, '
+          f'densify {densify * 1e3:.1f} ms, virtual BF {integrate:.2f} s.')
+
+
+if __name__ == "__main__":
+    for shape in SHAPES:
+        for events_per_probe in EVENTS_PER_PROBE:
+            run_shape(shape, events_per_probe)
@@ -0,0 +1,242 @@
+"""
+Benchmarks the Timepix3 jsonimage frame client against a local stream stand-in.
+
+The stand-in sends the jsonimage format (header terminated by '}\n' followed by the frame) as fast as the loopback
+allows. The legacy client rebuilds the frame by concatenating bytes and copies it twice, while JsonImageReceiver
+lands the payload directly in the data array.
+
+Header parsing is measured in headers/s against the previous string scanning, and JsonImageReceiver is checked on
+streams sent in random chunks, so headers and payloads are cut anywhere.
+
+For event streams, a slow decoder (as a GUI refresh or numba compilation stall) is simulated. Reading and decoding in
+the same thread throttles the sender, while EventStreamPipeline keeps draining the socket and reports queue depth,
+dropped buffers and per-stage latency.
+"""
+import random
+import socket
+import threading
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3stream
+
+BUFFER_SIZE = 64000
+NUMBER_OF_FRAMES = 2000
+WIDTH, HEIGHT = 1025, 256
+
+
+def create_header(frame_number: int, data_size: int) -> bytes:
+    return ("{{\"timeAtFrame\":{},\"frameNumber\":{},\"measurementID\":Null,\"dataSize\":{},\"bitDepth\":{},"
+            "\"width\":{},\"height\":{}}}\n").format(0.0, frame_number, data_size, 32, WIDTH, HEIGHT).encode()
+
+
+def stream_stand_in(server_socket, number_of_frames):
+    client_socket, _ = server_socket.accept()
+    frame = (100.0 * numpy.random.rand(HEIGHT, WIDTH)).astype('uint32').tobytes()
+    try:
+        for frame_number in range(number_of_frames):
+            client_socket.sendall(create_header(frame_number, len(frame)))
+            client_socket.sendall(frame)
+    finally:
+        client_socket.close()
+
+
+def connect(number_of_frames):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    thread = threading.Thread(target=stream_stand_in, args=(server_socket, number_of_frames))
+    thread.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(server_socket.getsockname())
+    return client, server_socket, thread
+
+
+def legacy_client(client, data, number_of_frames):
+    copies = 0
+    for _ in range(number_of_frames):
+        packet_data = client.recv(128)
+        while (packet_data.find(b'{"time') == -1) or (packet_data.find(b'}\n') == -1):
+            temp = client.recv(BUFFER_SIZE)
+            copies += len(packet_data)
+            packet_data += temp
+        end_header = packet_data.index(b'}\n')
+        header = packet_data[:end_header + 1].decode('latin-1')
+        data_size = WIDTH * HEIGHT * 4
+        how_many_more_bytes = data_size + len(header) - len(packet_data) + 1
+        while how_many_more_bytes != 0:
+            copies += len(packet_data)
+            packet_data += client.recv(min(BUFFER_SIZE, how_many_more_bytes))
+            how_many_more_bytes = data_size + len(header) - len(packet_data) + 1
+        frame_data = packet_data[end_header + 2:end_header + 2 + data_size]
+        copies += len(frame_data)
+        data[:] = numpy.frombuffer(frame_data, dtype=data.dtype)[:]
+        copies += data.nbytes
+    return copies
+
+
+def receiver_client(client, data, number_of_frames):
+    receiver = tp3stream.JsonImageReceiver(data.size, data.itemsize)
+    receiver.attach(client)
+    for _ in range(number_of_frames):
+        receiver.receive_header()
+        receiver.receive_into(data, 0, data.nbytes)
+    return 0
+
+
+def check_string_value(header, prop):
+    start_index = header.index(prop)
+    end_index = start_index + len(prop)
+    begin_value = header.index(':', end_index, len(header)) + 1
+    if prop == 'height':
+        end_value = header.index('}', end_index, len(header))
+    else:
+        end_value = header.index(',', end_index, len(header))
+    try:
+        if prop == 'timeAtFrame':
+            value = float(header[begin_value:end_value])
+        else:
+            value = int(header[begin_value:end_value])
+    except ValueError:
+        value = str(header[begin_value:end_value])
+    return value
+
+
+def legacy_parse(header: bytes) -> dict:
+    header = header.decode('latin-1')
+    cam_properties = dict()
+    for properties in ["timeAtFrame", "frameNumber", "measurementID", "dataSize", "bitDepth", "width", "height"]:
+        cam_properties[properties] = check_string_value(header, properties)
+    return cam_properties
+
+
+def run_header_parsing(number_of_headers=200000):
+    headers = [create_header(frame_number, WIDTH * 4)[:-1] for frame_number in range(1000)]
+    for name, function in [('Legacy string scanning', legacy_parse), ('parse_header', tp3stream.parse_header)]:
+        start = time.perf_counter()
+        for index in range(number_of_headers):
+            function(headers[index % 1000])
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {number_of_headers / elapsed:.0f} headers/s.')
+
+
+def chunked_stand_in(server_socket, stream, max_chunk):
+    client_socket, _ = server_socket.accept()
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    index = 0
+    try:
+        while index < len(stream):
+            chunk_size = random.randint(1, max_chunk)
+            client_socket.sendall(stream[index:index + chunk_size])
+            index += chunk_size
+    finally:
+        client_socket.close()
+
+
+def check_chunked_receiver(number_of_frames=500, trials=5, max_chunk=4096):
+    frames = list()
+    stream = bytearray()
+    for frame_number in range(number_of_frames):
+        payload = numpy.random.randint(0, 255, 4 * random.randint(1, 2048), dtype=numpy.uint8).tobytes()
+        frames.append(payload)
+        stream += create_header(frame_number, len(payload)) + payload
+    data = numpy.zeros(2048, dtype=numpy.uint32)
+    for _ in range(trials):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.bind(('127.0.0.1', 0))
+        server_socket.listen(1)
+        thread = threading.Thread(target=chunked_stand_in, args=(server_socket, bytes(stream), max_chunk))
+        thread.start()
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(server_socket.getsockname())
+        receiver = tp3stream.JsonImageReceiver(data.size, data.itemsize)
+        receiver.attach(client)
+        for frame_number, payload in enumerate(frames):
+            properties = receiver.receive_header()
+            assert properties['frameNumber'] == frame_number
+            assert receiver.receive_into(data, 0, properties['dataSize'])
+            assert data.view(numpy.uint8)[:len(payload)].tobytes() == payload
+        thread.join()
+        client.close()
+        server_socket.close()
+    print(f'JsonImageReceiver: {trials} randomly chunked streams of {number_of_frames} frames received correctly.')
+
+
+def event_stand_in(server_socket, total_bytes, sender_times):
+    client_socket, _ = server_socket.accept()
+    events = numpy.random.randint(0, 64 * 64 * 1025, 1 << 18, dtype=numpy.uint32).tobytes()
+    start = time.perf_counter()
+    sent = 0
+    try:
+        while sent < total_bytes:
+            client_socket.sendall(events)
+            sent += len(events)
+    except OSError:
+        pass
+    finally:
+        sender_times.append(time.perf_counter() - start)
+        client_socket.close()
+
+
+def run_events(name, use_pipeline, decode_delay=0.002, stall_every=50, total_bytes=1 << 30):
+    histogram = numpy.zeros(64 * 64 * 1025, dtype=numpy.uint32)
+    decoded = 0
+
+    def decode(buffer):
+        nonlocal decoded
+        events = numpy.frombuffer(buffer, dtype=numpy.uint32)
+        numpy.add.at(histogram, events[:1024], 1)
+        decoded += 1
+        if decoded % stall_every == 0:
+            time.sleep(decode_delay * stall_every)
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    sender_times = list()
+    thread = threading.Thread(target=event_stand_in, args=(server_socket, total_bytes, sender_times))
+    thread.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(server_socket.getsockname())
+    if use_pipeline:
+        pipeline = tp3stream.EventStreamPipeline()
+        pipeline.start(client, decode)
+        pipeline.finished.wait()
+        pipeline.stop()
+        counters = pipeline.counters
+    else:
+        buffer = bytearray(BUFFER_SIZE)
+        while True:
+            nbytes = client.recv_into(buffer)
+            if nbytes == 0:
+                break
+            decode(memoryview(buffer)[:nbytes - nbytes % 8])
+        counters = dict()
+    thread.join()
+    client.close()
+    server_socket.close()
+    print(f'{name}: sender throughput {total_bytes / sender_times[0] / 1e6:.1f} MB/s. {counters}')
+
+
+def run(name, function, number_of_frames=NUMBER_OF_FRAMES):
+    data = numpy.zeros(WIDTH * HEIGHT, dtype=numpy.uint32)
+    client, server_socket, thread = connect(number_of_frames)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    copies = function(client, data, number_of_frames)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    thread.join()
+    client.close()
+    server_socket.close()
+    print(f'{name}: {number_of_frames / elapsed:.1f} frames/s, {data.nbytes * number_of_frames / elapsed / 1e6:.1f} MB/s, '
+          f'CPU {cpu / number_of_frames * 1e6:.1f} us/frame, {copies / number_of_frames / 1e6:.2f} MB copied/frame.')
+
+
+if __name__ == "__main__":
+    run('Legacy concatenation', legacy_client)
+    run('JsonImageReceiver', receiver_client)
+    run_header_parsing()
+    check_chunked_receiver()
+    run_events('Read and decode in one thread', False)
+    run_events('EventStreamPipeline', True)
@@ -3,6 +3,11 @@ import numpy
 from nion.typeshed import Interactive_1_0 as Interactive
 from nion.typeshed import API_1_0 as API
 from nion.typeshed import UI_1_0 as UI
+from nion.instrumentation import HardwareSource
+
+from nionswift_plugin.IVG.tp3 import tp3virtual
+
+MASK_SHAPE = (256, 256) #Masks written for the FRAME_4DMASKED server pipeline
 
 
 class MaskCreator():
@@ -18,14 +23,14 @@ class MaskCreator():
         center = [(a*b)%256 for (a, b) in zip(graphic.center, self.data_shape)]
         radius = [(a*b / 2)%256 for (a, b) in zip(graphic.size, self.data_shape)]
         print(f'Creating BF mask. Center is {center} and radius is {radius}.')
-        self.__create_round_mask(center, radius, 0, 1)
+        self.__append_mask(tp3virtual.create_annular_mask(MASK_SHAPE, center, 0.0, radius))
 
     def create_adf(self):
         graphic = self.graphics['ADF']
         center = [(a*b)%256 for (a, b) in zip(graphic.center, self.data_shape)]
         radius = [(a*b / 2)%256 for (a, b) in zip(graphic.size, self.data_shape)]
         print(f'Creating ADF mask. Center is {center} and radius is {radius}.')
-        self.__create_round_mask(center, radius, 1, 0)
+        self.__append_mask(tp3virtual.create_annular_mask(MASK_SHAPE, center, radius, None))
 
     def reset_masks(self):
         self.masks_serial = numpy.array([], dtype=numpy.int16)
@@ -54,14 +59,28 @@ class MaskCreator():
         circle2.label = 'ADF'
         self.graphics['ADF'] = circle2
 
-    def __create_round_mask(self, center, radius, initial, value):
-        mask = numpy.zeros(256 * 256, dtype=numpy.int16)
-        mask[:] = initial
-        for x in range(256):
-            for y in range(256):
-                if ((x - center[1]) / radius[1]) ** 2 + ((y - center[0]) / radius[0]) ** 2 < 1:
-                    mask[y * 256 + x] = value
-        self.masks_serial = numpy.append(self.masks_serial, mask)
+    def __append_mask(self, mask):
+        self.masks_serial = numpy.append(self.masks_serial, mask.astype(numpy.int16).reshape(-1))
+
+    def update_virtual_detectors(self):
+        """
+        Sends the BF and ADF graphics to the live virtual detectors of the Timepix3 (EVENT_4DRAW). No reconnection
+        is needed, the images are integrated again from the events already received.
+        """
+        cam = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id("orsay_camera_timepix3")
+        if cam is None:
+            return
+        engine = cam.camera.camera.virtual_detectors
+        shape = engine.detector_shape
+        for name in ['BF', 'ADF']:
+            graphic = self.graphics[name]
+            center = [a * b for (a, b) in zip(graphic.center, shape)]
+            radius = [a * b / 2 for (a, b) in zip(graphic.size, shape)]
+            if name == 'BF':
+                engine.set_detector(name, tp3virtual.create_annular_mask(shape, center, 0.0, radius))
+            else:
+                engine.set_detector(name, tp3virtual.create_annular_mask(shape, center, radius, None))
+        print(f'Virtual detectors updated: {engine.names}.')
 
     def output_values(self):
         print(f'Mask is written to file. Size is {self.masks_serial.shape}.')
@@ -75,6 +94,7 @@ def do_task(interactive: Interactive, api: API):
     mask_obj.create_bf()
     mask_obj.create_adf()
     mask_obj.output_values()
+    mask_obj.update_virtual_detectors()
     while True:
         is_confirmed = interactive.confirm_yes_no('Update 4D Mask')
         if is_confirmed:
@@ -82,6 +102,7 @@ def do_task(interactive: Interactive, api: API):
             mask_obj.create_bf()
             mask_obj.create_adf()
             mask_obj.output_values()
+            mask_obj.update_virtual_detectors()
         else:
             break
 
@@ -2,6 +2,7 @@ from nion.typeshed import API_1_0 as API
 from nion.typeshed import UI_1_0 as UI
 from nion.typeshed import Interactive_1_0 as Interactive
 import nionswift_plugin.orsay_suite.orsay_data as OD
+from nionswift_plugin.IVG.scan import scan_patterns
 import numpy
 
 #Hyperspy import for Typing
@@ -18,13 +19,23 @@ def script_main(api_broker):
     prod_data_shape = numpy.prod(data_shape)
     metadata = data_item.metadata
     title = data_item.title
+    if metadata.get('hardware_source', dict()).get('reordered', False):
+        #Camera SPIMs with a scan pattern are put in scan order during the acquisition
+        print(f'{title} is already in scan order. Nothing to do.')
+        return
     scan_size = numpy.prod(metadata['scan']['scan_size'])
-    try:
-        decode_list = metadata['scan']['scan_device_properties']['decode_list']
-    except KeyError:
+    scan_device_properties = metadata['scan']['scan_device_properties']
+    if 'scan_pattern' in scan_device_properties:
+        decode_list = scan_patterns.load_mask(scan_device_properties['scan_pattern'])
+    elif 'decode_list' in scan_device_properties:
+        decode_list = scan_device_properties['decode_list']
+    else:
         #This is the camera data.
-        decode_list = metadata['hardware_source']['decode_list']
-        decode_list = [(x - 1) % scan_size for x in decode_list]
+        if 'scan_pattern' in metadata['hardware_source']:
+            decode_list = scan_patterns.load_mask(metadata['hardware_source']['scan_pattern'])
+        else:
+            decode_list = metadata['hardware_source']['decode_list']
+        decode_list = (numpy.array(decode_list, dtype='int') - 1) % scan_size
     decode_list = numpy.array(decode_list, dtype='int')
 
     ### Getting a hyperspy object ###
@@ -0,0 +1,42 @@
+"""
+Acquires the same spectrum image with the EELS, CL and Timepix3 cameras at once. Every camera is armed, then the scan
+is started in external clock mode and clocks all of them. The timing report shows the time saved with respect to
+acquiring the cameras one after the other.
+"""
+from nion.swift.model import HardwareSource
+from nion.typeshed import API_1_0 as API
+from nion.typeshed import UI_1_0 as UI
+
+from nionswift_plugin.IVG.camera import synchronized_acquisition
+
+api = api_broker.get_api(API.version, UI.version)  # type: API
+
+CAMERAS = ["orsay_camera_eels", "orsay_camera_eire", "orsay_camera_timepix3"]
+SCAN_SHAPE = (64, 64)
+
+scan = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id("orsay_scan_device")
+camera_devices = {camera_id: HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
+    camera_id).camera for camera_id in CAMERAS}
+exposure_ms = max(camera_device.current_camera_settings.exposure_ms for camera_device in camera_devices.values())
+
+
+def trigger():
+    frame_parameters = scan.get_current_frame_parameters()
+    frame_parameters.pixel_size = SCAN_SHAPE
+    scan.scan_device.prepare_synchronized_scan(frame_parameters, camera_exposure_ms=exposure_ms)
+    scan.set_current_frame_parameters(frame_parameters)
+    scan.start_playing()
+
+
+acquisition = synchronized_acquisition.SynchronizedAcquisition(camera_devices, SCAN_SHAPE, trigger)
+data = acquisition.run()
+scan.stop_playing()
+
+for camera_id, xdata in data.items():
+    data_item = api.library.create_data_item_from_data_and_metadata(xdata, title=camera_id + " (synchronized)")
+
+report = acquisition.get_report()
+print(f'Acquired in {report["wall_time"]:.1f} s, {report["dead_time_removed"]:.1f} s less than one camera after the '
+      f'other.')
+for camera_id, timing in report["devices"].items():
+    print(f'{camera_id}: {timing}')
@@ -20,12 +20,22 @@ from nion.data import DataAndMetadata
 from nion.instrumentation.camera_base import CameraFrameParameters
 
 try:
-    from ..aux_files import read_data
+    from ..aux_files import read_data, disk_spim, spim_reorder, frame_accumulation, buffer_pool
 except ImportError:
-    from ...aux_files import read_data
+    from ...aux_files import read_data, disk_spim, spim_reorder, frame_accumulation, buffer_pool
 
 _ = gettext.gettext
 
+MIN_UPDATE_PERIOD = 0.02 #Partial SPIM data is not published faster than this (in seconds)
+MAX_UPDATE_PERIOD = 0.1 #Rows slower than this are published as soon as they are complete
+CURRENT_UPDATE_PERIOD = 0.1 #Beam current is sent to the panel at most this often (in seconds)
+READOUT_SMOOTHING = 0.1 #Weight of each new frame in the measured readout time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 
 # #Monkey patching camera_base because of the has_attr
 # def test_update_spatial_calibrations(data_element, instrument_controller, camera, camera_category, data_shape, scaling_x, scaling_y):
@@ -62,12 +72,117 @@ _ = gettext.gettext
 class Orsay_Data(Enum):
     s16 = 2
     s32 = 3
+    uns8 = 5
     uns16 = 6
     uns32 = 7
     float = 11
     real = 12
 
 
+class SpimProgress:
+    """
+    Number of valid spectra of the SPIM being acquired. It is fed by the spim unlockers of the camera DLL and by the
+    Timepix3 messages. update is called for every spectrum and only takes the lock when a scan row is completed, so
+    grab_partial is woken up as soon as new rows are ready instead of polling.
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.reset(0, 1)
+
+    def reset(self, spectra_count: int, row_length: int):
+        with self.__condition:
+            self.spectra_count = spectra_count
+            self.row_length = max(row_length, 1)
+            self.spectra = 0
+            self.rows = 0
+            self.running = True
+            self.row_time = time.perf_counter()
+
+    @property
+    def is_complete(self) -> bool:
+        return self.spectra >= self.spectra_count
+
+    def update(self, spectra: int, running: bool = True):
+        self.spectra = spectra
+        rows = spectra // self.row_length
+        if rows != self.rows or not running:
+            with self.__condition:
+                self.rows = rows
+                self.running = running
+                self.row_time = time.perf_counter()
+                self.__condition.notify_all()
+
+    def wake(self):
+        with self.__condition:
+            self.running = False
+            self.__condition.notify_all()
+
+    def wait_for_rows(self, rows: int, timeout: float) -> int:
+        """
+        Waits until more than rows are valid, the acquisition stops or timeout. Returns the number of valid rows.
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.rows > rows or not self.running or self.is_complete, timeout)
+            return self.rows
+
+
+class ReadoutCalibration:
+    """
+    Readout time measured from the frame periods in Focus and Cumul, for each port, speed, binning and turbo mode. The
+    measurements are saved in Orsay_readout_<camera_id>.json and used to plan sequences. For settings that were never
+    measured, the readout time given by the camera is used.
+    """
+
+    def __init__(self, camera_id: str):
+        try:
+            self.__file = read_data.FileManager('Orsay_readout_' + camera_id)
+            self.readout_times = self.__file.settings
+        except OSError:
+            self.__file = None
+            self.readout_times = dict()
+        self.__key = None
+        self.__exposure = 0.0
+        self.__last_frame = None
+
+    @staticmethod
+    def create_key(settings: dict) -> str:
+        return (f"{settings.get('port', 0)}/{settings.get('speed', 0)}/{settings.get('h_binning', 1)}x"
+                f"{settings.get('v_binning', 1)}/{bool(settings.get('turbo_mode_enabled', False))}")
+
+    def start(self, settings: dict):
+        self.__key = self.create_key(settings)
+        self.__exposure = settings['exposure_ms'] / 1000
+        self.__last_frame = None
+
+    def add_frame(self):
+        now = time.perf_counter()
+        if self.__key is not None and self.__last_frame is not None:
+            readout = max(now - self.__last_frame - self.__exposure, 0.0)
+            previous = self.readout_times.get(self.__key)
+            if previous is not None:
+                readout = previous + READOUT_SMOOTHING * (readout - previous)
+            self.readout_times[self.__key] = readout
+        self.__last_frame = now
+
+    def stop(self):
+        self.__key = None
+        if self.__file is not None:
+            try:
+                self.__file.save_locally()
+            except OSError:
+                logging.info(f'***CAMERA***: Could not save the readout times in {self.__file.abs_path}.')
+
+    def get_readout_time(self, settings: dict, default: float) -> (float, bool):
+        """
+        Returns the readout time and whether it was measured.
+        """
+        readout = self.readout_times.get(self.create_key(settings))
+        if readout is None:
+            return default, False
+        return readout, True
+
+
 class CameraTask:
     def __init__(self, camera_device: "Camera", camera_frame_parameters, scan_shape: typing.Tuple[int, ...]):
         self.__camera_device = camera_device
@@ -77,21 +192,17 @@ class CameraTask:
         self.__aborted = False
         self.__xdata: typing.Optional[DataAndMetadata.DataAndMetadata] = None
         self.__start = 0
-        self.__start_time = 0
+        self.__last_publish = 0
+        self.__update_period = MIN_UPDATE_PERIOD
         self.__last_rows = 0
         self.__headers = False
+        self.__sink = None
+        self.__reorder = None
 
     @property
     def xdata(self) -> typing.Optional[DataAndMetadata.DataAndMetadata]:
         return self.__xdata
 
-    def grab_decoded_array(self):
-        if self.__decode_array is not None:
-            temp = self.__data.reshape(
-                (self.__scan_shape[0] * self.__scan_shape[1], self.sizex))[self.__decode_array].reshape((self.__scan_shape[0], self.__scan_shape[1], self.sizex))
-            self.__xdata = DataAndMetadata.new_data_and_metadata(
-                temp, data_descriptor=self.__data_descriptor, metadata=self.__metadata)
-
     def prepare(self) -> None:
         # returns the full scan readout, including flyback pixels
         scan_size = int(numpy.product(self.__scan_shape))
@@ -99,59 +210,71 @@ class CameraTask:
         self.__last_rows = 0
         self.__headers = False
         self.__camera_device.frame_number = 0
+        self.__camera_device.spim_progress.reset(scan_size, self.__scan_shape[1])
+        #Partial data is published once per scan row, within the MIN_UPDATE_PERIOD and MAX_UPDATE_PERIOD limits
+        row_time = self.__camera_device.current_camera_settings.exposure_ms / 1000 * self.__scan_shape[1]
+        self.__update_period = min(max(row_time, MIN_UPDATE_PERIOD), MAX_UPDATE_PERIOD)
         self.sizex, self.sizey = self.__camera_device.camera.getImageSize()
         settings = self.__camera_device.current_camera_settings.as_dict()
         # twoD = self.__camera_device.current_camera_settings.processing != "sum_project" \
         #               and not self.__camera_device.current_camera_settings.soft_binning
         self.__twoD = (self.sizey > 1) and not settings['soft_binning']
         self.__camera_device.current_camera_settings.processing = "None"
-        datatype = numpy.float32
-        # if "orsay" in settings.keys() and settings["orsay"]:
-        # if hasattr(self.__camera_device, "isMedipix") and self.__camera_device.isMedipix:
-        #     pixel_depth = self.__camera_device.pixeldepth
-        #     if pixel_depth == 1:
-        #         datatype = numpy.uint8
-        #     elif pixel_depth == 6:
-        #         if self.__twoD:
-        #             datatype = numpy.uint8
-        #         else:
-        #             datatype = numpy.uint16
-        #     elif pixel_depth == 12:
-        #         if self.__twoD:
-        #             datatype = numpy.uint16
-        #         else:
-        #             datatype = numpy.uint32
+        datatype = self.__camera_device.get_data_type(1 if self.__twoD else self.sizey)
+
+        #This is for OpenScan only. It applies the mask so you can do any scan pattern without worrying
+        scan_controller = Registry.get_component("stem_controller").scan_controller
+        if scan_controller.scan_device.scan_device_id == "open_scan_device":
+            self.__scan_pattern = scan_controller.scan_device.scan_engine.get_scan_pattern()
+            self.__decode_array = self.__scan_pattern.get_camera_decode(scan_size)
+        else:
+            self.__scan_pattern = None
+            self.__decode_array = numpy.zeros(0)
+        #A scan pattern needs a second cube, in scan order
+        copies = 2 if self.__decode_array.size > 0 else 1
         if self.__twoD:
             self.sizez = scan_size
             reshape_array = (self.__scan_shape[0], self.__scan_shape[1], self.sizey, self.sizex)
-            self.__camera_device.spimimagedata = numpy.zeros(reshape_array, dtype=datatype)
+            self.__camera_device.spimimagedata, self.__sink = disk_spim.create_spim_array(
+                reshape_array, datatype, self.__camera_device.buffer_pool.lease, copies)
             camera_readout_shape = (self.sizey, self.sizex)
         else:
             self.sizey = scan_size
             self.sizez = 1
             reshape_array = (self.__scan_shape[0], self.__scan_shape[1], self.sizex)
-            self.__camera_device.spimimagedata = numpy.zeros(reshape_array,
-                                                             dtype=datatype)
+            self.__camera_device.spimimagedata, self.__sink = disk_spim.create_spim_array(
+                reshape_array, datatype, self.__camera_device.buffer_pool.lease, copies)
             camera_readout_shape = (self.sizex,)
         print(f"Spim dimensions {self.sizex} {self.sizey} {self.sizez}")
         self.__data_descriptor = DataAndMetadata.DataDescriptor(False, len(self.__scan_shape),
                                                                 len(camera_readout_shape))
-        if settings['flipped']:
-            self.__data = numpy.flip(self.__camera_device.spimimagedata, axis=2)
-        else:
-            self.__data = self.__camera_device.spimimagedata
 
-        #This is for OpenScan only. It applies the mask so you can do any scan pattern without worrying
-        scan_controller = Registry.get_component("stem_controller").scan_controller
-        if scan_controller.scan_device.scan_device_id == "open_scan_device":
-            self.__decode_array = scan_controller.scan_device.scan_engine.get_mask_array()
+        if self.__decode_array.size > 0:
+            self.__reorder = spim_reorder.SpimReorder(self.__camera_device.spimimagedata, self.__scan_shape,
+                                                      self.__decode_array,
+                                                      self.__scan_pattern.get_order(scan_size))
+            data = self.__reorder.data
         else:
-            self.__decode_array = numpy.zeros(0)
+            self.__reorder = None
+            data = self.__camera_device.spimimagedata
+        #Flipping is a view over the spectra axis. Nothing is copied
+        self.__data = numpy.flip(data, axis=-1) if settings['flipped'] else data
 
         #Adding metadata to the measurement
         self.__metadata = dict()
         self.__metadata['hardware_source'] = dict()
-        self.__metadata['hardware_source']['decode_list'] = self.__decode_array.tolist()
+        if self.__decode_array.size > 0:
+            self.__metadata['hardware_source']['scan_pattern'] = self.__scan_pattern.reference
+            #The SPIM is published in scan order, so the scan pattern must not be applied again
+            self.__metadata['hardware_source']['reordered'] = True
+        else:
+            self.__metadata['hardware_source']['decode_list'] = list()
+        #The reordered copy of a scan pattern SPIM doubles its memory
+        spim_memory = {"acquisition": self.__camera_device.spimimagedata.nbytes,
+                       "reorder": 0 if self.__reorder is None else self.__reorder.memory_bytes}
+        self.__metadata['hardware_source']['spim_memory'] = spim_memory
+        logging.info(f'***CAMERA***: SPIM uses {spim_memory["acquisition"] / 1e9:.2f} GB, plus '
+                     f'{spim_memory["reorder"] / 1e9:.2f} GB for the scan pattern reordering.')
         if self.__headers == False:
             if self.__camera_device.isMedipix:
                 self.__metadata["hardware_source"]["merlin"] = dict()
@@ -171,26 +294,52 @@ class CameraTask:
 
     def start(self) -> typing.Optional[DataAndMetadata.DataAndMetadata]:
         self.__camera_device.camera.resumeSpim(4)  # stop eof
-        self.__start_time = time.time_ns()
+        self.__last_publish = time.perf_counter()
         return self.__xdata
 
     def grab_partial(self, *, update_period: float = 1.0) -> typing.Tuple[bool, bool, int]:
         # updates the full scan readout data, returns a tuple of is complete, is canceled, and
-        # the number of valid rows.
-        elapsed_time = time.time_ns() - self.__start_time
-        wait_time = update_period - elapsed_time * 1e-9
+        # the number of valid rows. xdata is a view of the SPIM, so only the newly valid rows are copied by the caller.
+        # New rows wake it up right away, but it does not return faster than the update period matched to the row time.
+        wait_time = self.__update_period - (time.perf_counter() - self.__last_publish)
         if wait_time > 0.001:
             time.sleep(wait_time)
-        self.__start_time = time.time_ns()
         if not self.__aborted:
-            rows = self.__camera_device.frame_number // self.__scan_shape[1]
-            is_complete = self.__camera_device.frame_number >= self.__scan_count
-            # if self.__last_rows != rows or self.__last_rows == self.__scan_shape[0]:
+            progress = self.__camera_device.spim_progress
+            rows = progress.wait_for_rows(self.__last_rows, update_period)
+            is_complete = progress.is_complete
+            self.__last_publish = time.perf_counter()
             self.__last_rows = rows
-            print(f"valid rows {rows},  frame number {self.__camera_device.frame_number}/{self.__scan_count}")
+            if self.__sink is not None:
+                self.__sink.advance(rows)
+                if is_complete:
+                    self.__sink.flush()
+            if self.__reorder is not None:
+                #Only the spectra acquired since the last update are put in scan order
+                rows = self.__reorder.update(progress.spectra)
+                if is_complete:
+                    rows = self.__scan_shape[0]
             return is_complete, False, rows
         return True, True, 0
 
+    def close(self) -> None:
+        """
+        Called once the acquisition ends, when the caller has copied the data. A spectrum image on disk is closed and
+        its file removed. The references to it are dropped first so that the mapping can be closed.
+        """
+        if self.__sink is None and self.__reorder is None:
+            return
+        self.__xdata = None
+        self.__data = None
+        if self.__sink is not None:
+            self.__camera_device.spimimagedata = None
+            self.__camera_device.spimimagedata_ptr = None
+            self.__sink.close()
+            self.__sink = None
+        if self.__reorder is not None:
+            self.__reorder.close()
+            self.__reorder = None
+
 
 class CameraDevice(camera_base.CameraDevice):
 
@@ -240,6 +389,12 @@ class CameraDevice(camera_base.CameraDevice):
         self.imagedata_ptr = None
         self.acquire_data = None
         self.has_data_event = threading.Event()
+        if manufacturer == 4 or manufacturer == 6: #Timepix3 adds its frames when computing the current
+            self.frame_accumulator = self.camera.frame_accumulator
+        else:
+            self.frame_accumulator = frame_accumulation.FrameAccumulator()
+        self.readout_calibration = ReadoutCalibration(self.camera_id)
+        self.buffer_pool = buffer_pool.BufferPool()
 
         # register data locker for SPIM acquisition
         if manufacturer != 4 and manufacturer != 6: #We dont do this for TPX3 and QD
@@ -261,6 +416,8 @@ class CameraDevice(camera_base.CameraDevice):
         self.spimimagedata = None
         self.spimimagedata_ptr = None
         self.has_spim_data_event = threading.Event()
+        self.spim_progress = SpimProgress()
+        self.__cancel_sequence_event = threading.Event()
 
         self.__cumul_on = False
         bx, by = self.camera.getBinning()
@@ -298,10 +455,14 @@ class CameraDevice(camera_base.CameraDevice):
 
         self.camera.setAccumulationNumber(self.current_camera_settings.as_dict()['spectra_count'])
         self.frame_number = 0
+        #Cached for the data callbacks, which run for every frame
+        self.__is_chrono = False
+        self.__hardware_source = None
 
         self.__processing = None
 
         self.__acqon = False
+        self.__camera_task = None
         self.__x_pix_spim = 30
         self.__y_pix_spim = 30
 
@@ -456,6 +617,23 @@ class CameraDevice(camera_base.CameraDevice):
                 self.__hardware_settings['gaps_mode'] = dict_frame_parameters['gaps_mode']
                 self.camera.gaps_mode = self.__hardware_settings['gaps_mode']
 
+    def get_data_type(self, summed_rows: int = 1, accumulated: bool = False):
+        """
+        Native data type of the spim and image buffers. Counting detectors are accumulated as integers, with enough
+        bits for their pixel depth and the number of rows summed in each pixel, so the 1-bit and 6-bit Medipix modes fit
+        in a byte when no rows are summed. Other cameras are corrected in float by the DLL.
+        """
+        if self.isTimepix:
+            return numpy.uint32
+        if not self.isMedipix:
+            return numpy.float32
+        bits = self.pixeldepth + int(numpy.ceil(numpy.log2(max(summed_rows, 1))))
+        if bits <= 8 and not accumulated:
+            return numpy.uint8
+        if bits <= 16 and not accumulated:
+            return numpy.uint16
+        return numpy.uint32
+
     def __numpy_to_orsay_type(self, array: numpy.array):
         orsay_type = Orsay_Data.float
         if array.dtype == numpy.double:
@@ -464,6 +642,8 @@ class CameraDevice(camera_base.CameraDevice):
             orsay_type = Orsay_Data.s16
         if array.dtype == numpy.int32:
             orsay_type = Orsay_Data.s32
+        if array.dtype == numpy.uint8:
+            orsay_type = Orsay_Data.uns8
         if array.dtype == numpy.uint16:
             orsay_type = Orsay_Data.uns16
         if array.dtype == numpy.uint32:
@@ -480,26 +660,33 @@ class CameraDevice(camera_base.CameraDevice):
         sx[0] = self.sizex
         sy[0] = self.sizey
         sz[0] = 1
-        data_type[0] = self.__numpy_to_orsay_type(self.imagedata)
         if self.imagedata_ptr is None:
             return None
         else:
+            data_type[0] = self.__numpy_to_orsay_type(self.imagedata)
             return self.imagedata_ptr.value
 
+    def __stop_playing(self):
+        # the hardware source is looked up once, not in every callback
+        if self.__hardware_source is None:
+            self.__hardware_source = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
+                self.camera_id)
+        self.__hardware_source.stop_playing()
+
     def __data_unlocker(self, gene, new_data):
         self.frame_number += 1
-        status = self.camera.getCCDStatus()
-        if new_data:
-            t = time.time()
-            if t - self._last_time > 0.1:
-                self._last_time = t
+        if new_data and self.__acqon:
+            self.readout_calibration.add_frame()
+            #In Cumul, the DLL gives the running sum
+            self.frame_accumulator.add(self.imagedata, self.__cumul_on)
         self.has_data_event.set()
-        if status["mode"] == "Cumul":
-            self.frame_number = status["accumulation_count"]
-        if self.__cumul_on and status["mode"] == "idle":
-            hardware_source = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                self.camera_id)
-            hardware_source.stop_playing()
+        if self.__cumul_on:
+            #Status is only needed in Cumul, for the accumulation count and the end of the acquisition
+            mode, accumulation_count = self.camera.getCCDStatusValues()
+            if mode == self.camera.STATUS_CUMUL:
+                self.frame_number = int(accumulation_count)
+            elif mode == self.camera.STATUS_IDLE:
+                self.__stop_playing()
 
     def __spim_data_locker(self, gene, data_type, sx, sy, sz):
         sx[0] = self.__x_pix_spim
@@ -510,10 +697,12 @@ class CameraDevice(camera_base.CameraDevice):
         return self.spimimagedata_ptr.value
 
     def __spim_data_unlocker(self, gene :int, new_data : bool, running : bool):
-        status = self.camera.getCCDStatus()
-        # if status["mode"] == "Spectrum imaging":
-        self.frame_number = int(status["current spectrum"])
-        if "Chrono" in status["mode"]:
+        mode, current_spectrum = self.camera.getCCDStatusValues()
+        #The second value is only the spectrum count while the camera is in a Spim mode
+        if mode in self.camera.STATUS_SPIM:
+            self.frame_number = int(current_spectrum)
+        self.spim_progress.update(self.frame_number, running)
+        if self.__is_chrono:
             if new_data:
                 self.has_data_event.set()
         else:
@@ -522,14 +711,12 @@ class CameraDevice(camera_base.CameraDevice):
                 self.has_spim_data_event.set()
                 print(f"spim done => frames {self.frame_number}")
         if not running:
-            hardware_source = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                self.camera_id)
-            hardware_source.stop_playing()
+            self.__stop_playing()
 
     def __spim_data_unlockerA(self, gene : int, new_data : bool, current_spectrum: c_uint64, current_spim : c_int32, running : bool):
         self.frame_number = current_spectrum
-        status = self.camera.getCCDStatus()
-        if "Chrono" in self.current_camera_settings.as_dict()['acquisition_mode']:
+        self.spim_progress.update(self.frame_number, running)
+        if self.__is_chrono:
             if new_data:
                 self.has_data_event.set()
         else:
@@ -538,9 +725,7 @@ class CameraDevice(camera_base.CameraDevice):
                 self.has_spim_data_event.set()
                 print(f"spim done => frames {self.frame_number}")
         if not running:
-            hardware_source = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                self.camera_id)
-            hardware_source.stop_playing()
+            self.__stop_playing()
 
     def __spectrum_data_locker(self, gene, data_type, sx) -> None:
         if self.__acqon and (self.current_camera_settings.exposure_ms >= 10):
@@ -551,7 +736,7 @@ class CameraDevice(camera_base.CameraDevice):
             return None
 
     def __spectrum_data_unlocker(self, gene, newdata):
-        if "Chrono" in self.current_camera_settings.as_dict()['acquisition_mode']:
+        if self.__is_chrono:
             self.has_data_event.set()
 
     @property
@@ -574,21 +759,34 @@ class CameraDevice(camera_base.CameraDevice):
     def flip(self, do_flip):
         pass
 
+    def __give_back_buffers(self):
+        # buffers of the previous acquisition go back to the pool once consumers are done with them. Only our references
+        # are dropped here. Timepix3 arrays are not from the pool and are kept
+        if self.buffer_pool.give_back(self.imagedata):
+            self.imagedata = self.imagedata_ptr = self.acquire_data = None
+        if self.buffer_pool.give_back(self.spimimagedata):
+            self.spimimagedata = self.spimimagedata_ptr = self.acquire_data = None
+
     def start_live(self) -> None:
+        self.__give_back_buffers()
         self.frame_number = 0
         self.__cumul_on = False
+        self.__is_chrono = "Chrono" in self.current_camera_settings.as_dict()['acquisition_mode']
         self.sizex, self.sizey = self.camera.getImageSize()
+        summed_rows = self.sizey
         if self.current_camera_settings.as_dict()['soft_binning']:
             self.sizey = 1
 
         if "Chrono" in self.current_camera_settings.as_dict()['acquisition_mode']:
             if self.current_camera_settings.as_dict()['acquisition_mode'] == '2D-Chrono':
                 self.sizez = self.current_camera_settings.spectra_count
-                if not self.isTimepix: self.spimimagedata = numpy.zeros((self.sizez, self.sizey, self.sizex), dtype=numpy.float32)
+                if not self.isTimepix: self.spimimagedata = self.buffer_pool.lease(
+                    (self.sizez, self.sizey, self.sizex), self.get_data_type(summed_rows // self.sizey))
             else:
                 self.sizey = self.current_camera_settings.as_dict()['spectra_count']
                 self.sizez = 1
-                if not self.isTimepix: self.spimimagedata = numpy.zeros((self.sizey, self.sizex), dtype=numpy.float32)
+                if not self.isTimepix: self.spimimagedata = self.buffer_pool.lease(
+                    (self.sizey, self.sizex), self.get_data_type(summed_rows))
             if not self.isTimepix: self.spimimagedata_ptr = self.spimimagedata.ctypes.data_as(ctypes.c_void_p)
             self.camera.stopFocus()
             if self.isTimepix:
@@ -624,8 +822,11 @@ class CameraDevice(camera_base.CameraDevice):
             if self.current_camera_settings.as_dict()['acquisition_mode'] == "Cumul":
                 acqmode = 1
                 self.__cumul_on = True
+            self.frame_accumulator.reset()
+            self.readout_calibration.start(self.current_camera_settings.as_dict())
             if not self.isTimepix:
-                self.imagedata = numpy.zeros((self.sizey, self.sizex), dtype=numpy.float32)
+                self.imagedata = self.buffer_pool.lease((self.sizey, self.sizex),
+                                                        self.get_data_type(summed_rows // self.sizey, self.__cumul_on))
                 self.imagedata_ptr = self.imagedata.ctypes.data_as(ctypes.c_void_p)
             self.__acqon = self.camera.startFocus(self.current_camera_settings.as_dict()['exposure_ms'] / 1000, sb,
                                                   acqmode)
@@ -636,6 +837,7 @@ class CameraDevice(camera_base.CameraDevice):
         self._last_time = time.time()
 
     def stop_live(self) -> None:
+        self.readout_calibration.stop()
         if self.__acqon:
             self.camera.stopFocus()
             self.__acqon = False
@@ -645,6 +847,10 @@ class CameraDevice(camera_base.CameraDevice):
             self.camera.stopSpim(True)
             self.__acqon = False
             logging.info('***CAMERA***: Spim stopped. Handling...')
+        if self.__camera_task is None:
+            #Idle, so the pinned buffers are not kept until the next acquisition
+            self.__give_back_buffers()
+            self.buffer_pool.clear()
 
     def acquire_image(self) -> dict:
         self.has_data_event.wait(1)
@@ -661,9 +867,10 @@ class CameraDevice(camera_base.CameraDevice):
                 datum_dimensions = 2
 
         elif "Event Hyperspec" in acquisition_mode:
-            self.acquire_data = self.spimimagedata
+            #Exact counts, even once histogram bins saturated
+            self.acquire_data = self.camera.create_spimimage()
             collection_dimensions = 2
-            datum_dimensions = 1
+            datum_dimensions = self.acquire_data.ndim - 2 #Raw 4D gives the binned diffraction preview
 
         else:
             self.acquire_data = self.imagedata
@@ -682,6 +889,7 @@ class CameraDevice(camera_base.CameraDevice):
 
         properties = dict()
         properties["frame_number"] = self.frame_number
+        properties["accumulated_frames"] = self.frame_accumulator.count
         properties["acquisition_mode"] = acquisition_mode
         properties["frame_parameters"] = dict(self.current_camera_settings.as_dict())
         calibration_controls = copy.deepcopy(self.calibration_controls)
@@ -700,6 +908,10 @@ class CameraDevice(camera_base.CameraDevice):
                                    scan_shape: DataAndMetadata.ShapeType,
                                    **kwargs: typing.Any) -> camera_base.PartialData:
 
+        self.__is_chrono = False
+        if self.__camera_task is not None: #The previous acquisition did not end
+            self.__camera_task.close()
+        self.__give_back_buffers()
         self.__camera_task = CameraTask(self, camera_frame_parameters, scan_shape)
         self.__camera_task.prepare()
         self.__x_pix_spim = scan_shape[1]
@@ -712,15 +924,18 @@ class CameraDevice(camera_base.CameraDevice):
     def acquire_synchronized_continue(self, *, update_period: float = 1.0,
                                       **kwargs: typing.Any) -> camera_base.PartialData:
         # assert self.__camera_task
-        is_complete, is_canceled, valid_count = self.__camera_task.grab_partial(update_period=3.0)
+        is_complete, is_canceled, valid_count = self.__camera_task.grab_partial(update_period=update_period)
         return camera_base.PartialData(self.__camera_task.xdata, is_complete, is_canceled, valid_count)
 
     def acquire_synchronized_end(self, **kwargs: typing.Any) -> None:
         self.camera.stopSpim(True)
+        if self.__camera_task is not None:
+            self.__camera_task.close()
         self.__camera_task = None
 
     def acquire_synchronized_cancel(self) -> None:
         self.__cancel_sequence_event.set()
+        self.spim_progress.wake()
 
     @property
     def _is_acquire_synchronized_running(self) -> bool:
@@ -814,20 +1029,53 @@ class CameraDevice(camera_base.CameraDevice):
         return self.camera.getReadoutTime()
 
     def get_acquire_sequence_metrics(self, camera_frame_parameters: typing.Dict) -> typing.Dict:
+        """
+        Time and memory of a sequence. The readout time is the one measured for the same port, speed, binning and
+        turbo mode, if any. Memory uses the frame size of the requested area and binning, not of the current ones, and
+        the dtype of the buffers. max_frame_count is the number of frames that fit in the available memory.
+
+        fits_in_memory is only there with psutil. Sequences for which it is False are refused by
+        acquire_sequence_prepare.
+        """
         camera_frame_parameters = camera_frame_parameters.as_dict()
+        settings = dict(self.current_camera_settings.as_dict())
+        settings.update(camera_frame_parameters)
         acquisition_frame_count = camera_frame_parameters.get("acquisition_frame_count")
         storage_frame_count = camera_frame_parameters.get("storage_frame_count")
-        frame_time = self.current_camera_settings.exposure_ms / 1000 + self.camera.getReadoutTime()
-        acquisition_time = frame_time * acquisition_frame_count
-        if camera_frame_parameters.get("processing") == "sum_project":
-            acquisition_memory = self.camera.getImageSize()[0] * 4 * acquisition_frame_count
-            storage_memory = self.camera.getImageSize()[0] * 4 * storage_frame_count
-        else:
-            acquisition_memory = self.camera.getImageSize()[0] * self.camera.getImageSize()[
-                1] * 4 * acquisition_frame_count
-            storage_memory = self.camera.getImageSize()[0] * self.camera.getImageSize()[1] * 4 * storage_frame_count
-        return {"acquisition_time": acquisition_time, "acquisition_memory": acquisition_memory,
-                "storage_memory": storage_memory}
+        readout_time, calibrated = self.readout_calibration.get_readout_time(settings, self.camera.getReadoutTime())
+        frame_time = settings["exposure_ms"] / 1000 + readout_time
+        area = settings.get("area") or (0, 0, *self.__sensor_dimensions)
+        sx = max((area[3] - area[1]) // max(int(settings.get("h_binning", 1)), 1), 1)
+        sy = max((area[2] - area[0]) // max(int(settings.get("v_binning", 1)), 1), 1)
+        summed_rows = 1
+        if settings.get("processing") == "sum_project" or settings.get("soft_binning"):
+            summed_rows, sy = sy, 1
+        frame_memory = sx * sy * numpy.dtype(self.get_data_type(summed_rows)).itemsize
+        acquisition_memory = frame_memory * acquisition_frame_count
+        storage_memory = frame_memory * storage_frame_count
+        metrics = {"acquisition_time": frame_time * acquisition_frame_count, "acquisition_memory": acquisition_memory,
+                   "storage_memory": storage_memory, "frame_time": frame_time, "readout_time": readout_time,
+                   "readout_calibrated": calibrated, "frame_memory": frame_memory}
+        if psutil is not None:
+            available_memory = psutil.virtual_memory().available
+            metrics["available_memory"] = available_memory
+            metrics["max_frame_count"] = available_memory // max(frame_memory, 1)
+            metrics["fits_in_memory"] = acquisition_memory + storage_memory < available_memory
+        return metrics
+
+    def acquire_sequence_prepare(self, n: int, **kwargs: typing.Any) -> None:
+        """
+        Called by the hardware source before a sequence of n frames, with the current frame parameters already set.
+        The frames are acquired one at a time into the sequence, so only the sequence itself is stored. MemoryError is
+        raised if it does not fit in the available memory, before anything is allocated.
+        """
+        parameters = CameraFrameParameters(dict(self.current_camera_settings.as_dict(), acquisition_frame_count=1,
+                                                storage_frame_count=n))
+        metrics = self.get_acquire_sequence_metrics(parameters)
+        if not metrics.get("fits_in_memory", True):
+            raise MemoryError(f'***CAMERA***: A sequence of {n} frames needs {metrics["storage_memory"] / 1e9:.2f} GB, '
+                              f'but only {metrics["available_memory"] / 1e9:.2f} GB are available. At most '
+                              f'{metrics["max_frame_count"]} frames fit.')
 
     def sendMessageFactory(self):
         """
@@ -858,10 +1106,16 @@ class CameraDevice(camera_base.CameraDevice):
         def sendMessage(message):
             self.frame_number = self.camera.get_frame()
             if message == 1:
-                self.current_event.fire(format(self.camera.get_current(self.imagedata, self.frame_number), ".5f"))
+                self.readout_calibration.add_frame()
+                current = self.camera.get_current(self.imagedata, self.frame_number)
+                t = time.time()
+                if t - self._last_time > CURRENT_UPDATE_PERIOD: #The panel does not need the current of every frame
+                    self._last_time = t
+                    self.current_event.fire(format(current, ".5f"))
                 self.has_data_event.set()
             elif message == 2:
                 self.spimimagedata[:] = self.camera.create_spimimage_frame()
+                self.spim_progress.update(self.frame_number)
                 self.has_spim_data_event.set()
             elif message == 3:
                 self.has_data_event.set()
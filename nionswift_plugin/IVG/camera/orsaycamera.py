@@ -72,6 +72,13 @@ class orsayCamera(object):
     Class controlling orsay camera class
     Requires Cameras.dll library to run.
     """
+    #Modes returned by getCCDStatus
+    STATUS_OFFLINE = -1
+    STATUS_IDLE = 0
+    STATUS_FOCUS = 3
+    STATUS_CUMUL = 4
+    STATUS_SPIM = (5, 6)
+
     def __initialize_library(self):
         #	void CAMERAS_EXPORT *OrsayCamerasInit(int manufacturer, const char *model, void(*logger)(const char *buf, bool debug), bool simul);
         self.__OrsayCameraInit = _buildFunction(_library.OrsayCamerasInit,
@@ -295,6 +302,10 @@ class orsayCamera(object):
 
         modelb = _toString23(model)
         self.orsaycamera = self.__OrsayCameraInit(manufacturer, modelb,  _toString23(sn), self.fnlog, simul)
+        #Status arguments are created once, so the data callbacks can read the status without allocating them
+        self.__status_mode = c_short()
+        self.__status_values = [c_double() for _ in range(4)]
+        self.__status_arguments = (byref(self.__status_mode),) + tuple(byref(value) for value in self.__status_values)
         if not self.orsaycamera:
             raise Exception ("Camera not created.")
 
@@ -714,6 +725,14 @@ class orsayCamera(object):
             status["total spectra"] = p2.value
         return status
 
+    def getCCDStatusValues(self) -> (int, float):
+        """
+        Same as getCCDStatus, but returns the mode number and the first parameter instead of a dict. This is the
+        current spectrum in spectrum imaging and the accumulation count in cumul.
+        """
+        self.__OrsayCameragetCCDStatus(self.orsaycamera, *self.__status_arguments)
+        return self.__status_mode.value, self.__status_values[0].value
+
     def getReadoutSpeed(self):
         """
         Return expected frame rate
@@ -0,0 +1,133 @@
+import logging, threading, time, typing
+
+UPDATE_PERIOD = 0.1
+TIMEOUT = 3600.0 #Acquisitions longer than this (in seconds) are canceled
+
+
+class DeviceTiming:
+    def __init__(self, name: str):
+        self.name = name
+        self.arm_time = 0.0
+        self.acquisition_time = 0.0
+        self.end_time = 0.0
+        self.first_rows_time = None
+        self.updates = 0
+        self.completed = False
+
+    @property
+    def total_time(self) -> float:
+        return self.arm_time + self.acquisition_time + self.end_time
+
+    def as_dict(self) -> dict:
+        return {"arm_time": self.arm_time, "acquisition_time": self.acquisition_time, "end_time": self.end_time,
+                "first_rows_time": self.first_rows_time, "updates": self.updates, "completed": self.completed}
+
+
+class SynchronizedAcquisition:
+    """
+    Acquires a spectrum image with several cameras against the same scan. Every camera is armed with
+    acquire_synchronized_begin, each in its own thread, and the trigger is called once all are armed. trigger starts
+    the scan that clocks the cameras, for instance the scan in external clock mode. The cameras are then read
+    concurrently with acquire_synchronized_continue until all are complete.
+
+    run returns the data of every camera by name. timings has the time spent by every camera in each step, and
+    dead_time_removed is the time saved with respect to acquiring the cameras one after the other.
+    """
+
+    def __init__(self, camera_devices: typing.Dict[str, typing.Any], scan_shape: typing.Tuple[int, int],
+                 trigger: typing.Callable[[], None], update_period: float = UPDATE_PERIOD):
+        self.camera_devices = camera_devices
+        self.scan_shape = tuple(scan_shape)
+        self.trigger = trigger
+        self.update_period = update_period
+        self.timings = {name: DeviceTiming(name) for name in camera_devices}
+        self.wall_time = 0.0
+        self.__partial_data = dict()
+        self.__armed = threading.Barrier(len(camera_devices) + 1)
+        self.__canceled = threading.Event()
+
+    @property
+    def sequential_time(self) -> float:
+        return sum(timing.total_time for timing in self.timings.values())
+
+    @property
+    def dead_time_removed(self) -> float:
+        return self.sequential_time - self.wall_time
+
+    def __acquire(self, name: str, camera_device):
+        timing = self.timings[name]
+        start = time.perf_counter()
+        try:
+            partial_data = camera_device.acquire_synchronized_begin(camera_device.current_camera_settings,
+                                                                    self.scan_shape)
+        except Exception:
+            logging.info(f'***SYNCHRONIZED***: {name} could not be armed.')
+            self.__canceled.set()
+            self.__armed.abort()
+            raise
+        timing.arm_time = time.perf_counter() - start
+        try:
+            self.__armed.wait()
+        except threading.BrokenBarrierError:
+            #Another camera could not be armed, so the scan is never started
+            camera_device.acquire_synchronized_cancel()
+            camera_device.acquire_synchronized_end()
+            return
+
+        start = time.perf_counter()
+        try:
+            while not partial_data.is_complete and not partial_data.is_canceled and not self.__canceled.is_set():
+                partial_data = camera_device.acquire_synchronized_continue(update_period=self.update_period)
+                timing.updates += 1
+                if timing.first_rows_time is None and partial_data.valid_rows:
+                    timing.first_rows_time = time.perf_counter() - start
+                if time.perf_counter() - start > TIMEOUT:
+                    logging.info(f'***SYNCHRONIZED***: {name} timed out after {TIMEOUT} s.')
+                    camera_device.acquire_synchronized_cancel()
+                    break
+        except Exception:
+            logging.info(f'***SYNCHRONIZED***: {name} failed during the acquisition.')
+            camera_device.acquire_synchronized_cancel()
+            raise
+        finally:
+            #The camera is always given back, even if reading it failed
+            timing.acquisition_time = time.perf_counter() - start
+            timing.completed = partial_data.is_complete
+            start = time.perf_counter()
+            camera_device.acquire_synchronized_end()
+            timing.end_time = time.perf_counter() - start
+        self.__partial_data[name] = partial_data
+
+    def cancel(self):
+        self.__canceled.set()
+        for camera_device in self.camera_devices.values():
+            camera_device.acquire_synchronized_cancel()
+
+    def run(self) -> typing.Dict[str, typing.Any]:
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.__acquire, args=(name, camera_device), daemon=True)
+                   for name, camera_device in self.camera_devices.items()]
+        for thread in threads:
+            thread.start()
+        try:
+            self.__armed.wait()
+            self.trigger()
+        except threading.BrokenBarrierError:
+            logging.info('***SYNCHRONIZED***: Acquisition canceled before the trigger.')
+        except Exception:
+            #The cameras are armed but the scan may not run, so they are canceled instead of waiting for TIMEOUT
+            logging.info('***SYNCHRONIZED***: The trigger failed, the acquisition is canceled.')
+            self.cancel()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            self.wall_time = time.perf_counter() - start
+        logging.info(f'***SYNCHRONIZED***: {len(threads)} cameras in {self.wall_time:.3f} s, '
+                     f'{self.dead_time_removed:.3f} s less than one after the other.')
+        return {name: partial_data.xdata for name, partial_data in self.__partial_data.items()}
+
+    def get_report(self) -> dict:
+        return {"wall_time": self.wall_time, "sequential_time": self.sequential_time,
+                "dead_time_removed": self.dead_time_removed,
+                "devices": {name: timing.as_dict() for name, timing in self.timings.items()}}
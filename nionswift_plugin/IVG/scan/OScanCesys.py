@@ -9,6 +9,7 @@ from nion.instrumentation import scan_base, stem_controller
 from nion.instrumentation import HardwareSource
 
 from nionswift_plugin.IVG.scan.OScanCesysDialog import ConfigDialog
+from nionswift_plugin.IVG.scan import sequence_buffer, scan_patterns
 from FPGAControl import FPGAConfig
 from ...aux_files import read_data
 
@@ -21,7 +22,22 @@ OPEN_SCAN_IS_VG = set_file.settings["OrsayInstrument"]["open_scan"]["IS_VG"]
 OPEN_SCAN_EFM03 = set_file.settings["OrsayInstrument"]["open_scan"]["EFM03"]
 OPEN_SCAN_BITSTREAM = set_file.settings["OrsayInstrument"]["open_scan"]["BITSTREAM_FILE"]
 DEBUG = False
-TIMEOUT_IS_SYNC = 2.0
+TIMEOUT_IS_SYNC = 2.0 #Longest wait for new pixels in a synchronized scan
+POLL_PERIOD = 0.002 #Period at which the pixel and frame counters are read while waiting for new pixels
+MIN_TRANSFER_PERIOD = 0.05 #New lines are transferred at most this often. Complete frames are transferred at once
+MAX_TRANSFER_PERIOD = 0.2 #Longest wait for new pixels in a free running scan
+VIRTUAL_CHANNEL_NAME = "TPX3_VD" #Prefix of the scan channels of the Timepix3 virtual detectors, followed by their name
+TIMEPIX3_ID = "orsay_camera_timepix3"
+
+def has_timepix3() -> bool:
+    """
+    Whether a Timepix3 is declared in Orsay_cameras_list. Its virtual detectors are only published as scan channels
+    if so.
+    """
+    cameras = read_data.FileManager('Orsay_cameras_list').settings
+    return isinstance(cameras, list) and any(isinstance(camera, dict) and camera.get("id") == TIMEPIX3_ID
+                                             for camera in cameras)
+
 
 def getlibname():
     if sys.platform.startswith('win'):
@@ -34,10 +50,14 @@ def getlibname():
 class ArgumentController:
     """
     ArgumentController stores all the arguments of the ScanDevice into a dictionary. Useful for persistent settings and control.
+    The json file is written behind by read_data.WriteBehind, so a burst of changes, like a preset switch, is saved
+    once. Values equal to the stored ones are not saved again. Changes are made under the lock of the writer.
     """
     def __init__(self, filename: str):
         self.__settings_manager = read_data.FileManager(filename)
+        self.__writer = read_data.WriteBehind(self.__settings_manager)
         self.argument_controller = self.__settings_manager.settings
+        self.unchanged = 0
 
     def get(self, keyname: str, value=None):
         #If the keyname does not exists and the value is not None, we set the value to populate the dictionary
@@ -45,19 +65,43 @@ class ArgumentController:
             self.set(keyname, value)
         return self.argument_controller.get(keyname, value)
 
+    def __is_unchanged(self, keyname: str, value) -> bool:
+        #Lists edited in place are the stored object itself, so they are always saved
+        if keyname not in self.argument_controller:
+            return False
+        stored = self.argument_controller[keyname]
+        return stored is not value and type(stored) == type(value) and stored == value
+
     def set(self, keyname: str, value):
-        self.argument_controller[keyname] = value
+        with self.__writer.lock:
+            if self.__is_unchanged(keyname, value):
+                self.unchanged += 1
+                return
+            self.argument_controller[keyname] = value
         self._write_to_json()
 
     def keys(self):
         return self.argument_controller.keys()
 
     def update(self, **kwargs):
-        self.argument_controller.update(**kwargs)
+        with self.__writer.lock:
+            changed = {key: value for key, value in kwargs.items() if not self.__is_unchanged(key, value)}
+            if not changed:
+                self.unchanged += 1
+                return
+            self.argument_controller.update(**changed)
         self._write_to_json()
 
     def _write_to_json(self):
-        self.__settings_manager.save_locally()
+        self.__writer.schedule()
+
+    def flush(self):
+        self.__writer.flush()
+
+    @property
+    def counters(self) -> dict:
+        return {"requests": self.__writer.requests + self.unchanged, "writes": self.__writer.writes,
+                "unchanged": self.unchanged, "writes_avoided": self.__writer.writes_avoided + self.unchanged}
 
 
 class ScanEngine:
@@ -81,6 +125,10 @@ class ScanEngine:
         # Settings
         self.__presetting = 0
         self.__last_frame_parameters: scan_base.ScanFrameParameters = None
+        self.__last_scan_arguments = None
+        self.__last_fov_nm = None
+        self.reconfigurations = {"fov": 0, "scan": 0, "unchanged": 0}
+        self.patterns = scan_patterns.PatternCache()
         self.__last_frame_parameters_time = time.time()
         self.__last_probe_position = (0.5, 0.5)
         self.argument_controller = ArgumentController('opscan_persistent_data_' + str(self.__presetting))
@@ -113,71 +161,92 @@ class ScanEngine:
         """
         metadata.update(self.argument_controller.argument_controller)
 
+    def get_scan_pattern(self) -> scan_patterns.ScanPattern:
+        """
+        Ordered and mask arrays of the current scan programming. They are fetched from the FPGA once per programming.
+        """
+        key = None if self.__last_scan_arguments is None else repr(self.__last_scan_arguments)
+        return self.patterns.get(key, self.device.get_ordered_array, self.device.get_mask_array)
+
     def get_ordered_array(self):
         """
         Get the last ordered array parsed as a list to the engine
         """
-        return self.device.get_ordered_array()
+        return self.get_scan_pattern().ordered
 
     def get_mask_array(self):
         """
         Get the last masked (decoded) array parsed as a list to the engine
         """
-        return self.device.get_mask_array()
+        return self.get_scan_pattern().mask
+
+    def get_scan_arguments(self, frame_parameters: scan_base.ScanFrameParameters) -> (tuple, dict):
+        """
+        Arguments of device.change_scan_parameters for frame_parameters and the current settings.
+        """
+        frame_dict = frame_parameters.as_dict()
+        (y, x) = frame_dict['pixel_size']
+        args = (x, y, frame_dict['pixel_time_us'], self.flyback_us, frame_dict.get("external_clock_mode", 0),
+                SCAN_MODES[self.rastering_mode])
+        kwargs = dict(rotation_rad=frame_dict.get('rotation_rad', 0.0),
+                      lissajous_nx=self.lissajous_nx,
+                      lissajous_ratio=self.lissajous_ratio,
+                      lissajous_phase=self.lissajous_phase,
+                      subimages=self.mini_scan,
+                      adc_acquisition_mode=self.adc_acquisition_mode,
+                      adc_acquisition_mode_name=ADC_READOUT_MODES[self.adc_acquisition_mode],
+                      kernelMode=KERNEL_LIST[self.kernel_mode],
+                      givenPixel=self.given_pixel,
+                      dutyCycle=self.duty_cycle,
+                      acquisitionCutoff=self.acquisition_cutoff,
+                      acquisitionWindow=self.acquisition_window,
+                      subscan_fractional_size=frame_dict.get('subscan_fractional_size'),
+                      subscan_fractional_center=frame_dict.get('subscan_fractional_center'),
+                      subscan_pixel_size=frame_dict.get('subscan_pixel_size'))
+        return args, kwargs
 
     def set_frame_parameters(self, frame_parameters: scan_base.ScanFrameParameters):
         """
-        Sets the frame parameters of the scan. The frame_parameters must be different in order to this to be taken into account.
+        Sets the frame parameters of the scan. Only what changed is sent to the FPGA. A new field of view only changes
+        the magnification, and settings with their own setter, like the multiplexers, are already sent by it. The scan
+        is reprogrammed only if an argument of change_scan_parameters changed.
         """
-        is_synchronized_scan = frame_parameters.get_parameter("external_clock_mode", 0)
-        (y, x) = frame_parameters.as_dict()['pixel_size']
-        pixel_time = frame_parameters.as_dict()['pixel_time_us']
-        fov_nm = frame_parameters.as_dict()['fov_nm']
-        rotation_rad = frame_parameters.as_dict().get('rotation_rad', 0.0)
-        subscan_fractional_size = frame_parameters.as_dict().get('subscan_fractional_size')
-        subscan_fractional_center = frame_parameters.as_dict().get('subscan_fractional_center')
-        subscan_pixel_size = frame_parameters.as_dict().get('subscan_pixel_size')
+        fov_nm = frame_parameters.fov_nm
 
         # Setting the field of view. This does not need to change the list
-        if self.__last_frame_parameters is None or fov_nm != self.__last_frame_parameters.as_dict()['fov_nm']:
+        if self.__last_fov_nm is None or fov_nm != self.__last_fov_nm:
             self.set_field_of_view(fov_nm)
-            if self.__last_frame_parameters is not None: self.__last_frame_parameters.set_parameter('fov_nm', fov_nm)
+            self.__last_fov_nm = fov_nm
+            self.reconfigurations["fov"] += 1
 
-        # Setting the values in the frame parameters to be compared in the next step
+        # Setting the values in the frame parameters so they are in the metadata
         for (key, value) in self.argument_controller.argument_controller.items():
             frame_parameters.set_parameter(key, value)
 
-        if self.__last_frame_parameters is None or frame_parameters.as_dict() != self.__last_frame_parameters.as_dict():
-            self.device.change_scan_parameters(x, y, pixel_time, self.flyback_us, is_synchronized_scan,
-                                               SCAN_MODES[self.rastering_mode],
-                                               rotation_rad=rotation_rad,
-                                               lissajous_nx=self.lissajous_nx,
-                                               lissajous_ratio=self.lissajous_ratio,
-                                               lissajous_phase=self.lissajous_phase,
-                                               subimages=self.mini_scan,
-                                               adc_acquisition_mode=self.adc_acquisition_mode,
-                                               adc_acquisition_mode_name=ADC_READOUT_MODES[self.adc_acquisition_mode],
-                                               kernelMode=KERNEL_LIST[self.kernel_mode],
-                                               givenPixel=self.given_pixel,
-                                               dutyCycle=self.duty_cycle,
-                                               acquisitionCutoff=self.acquisition_cutoff,
-                                               acquisitionWindow=self.acquisition_window,
-                                               subscan_fractional_size=subscan_fractional_size,
-                                               subscan_fractional_center=subscan_fractional_center,
-                                               subscan_pixel_size=subscan_pixel_size
-                                               )
+        scan_arguments = self.get_scan_arguments(frame_parameters)
+        if self.__last_frame_parameters is None or scan_arguments != self.__last_scan_arguments:
+            args, kwargs = scan_arguments
+            self.device.change_scan_parameters(*args, **kwargs)
+            self.__last_scan_arguments = scan_arguments
+            #The FPGA made new ordered and mask arrays
+            self.patterns.invalidate(repr(scan_arguments))
+            self.reconfigurations["scan"] += 1
+        else:
+            self.reconfigurations["unchanged"] += 1
 
         self.__last_frame_parameters_time = time.time()
         self.__last_frame_parameters = frame_parameters
 
-    def _update_frame_parameter(self):
+    def _update_frame_parameter(self, reprogram: bool = False):
         """
-        Try to updates the frame_parameter. The self.__last_frame_parameter is copied but its updated with all the values on ArgumentController.
-        If any of them change, they trigger a scan frame parameter change
+        Sends the settings of the ArgumentController with the last frame parameters. Only a change in the scan
+        arguments reprograms the scan, so the frame parameters are not copied. reprogram is for settings that are not
+        scan arguments but still need change_scan_parameters, and forces it.
         """
-        updated_frame_parameter = copy.deepcopy(self.__last_frame_parameters)
         if self.__last_frame_parameters is not None:
-            self.set_frame_parameters(updated_frame_parameter)
+            if reprogram:
+                self.__last_scan_arguments = None
+            self.set_frame_parameters(self.__last_frame_parameters)
 
     def set_field_of_view(self, fov: float):
         """
@@ -200,9 +269,7 @@ class ScanEngine:
             self.device.set_probe_position(x, y)
             #This will force the next frame to be taken place
             self.__last_frame_parameters = None
-
-    def get_mask_array(self):
-        return self.device.get_mask_array()
+            self.__last_fov_nm = None
 
     @property
     def pre_settings(self):
@@ -224,6 +291,7 @@ class ScanEngine:
         self.__presetting = value
 
         old_argument_controller = self.argument_controller
+        old_argument_controller.flush()
         self.argument_controller = ArgumentController('opscan_persistent_data_' + str(self.__presetting))
 
         for (key, values) in old_argument_controller.argument_controller.items():
@@ -312,10 +380,11 @@ class ScanEngine:
         self.device.change_video_parameters(video_delay=self.video_delay)
         self.property_changed_event.fire("video_phase")
         if self.debug_io:
-            self._update_frame_parameter()
+            #The emulated scan is programmed again to use the new delay, which is not a scan argument
+            self._update_frame_parameter(reprogram=True)
         # If timepix3 is present, we should try to set the metadata of this value
         cam = HardwareSource.HardwareSourceManager() \
-            .get_hardware_source_for_hardware_source_id("orsay_camera_timepix3")
+            .get_hardware_source_for_hardware_source_id(TIMEPIX3_ID)
         if cam is not None:
             cam.camera.camera.set_video_delay(value)
 
@@ -967,6 +1036,7 @@ class Frame:
         self.frame_parameters = frame_parameters
         self.complete = False
         self.bad = False
+        self.properties = None
 
 
 class Device(scan_base.ScanDevice):
@@ -982,16 +1052,18 @@ class Device(scan_base.ScanDevice):
         self.__is_scanning = False
         self.on_device_state_changed = None
         self.flyback_pixels = 2
-        self.__buffer = list()
-        self.__sequence_buffer_size = 0
-        self.__view_buffer_size = 20
+        self.__buffer = sequence_buffer.SequenceBuffer()
+        self.__transferred_pixels = None
+        self.__transfer_time = 0.0
+        self.transfer_counters = {"transfers": 0, "skipped": 0, "bytes": 0}
         self.bottom_blanker = 0
         self.scan_engine = ScanEngine()
 
         self.has_data_event = threading.Event()
 
     def close(self):
-        pass
+        self.scan_engine.argument_controller.flush()
+        logging.info(f'***OScan***: Settings writes {self.scan_engine.argument_controller.counters}.')
 
     def stop(self) -> None:
         """Stop acquiring."""
@@ -1010,9 +1082,39 @@ class Device(scan_base.ScanDevice):
             self.__is_scanning = False
 
     def __get_channels(self) -> typing.List[Channel]:
+        """
+        Scan channels, followed by one channel per virtual detector of the Timepix3. They are named after the detectors
+        configured in its engine, or after the default ones if the camera is not registered yet. Channels are fixed
+        once the device is created, so detectors added later are not published.
+        """
         channels = [Channel(0, "ListScan", False), Channel(1, "BF", False), Channel(2, "ADF", True)]
+        if has_timepix3():
+            from nionswift_plugin.IVG.tp3 import tp3virtual
+            engine = self.__get_virtual_detector_engine() or tp3virtual.VirtualDetectorEngine()
+            for name in engine.names:
+                channels.append(Channel(len(channels), VIRTUAL_CHANNEL_NAME + "_" + name, False))
         return channels
 
+    def __get_virtual_detector_engine(self):
+        cam = HardwareSource.HardwareSourceManager() \
+            .get_hardware_source_for_hardware_source_id(TIMEPIX3_ID)
+        if cam is None:
+            return None
+        return cam.camera.camera.virtual_detectors
+
+    def __get_virtual_detector_image(self, channel: Channel):
+        """
+        Image of the Timepix3 virtual detector named by this channel, and its name.
+        """
+        engine = self.__get_virtual_detector_engine()
+        name = channel.name[len(VIRTUAL_CHANNEL_NAME) + 1:]
+        if engine is None or engine.store is None or name not in engine.names:
+            return None, None
+        try:
+            return engine.get_image(name), name
+        except ValueError: #Removed meanwhile
+            return None, None
+
     # def __get_initial_profiles(self) -> typing.List[scan_base.ScanFrameParameters]:
     #     profiles = list()
     #     profiles.append(scan_base.ScanFrameParameters(
@@ -1044,7 +1146,7 @@ class Device(scan_base.ScanDevice):
     def start_frame(self, is_continuous: bool) -> int:
         """Start acquiring. Return the frame number."""
         if not self.__is_scanning:
-            self.__buffer = list()
+            self.__buffer.clear()
             self.__start_next_frame()
             self.__is_scanning = True
         return self.__frame_number
@@ -1061,6 +1163,32 @@ class Device(scan_base.ScanDevice):
         self.__frame_number = self.scan_engine.device.get_frame_counter()
         self.__start_frame = self.__frame_number
         self.__frame = Frame(self.__frame_number, channels, frame_parameters)
+        self.__transferred_pixels = None
+
+    def __wait_for_new_pixels(self, is_synchronized_scan: bool, pixels_read: int,
+                              line_length: int) -> (int, bool, bool):
+        """
+        Reads the pixel and frame counters until a line after pixels_read is acquired or the frame is complete, instead
+        of sleeping a fixed time. New lines are reported MIN_TRANSFER_PERIOD after the last transfer. Waits at most
+        TIMEOUT_IS_SYNC in a synchronized scan and MAX_TRANSFER_PERIOD otherwise. Returns the pixel counter, whether the
+        frame is complete and whether there are new lines.
+        """
+        device = self.scan_engine.device
+        deadline = time.perf_counter() + (TIMEOUT_IS_SYNC if is_synchronized_scan else MAX_TRANSFER_PERIOD)
+        while True:
+            pixels = device.get_pixel_counter()
+            if is_synchronized_scan:
+                complete = device.get_dma_status_idle()[0] == 2
+            else:
+                self.__frame_number = device.get_frame_counter()
+                complete = self.__frame_number != self.__start_frame
+            new_lines = pixels_read is None or (pixels // line_length != pixels_read // line_length and
+                                                time.perf_counter() - self.__transfer_time > MIN_TRANSFER_PERIOD)
+            if complete or new_lines:
+                return pixels, complete, True
+            if time.perf_counter() > deadline:
+                return pixels, complete, False
+            time.sleep(POLL_PERIOD)
 
     def read_partial(self, frame_number, pixels_to_skip) -> (typing.Sequence[dict], bool, bool, tuple, int, int):
         """Read or continue reading a frame.
@@ -1084,18 +1212,25 @@ class Device(scan_base.ScanDevice):
         # frame_number = current_frame.frame_number
         self.__frame_number = self.scan_engine.device.get_frame_counter()
         is_synchronized_scan = current_frame.frame_parameters.get_parameter("external_clock_mode", 0) != 0
-        if is_synchronized_scan:
-            time.sleep(TIMEOUT_IS_SYNC)
-            current_frame.complete = self.scan_engine.device.get_dma_status_idle()[0] == 2
-            if current_frame.complete:
-                sub_area = ((0, 0), self.get_current_image_size(current_frame.frame_parameters))
-            else:
-                (x, y) = self.get_current_image_size(current_frame.frame_parameters)
-                lines = self.scan_engine.device.get_pixel_counter() // y
-                sub_area = ((0, 0), (lines, y))
+        (x, y) = self.get_current_image_size(current_frame.frame_parameters)
+        pixels_read = self.__transferred_pixels
+        if is_synchronized_scan and pixels_read is not None:
+            pixels_read = max(pixels_read, pixels_to_skip)
+        pixels, current_frame.complete, new_lines = self.__wait_for_new_pixels(is_synchronized_scan, pixels_read, y)
+        if current_frame.complete or not is_synchronized_scan:
+            sub_area = ((0, 0), (x, y))
+        else:
+            lines = pixels // y
+            sub_area = ((0, 0), (lines, y))
+            pixels_to_skip = lines * y
+        #Images are transferred only when there are new lines, in free running scans as well
+        transfer = new_lines
+        if transfer:
+            self.__transferred_pixels = pixels
+            self.__transfer_time = time.perf_counter()
+            self.transfer_counters["transfers"] += 1
         else:
-            current_frame.complete = self.__frame_number != self.__start_frame
-            sub_area = ((0, 0), self.get_current_image_size(current_frame.frame_parameters))
+            self.transfer_counters["skipped"] += 1
 
         if DEBUG:
             print(
@@ -1105,35 +1240,41 @@ class Device(scan_base.ScanDevice):
 
         data_elements = list()
 
+        #Properties shared by every channel and every read of the frame
+        if current_frame.properties is None:
+            current_frame.properties = current_frame.frame_parameters.as_dict()
+            current_frame.properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
+            current_frame.properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
+            current_frame.properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
+            if is_synchronized_scan:
+                current_frame.properties["scan_pattern"] = self.scan_engine.get_scan_pattern().reference
+        #Properties from scan_engine that must be updated in a frame_base
+        self.scan_engine.update_metadata_to_dict(current_frame.properties)
+
         for channel in current_frame.channels:
             data_element = dict()
-            data_array = self.scan_engine.receive_total_frame(channel.channel_id)
+            if channel.name.startswith(VIRTUAL_CHANNEL_NAME):
+                data_array, detector_name = self.__get_virtual_detector_image(channel)
+            elif transfer:
+                data_array = channel.data = self.scan_engine.receive_total_frame(channel.channel_id)
+                self.transfer_counters["bytes"] += data_array.nbytes if data_array is not None else 0
+            else:
+                data_array = channel.data
             data_element["data"] = data_array
-            properties = current_frame.frame_parameters.as_dict()
-            properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
-            if is_synchronized_scan:
-                properties["decode_list"] = self.scan_engine.get_mask_array().tolist()
-            properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
-            properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
-            properties["channel_id"] = channel.channel_id
-
-            #Properties from scan_engine that must be updated in a frame_base
-            self.scan_engine.update_metadata_to_dict(properties)
-
+            properties = dict(current_frame.properties, channel_id=channel.channel_id)
+            if channel.name.startswith(VIRTUAL_CHANNEL_NAME):
+                properties["virtual_detector"] = detector_name
             data_element["properties"] = properties
             if data_array is not None:
                 data_elements.append(data_element)
 
         if current_frame.complete:
-            if len(self.__buffer) > 0 and len(self.__buffer[-1]) != len(data_elements):
-                self.__buffer = list()
-            self.__buffer.append(data_elements)
-            while len(self.__buffer) > self.__sequence_buffer_size + self.__view_buffer_size:
-                del self.__buffer[self.__sequence_buffer_size]
+            self.__buffer.push(data_elements)
             self.__frame = None
 
         # return data_elements, complete, bad_frame, sub_area, frame_number, pixels_to_skip
-        return data_elements, current_frame.complete, False, sub_area, self.__frame_number, 0
+        return data_elements, current_frame.complete, False, sub_area, self.__frame_number, \
+               0 if current_frame.complete else pixels_to_skip
 
     # This one is called in scan_base
     def prepare_synchronized_scan(self, scan_frame_parameters: scan_base.ScanFrameParameters, *, camera_exposure_ms,
@@ -1142,23 +1283,16 @@ class Device(scan_base.ScanDevice):
         scan_frame_parameters.set_parameter("external_clock_mode", 1)
 
     def set_sequence_buffer_size(self, buffer_size: int) -> None:
-        self.__sequence_buffer_size = buffer_size
-        self.__buffer = list()
+        self.__buffer.clear(buffer_size)
 
     def get_sequence_buffer_count(self) -> int:
         return len(self.__buffer)
 
     def pop_sequence_buffer_data(self) -> typing.List[typing.Dict[str, typing.Any]]:
-        self.__sequence_buffer_size -= 1
-        return self.__buffer.pop(0)
+        return self.__buffer.pop()
 
     def get_buffer_data(self, start: int, count: int) -> typing.List[typing.List[typing.Dict[str, typing.Any]]]:
-        # print(f"get {start=} {count=} {len(self.__buffer)=}")
-        # time.sleep(0.1)
-        if start < 0:
-            return self.__buffer[start: start + count if count < -start else None]
-        else:
-            return self.__buffer[start: start + count]
+        return self.__buffer.get_buffer_data(start, count)
 
     def calculate_flyback_pixels(self, frame_parameters: scan_base.ScanFrameParameters) -> int:
         return 0
@@ -11,6 +11,7 @@ from nion.swift.model import HardwareSource
 from nionswift_plugin.IVG.scan.orsayscan import orsayScan, LOCKERFUNC, UNLOCKERFUNCA
 from nionswift_plugin.IVG.scan.ConfigVGLumDialog import ConfigDialog
 from nionswift_plugin.IVG import ivg_inst
+from nionswift_plugin.IVG.scan import sequence_buffer
 from ...aux_files import read_data
 
 _ = gettext.gettext
@@ -107,6 +108,7 @@ class Frame:
         self.data_count = 0
         self.start_time = time.time()
         self.scan_data = None
+        self.properties = None
 
 class Device(scan_base.ScanDevice):
     def __init__(self, instrument):
@@ -128,11 +130,9 @@ class Device(scan_base.ScanDevice):
         self.__profiles = self.__get_initial_profiles()
         self.__frame_parameters = copy.deepcopy(self.__profiles[0])
         self.flyback_pixels = 2
-        self.__buffer = list()
-        self.__sequence_buffer_size = 0
+        self.__buffer = sequence_buffer.SequenceBuffer()
         self.__timeout = 0.25
         self.__last_time = time.time()
-        self.__view_buffer_size = 20
         self.bottom_blanker = 0
 
         self.orsayscan = orsayScan(1, vg=bool(ORSAY_SCAN_IS_VG), efm03=bool(ORSAY_SCAN_EFM03))
@@ -320,8 +320,9 @@ class Device(scan_base.ScanDevice):
         if channel_type == "TPX3":
             self.__tpx3_spim = self.__tpx3_camera.camera.camera.StartSpimFromScan()
             if self.__tpx3_spim: #True if successful
-                self.__tpx3_calib["dispersion"] = self.__instrument.TryGetVal("EELS_TV_eVperpixel")[1]
-                self.__tpx3_calib["offset"] = self.__instrument.TryGetVal("ZLPtare")[1]
+                self.__tpx3_calib["dispersion"], self.__tpx3_calib["offset"] = \
+                    self.__tpx3_camera.camera.camera.get_energy_calibration(
+                        self.__instrument.TryGetVal("EELS_TV_eVperpixel")[1], self.__instrument.TryGetVal("ZLPtare")[1])
                 self.__tpx3_camera.camera.camera._TimePix3__isReady.wait(5.0)
                 self.__tpx3_data = self.__tpx3_camera.camera.camera.create_spimimage() #Getting the reference
                 time.sleep(0.5) #Timepix has already a socket connected. Wait until it is definitely reading data
@@ -348,7 +349,7 @@ class Device(scan_base.ScanDevice):
     def start_frame(self, is_continuous: bool) -> int:
         """Start acquiring. Return the frame number."""
         if not self.__is_scanning:
-            self.__buffer = list()
+            self.__buffer.clear()
             self.__start_next_frame()
 
             logging.info(f"***SCAN***: Starting acquisition. Spim is {self.__spim}")
@@ -452,21 +453,29 @@ class Device(scan_base.ScanDevice):
             offsetx = [0, scan_area[1]]
 
 
+        #Properties shared by every channel and every read of the frame
+        if current_frame.properties is None:
+            current_frame.properties = current_frame.frame_parameters.as_dict()
+            current_frame.properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
+            current_frame.properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
+            current_frame.properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
+
         for channel in current_frame.channels:
             data_element = dict()
 
             #Timepix3 Spim channel
             if channel.name == 'TPX3':
                 #if self.__frame_number % 10 == 0:
-                data_array = self.__tpx3_data
+                #Read at every frame, as the cube holds the exact counts in a new array once histogram bins saturate
+                data_array = None if self.__tpx3_data is None else self.__tpx3_camera.camera.camera.create_spimimage()
                 data_element["data"] = data_array
-                properties = current_frame.frame_parameters.as_dict()
-                properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
-                properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
-                properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
-                properties["channel_id"] = channel.channel_id
+                properties = dict(current_frame.properties, channel_id=channel.channel_id)
                 properties["eels_dispersion"] = self.__tpx3_calib["dispersion"]
                 properties["eels_offset"] = self.__tpx3_calib["offset"]
+                #Events the stream had to drop while the decoder was behind. They are missing from the cube
+                stream_counters = self.__tpx3_camera.camera.camera.stream_counters
+                properties["tpx3_dropped_buffers"] = stream_counters["dropped_buffers"]
+                properties["tpx3_dropped_bytes"] = stream_counters["dropped_bytes"]
                 data_element["properties"] = properties
                 if data_array is not None:
                     data_elements.append(data_element)
@@ -475,11 +484,7 @@ class Device(scan_base.ScanDevice):
                 #if self.__frame_number % 10 == 0:
                 data_array = self.__tpx3_data
                 data_element["data"] = data_array
-                properties = current_frame.frame_parameters.as_dict()
-                properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
-                properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
-                properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
-                properties["channel_id"] = channel.channel_id
+                properties = dict(current_frame.properties, channel_id=channel.channel_id)
                 properties["eels_dispersion"] = self.__tpx3_calib["dispersion"]
                 properties["eels_offset"] = self.__tpx3_calib["offset"]
                 data_element["properties"] = properties
@@ -487,15 +492,12 @@ class Device(scan_base.ScanDevice):
                     data_elements.append(data_element)
             else:
                 data_array = self.imagedata[channel.channel_id * sxy: (channel.channel_id + 1) * sxy]
-                data_array = data_array.reshape(scan_area[1], scan_area[0]).astype('float32')
-                data_array = data_array[offsetx[0]:offsetx[1], offsety[0]:offsety[1]]
+                #Cropped before the copy, so a buffered frame only holds the subscan
+                data_array = data_array.reshape(scan_area[1], scan_area[0])
+                data_array = data_array[offsetx[0]:offsetx[1], offsety[0]:offsety[1]].astype('float32')
                 data_element["data"] = data_array
-                properties = current_frame.frame_parameters.as_dict()
+                properties = dict(current_frame.properties, channel_id=channel.channel_id)
                 properties['sub_area'] = ((0, 0), data_array.shape)
-                properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
-                properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
-                properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
-                properties["channel_id"] = channel.channel_id
                 data_element["properties"] = properties
                 if data_array is not None:
                     data_elements.append(data_element)
@@ -504,11 +506,7 @@ class Device(scan_base.ScanDevice):
         self.has_data_event.clear()
 
         if current_frame.complete:
-            if len(self.__buffer) > 0 and len(self.__buffer[-1]) != len(data_elements):
-                self.__buffer = list()
-            self.__buffer.append(data_elements)
-            while len(self.__buffer) > self.__sequence_buffer_size + self.__view_buffer_size:
-                del self.__buffer[self.__sequence_buffer_size]
+            self.__buffer.push(data_elements)
         self.__frame = None
 
         #Stop by using the number of frames
@@ -525,23 +523,16 @@ class Device(scan_base.ScanDevice):
         scan_frame_parameters.set_parameter("external_clock_mode", 1)
 
     def set_sequence_buffer_size(self, buffer_size: int) -> None:
-        self.__sequence_buffer_size = buffer_size
-        self.__buffer = list()
+        self.__buffer.clear(buffer_size)
 
     def get_sequence_buffer_count(self) -> int:
         return len(self.__buffer)
 
     def pop_sequence_buffer_data(self) -> typing.List[typing.Dict[str, typing.Any]]:
-        self.__sequence_buffer_size -= 1
-        return self.__buffer.pop(0)
+        return self.__buffer.pop()
 
     def get_buffer_data(self, start: int, count: int) -> typing.List[typing.List[typing.Dict[str, typing.Any]]]:
-        # print(f"get {start=} {count=} {len(self.__buffer)=}")
-        # time.sleep(0.1)
-        if start < 0:
-            return self.__buffer[start: start + count if count < -start else None]
-        else:
-            return self.__buffer[start: start + count]
+        return self.__buffer.get_buffer_data(start, count)
 
     def calculate_flyback_pixels(self, frame_parameters: scan_base.ScanFrameParameters) -> int:
         return 0
@@ -0,0 +1,203 @@
+import collections, hashlib, logging, os, sys, numpy
+
+from ...aux_files import read_data
+
+if sys.platform.startswith('win'):
+    DEFAULT_PATTERN_FOLDER = 'C:\\ProgramData\\Microscope\\scan_patterns'
+else:
+    DEFAULT_PATTERN_FOLDER = '/srv/data/scan_patterns'
+SETTINGS_SECTION = "memory" #Section of global_settings with SCAN_PATTERN_PATH
+MAXIMUM_PATTERNS = 8 #Scan patterns kept by the cache, least recently used are dropped first
+MAXIMUM_EMBEDDED_PIXELS = 128 * 128 #Masks up to this size are kept in the metadata instead of a file
+FOLDER_BUDGET = 1 << 30 #Default size (in bytes) of the saved masks. The least recently used are removed beyond it
+
+
+def get_pattern_folder() -> str:
+    """
+    Folder of the saved masks, SCAN_PATTERN_PATH of global_settings if set.
+    """
+    return os.path.abspath(read_data.get_global_setting(SETTINGS_SECTION, "SCAN_PATTERN_PATH", "")
+                           or DEFAULT_PATTERN_FOLDER)
+
+
+def get_folder_budget() -> int:
+    """
+    Size (in bytes) of the saved masks, SCAN_PATTERN_BUDGET_GB of global_settings if set.
+    """
+    budget = read_data.get_global_setting(SETTINGS_SECTION, "SCAN_PATTERN_BUDGET_GB", None)
+    return FOLDER_BUDGET if budget is None else int(float(budget) * (1 << 30))
+
+
+def clean_folder(folder: str, budget: int, keep: str = None) -> int:
+    """
+    Removes the least recently used masks of folder until they take at most budget bytes. keep is never removed.
+    Returns the number of masks removed.
+    """
+    entries = list()
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.npy') and entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        logging.info(f'***SCAN PATTERN***: Removed {removed} scan patterns from {folder}.')
+    return removed
+
+
+def compact(array) -> numpy.ndarray:
+    """
+    Flat read-only copy of array in uint32, or int64 if the values do not fit.
+    """
+    array = numpy.asarray(array).reshape(-1)
+    dtype = numpy.uint32
+    if array.size and (array.min() < 0 or array.max() > numpy.iinfo(numpy.uint32).max):
+        dtype = numpy.int64
+    compacted = numpy.array(array, dtype=dtype)
+    compacted.flags.writeable = False
+    return compacted
+
+
+def load_mask(reference: dict) -> numpy.ndarray:
+    """
+    Mask array of the scan_pattern metadata entry, embedded in it if it could not be saved.
+    """
+    if "mask" in reference:
+        return numpy.array(reference["mask"], dtype=reference.get("dtype"))
+    return numpy.load(reference["file"])
+
+
+class ScanPattern:
+    """
+    Ordered and mask arrays of one programming of the scan, fetched from the FPGA on first use and kept in compact
+    form. The mask is the decode array, mask[i] being the acquisition index of the scan pixel i.
+
+    Metadata refers to the pattern with reference. Masks of up to MAXIMUM_EMBEDDED_PIXELS pixels are held by the
+    reference. Larger ones are saved once in folder, named after a hash of their content, so a pattern used again is
+    not saved twice. Random patterns are new at every scan, so the least recently used masks are removed once the
+    folder is above budget, and older data can refer to a removed file. If the mask cannot be saved, the reference
+    holds it instead.
+    """
+
+    def __init__(self, key, fetch_ordered, fetch_mask, folder: str = None, budget: int = None):
+        self.key = key
+        self.folder = get_pattern_folder() if folder is None else folder
+        self.budget = get_folder_budget() if budget is None else budget
+        self.__fetch_ordered = fetch_ordered
+        self.__fetch_mask = fetch_mask
+        self.__ordered = None
+        self.__mask = None
+        self.__orders = dict()
+        self.__decodes = dict()
+        self.__pattern_id = None
+        self.__saved = None #True once saved, False if saving failed
+
+    @property
+    def ordered(self) -> numpy.ndarray:
+        if self.__ordered is None:
+            self.__ordered = compact(self.__fetch_ordered())
+        return self.__ordered
+
+    @property
+    def mask(self) -> numpy.ndarray:
+        if self.__mask is None:
+            self.__mask = compact(self.__fetch_mask())
+        return self.__mask
+
+    @property
+    def pattern_id(self) -> str:
+        if self.__pattern_id is None:
+            self.__pattern_id = hashlib.sha1(self.mask.tobytes()).hexdigest()[:16]
+        return self.__pattern_id
+
+    def get_camera_decode(self, count: int = None) -> numpy.ndarray:
+        """
+        Acquisition index of the camera spectrum of every scan pixel, for the first count pixels. Camera spectra are one
+        pixel behind the mask, so this is (mask - 1) % count, as SpectrumReordering decodes camera data.
+        """
+        count = self.mask.size if count is None else min(count, self.mask.size)
+        if count not in self.__decodes:
+            decode = (self.mask[:count].astype(numpy.int64) - 1) % count
+            decode.flags.writeable = False
+            self.__decodes[count] = decode
+        return self.__decodes[count]
+
+    def get_order(self, count: int = None) -> numpy.ndarray:
+        """
+        Scan pixels sorted by the acquisition index of their camera spectrum, for the first count pixels. For a
+        permutation, this is the inverse of get_camera_decode.
+        """
+        count = self.mask.size if count is None else min(count, self.mask.size)
+        if count not in self.__orders:
+            order = numpy.argsort(self.get_camera_decode(count), kind='stable')
+            order.flags.writeable = False
+            self.__orders[count] = order
+        return self.__orders[count]
+
+    @property
+    def reference(self) -> dict:
+        path = os.path.join(self.folder, self.pattern_id + '.npy')
+        if self.__saved is None:
+            self.__saved = self.mask.size > MAXIMUM_EMBEDDED_PIXELS and self.__save(path)
+        reference = {"pattern_id": self.pattern_id, "size": int(self.mask.size), "dtype": str(self.mask.dtype)}
+        if self.__saved:
+            reference["file"] = path
+        else:
+            reference["mask"] = self.mask.tolist()
+        return reference
+
+    def __save(self, path: str) -> bool:
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            if os.path.exists(path):
+                os.utime(path) #Used again, so it is the last one removed
+            else:
+                numpy.save(path, self.mask)
+                clean_folder(self.folder, self.budget, keep=path)
+            return True
+        except OSError:
+            logging.info(f'***SCAN PATTERN***: Could not save the scan pattern at {path}. The mask is kept in the '
+                         f'metadata instead.')
+            return False
+
+
+class PatternCache:
+    """
+    Scan patterns by scan geometry and pattern parameters, the key. The FPGA creates the arrays again every time the
+    scan is programmed, and random patterns change, so invalidate must be called with the key whenever it is.
+    """
+
+    def __init__(self, maximum: int = MAXIMUM_PATTERNS, folder: str = None, budget: int = None):
+        self.maximum = maximum
+        self.folder = get_pattern_folder() if folder is None else folder
+        self.budget = get_folder_budget() if budget is None else budget
+        self.hits = 0
+        self.misses = 0
+        self.__patterns = collections.OrderedDict()
+
+    def invalidate(self, key):
+        self.__patterns.pop(key, None)
+
+    def get(self, key, fetch_ordered, fetch_mask) -> ScanPattern:
+        if key is not None and key in self.__patterns:
+            self.hits += 1
+            self.__patterns.move_to_end(key)
+            return self.__patterns[key]
+        self.misses += 1
+        pattern = ScanPattern(key, fetch_ordered, fetch_mask, self.folder, self.budget)
+        if key is not None:
+            self.__patterns[key] = pattern
+            while len(self.__patterns) > self.maximum:
+                self.__patterns.popitem(last=False)
+        return pattern
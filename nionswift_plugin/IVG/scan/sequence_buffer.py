@@ -0,0 +1,58 @@
+import collections, typing
+
+VIEW_BUFFER_SIZE = 20 #Most recent frames kept for the view, after the frames of the sequence
+
+
+class SequenceBuffer:
+    """
+    Completed frames of a scan device, as lists of data elements. The first sequence_size frames are kept for the
+    sequence acquisition until they are popped. Later frames go to a ring of the view_size most recent ones, so memory
+    is bounded however long the device scans. Pushing and popping take constant time, and get_buffer_data returns the
+    stored data elements themselves, without copying their arrays.
+
+    The indices of get_buffer_data are those of the frames in order, sequence frames first, negative ones counting
+    from the most recent frame.
+    """
+
+    def __init__(self, view_size: int = VIEW_BUFFER_SIZE):
+        self.view_size = view_size
+        self.sequence_size = 0
+        self.__sequence = collections.deque()
+        self.__view = collections.deque(maxlen=view_size)
+
+    def __len__(self) -> int:
+        return len(self.__sequence) + len(self.__view)
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += len(self)
+        if index < len(self.__sequence):
+            return self.__sequence[index]
+        return self.__view[index - len(self.__sequence)]
+
+    def clear(self, sequence_size: int = None):
+        if sequence_size is not None:
+            self.sequence_size = sequence_size
+        self.__sequence.clear()
+        self.__view.clear()
+
+    def push(self, data_elements: typing.List[dict]):
+        #A change in the enabled channels starts over
+        if len(self) > 0 and len(self[-1]) != len(data_elements):
+            self.clear()
+        if len(self.__sequence) < self.sequence_size:
+            self.__sequence.append(data_elements)
+        else:
+            self.__view.append(data_elements)
+
+    def pop(self) -> typing.List[dict]:
+        self.sequence_size = max(self.sequence_size - 1, 0)
+        if self.__sequence:
+            return self.__sequence.popleft()
+        return self.__view.popleft()
+
+    def get_buffer_data(self, start: int, count: int) -> typing.List[typing.List[dict]]:
+        length = len(self)
+        if start < 0:
+            start = max(start + length, 0)
+        return [self[index] for index in range(start, min(start + count, length))]
@@ -0,0 +1,348 @@
+"""
+Local stand-in for Serval and for the TCP stream that TimePix3 listens to.
+
+The REST side answers the endpoints used by tp3func (/, /dashboard, /detector/config, /server/destination,
+/measurement/start, /measurement/stop and /config/load). The stream side accepts any number of clients on
+tp3func.PORT, reads the configuration bytes sent by TimePix3._prepare_for_acquisition and streams data in the format of
+the requested mode: jsonimage frames for FRAME-like modes, pixel-by-pixel jsonimage for HYPERSPEC_FRAME_BASED, event
+indices for the EVENT modes and 16 bit masked frames for FRAME_4DMASKED.
+
+To run the whole client against it, create TimePix3('http://127.0.0.1:8080', False, message) while the simulator runs,
+or start it from a terminal with:
+
+python -m nionswift_plugin.IVG.tp3.tp3_vi --event-rate 1e8 --frame-rate 200
+"""
+
+import argparse, json, logging, socket, socketserver, threading, time, numpy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from . import tp3func
+
+SERVAL_PORT = 8080
+DEFAULT_EVENT_RATE = 1e7 #events per second. 0 means as fast as possible
+DEFAULT_FRAME_RATE = 100.0 #frames per second. 0 means as fast as possible
+EVENT_POOL_SIZE = 1 << 20
+EVENT_CHUNK_SIZE = 1 << 16
+NUMBER_OF_POOL_FRAMES = 4
+ZLP_CHANNEL = 100
+ZLP_WIDTH = 3.0
+ZLP_FRACTION = 0.5
+
+
+class ServalSimulator:
+
+    def __init__(self, host: str = '127.0.0.1', serval_port: int = SERVAL_PORT, stream_port: int = tp3func.PORT,
+                 event_rate: float = DEFAULT_EVENT_RATE, frame_rate: float = DEFAULT_FRAME_RATE):
+        self.host = host
+        self.serval_port = serval_port
+        self.stream_port = stream_port
+        self.event_rate = event_rate
+        self.frame_rate = frame_rate
+        self.detector_config = {'Fan1PWM': 100, 'Fan2PWM': 100, 'BiasVoltage': 100, 'BiasEnabled': True,
+                                'TriggerIn': 2, 'TriggerOut': 0, 'Polarity': 'Positive',
+                                'TriggerMode': 'AUTOTRIGSTART_TIMERSTOP', 'ExposureTime': 0.05,
+                                'TriggerPeriod': 0.05, 'nTriggers': 99999, 'PeriphClk80': False,
+                                'TriggerDelay': 0.0, 'Tdc': ['P0', 'P0'], 'LogLevel': 1}
+        self.destination = dict()
+        self.__measurement = None
+        self.__recording = threading.Event()
+        self.__lock = threading.Lock()
+        self.__counters = {'clients': 0, 'frames_sent': 0, 'events_sent': 0, 'bytes_sent': 0}
+        self.__http_server = None
+        self.__stream_server = None
+        self.__threads = list()
+
+    @property
+    def counters(self) -> dict:
+        with self.__lock:
+            return dict(self.__counters)
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.serval_port}'
+
+    @property
+    def is_recording(self) -> bool:
+        return self.__recording.is_set()
+
+    def start(self):
+        simulator = self
+
+        class ServalHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                simulator.handle_request(self, 'GET')
+
+            def do_PUT(self):
+                simulator.handle_request(self, 'PUT')
+
+            def log_message(self, format, *args):
+                pass
+
+        class StreamHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                simulator.handle_stream(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.__http_server = ThreadingHTTPServer((self.host, self.serval_port), ServalHandler)
+        self.__stream_server = socketserver.ThreadingTCPServer((self.host, self.stream_port), StreamHandler)
+        self.__stream_server.daemon_threads = True
+        self.__threads = [threading.Thread(target=self.__http_server.serve_forever, daemon=True),
+                          threading.Thread(target=self.__stream_server.serve_forever, daemon=True)]
+        for thread in self.__threads:
+            thread.start()
+        logging.info(f'***TP3_VI***: Serval simulator at {self.url} streaming on port {self.stream_port}.')
+
+    def stop(self):
+        self.stop_measurement()
+        for server in [self.__http_server, self.__stream_server]:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = list()
+
+    def start_measurement(self):
+        with self.__lock:
+            self.__measurement = {'Status': 'DA_RECORDING', 'StartDateTime': time.time(), 'FrameCount': 0}
+        self.__recording.set()
+
+    def stop_measurement(self):
+        self.__recording.clear()
+        with self.__lock:
+            self.__measurement = None
+
+    def dashboard(self) -> dict:
+        with self.__lock:
+            measurement = None if self.__measurement is None else dict(self.__measurement)
+            frames_sent = self.__counters['frames_sent']
+        if measurement is not None:
+            measurement['ElapsedTime'] = time.time() - measurement.pop('StartDateTime')
+            measurement['FrameCount'] = frames_sent
+        return {'Server': {'SoftwareVersion': 'simulator'}, 'Measurement': measurement}
+
+    def handle_request(self, request: BaseHTTPRequestHandler, method: str):
+        path = urlparse(request.path).path.rstrip('/')
+        body = b''
+        if method == 'PUT':
+            length = int(request.headers.get('Content-Length', 0))
+            body = request.rfile.read(length)
+
+        status, reply = 200, ''
+        if path == '':
+            reply = 'Serval simulator.'
+        elif path == '/dashboard':
+            reply = json.dumps(self.dashboard())
+        elif path == '/detector/config':
+            if method == 'PUT':
+                self.detector_config.update(json.loads(body))
+                reply = 'Detector configuration updated.'
+            else:
+                reply = json.dumps(self.detector_config)
+        elif path == '/server/destination':
+            if method == 'PUT':
+                self.destination = json.loads(body)
+                reply = 'Destination updated.'
+            else:
+                reply = json.dumps(self.destination)
+        elif path == '/measurement/start':
+            self.start_measurement()
+            reply = 'Measurement started.'
+        elif path == '/measurement/stop':
+            self.stop_measurement()
+            reply = 'Measurement stopped.'
+        elif path == '/config/load':
+            reply = 'Configuration loaded.'
+        else:
+            status, reply = 404, f'Unknown endpoint {path}.'
+
+        reply = reply.encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'text/plain')
+        request.send_header('Content-Length', str(len(reply)))
+        request.end_headers()
+        request.wfile.write(reply)
+
+    def __count(self, frames: int, events: int, nbytes: int):
+        with self.__lock:
+            self.__counters['frames_sent'] += frames
+            self.__counters['events_sent'] += events
+            self.__counters['bytes_sent'] += nbytes
+
+    @staticmethod
+    def read_configuration(client: socket.socket) -> (tp3func.Timepix3Configurations, bytes):
+        """
+        Reads the json configuration sent by the client. It has no terminator, so bytes are read until they decode.
+        Bytes received after the configuration are returned with it.
+        """
+        decoder = json.JSONDecoder()
+        data = b''
+        while True:
+            packet = client.recv(4096)
+            if not packet:
+                raise ConnectionResetError
+            data += packet
+            try:
+                settings, end = decoder.raw_decode(data.decode('latin-1'))
+                break
+            except ValueError:
+                continue
+        #An in-process simulator must not write the client values, nor the defaults, to the instrument dictionary
+        config = tp3func.Timepix3Configurations(publish=False)
+        for key, value in settings.items():
+            setattr(config, key, value)
+        return config, data[end:]
+
+    def handle_stream(self, client: socket.socket):
+        with self.__lock:
+            self.__counters['clients'] += 1
+        try:
+            config, leftover = self.read_configuration(client)
+            logging.info(f'***TP3_VI***: Client connected in mode {config.mode}.')
+            if config.mode == tp3func.EVENT_LIST_SCAN:
+                # Ordered array of the scan, sent by the client before the sequence starts
+                self.__recv_exactly(client, config.xscan_size * config.yscan_size * 4 - len(leftover))
+            if config.mode in [tp3func.FRAME, tp3func.FRAME_BASED, tp3func.ISIBOX_SAVEALL, tp3func.FASTCHRONO,
+                               tp3func.COINC_CHRONO]:
+                self.stream_frames(client, config)
+            elif config.mode == tp3func.HYPERSPEC_FRAME_BASED:
+                self.stream_hyperspec_frames(client, config)
+            elif config.mode in [tp3func.EVENT_HYPERSPEC, tp3func.EVENT_HYPERSPEC_COINC, tp3func.EVENT_LIST_SCAN,
+                                 tp3func.EVENT_4DRAW]:
+                self.stream_events(client, config)
+            elif config.mode == tp3func.FRAME_4DMASKED:
+                self.stream_masked_frames(client, config)
+            else:
+                logging.info(f'***TP3_VI***: Mode {config.mode} is not simulated.')
+        except (ConnectionResetError, BrokenPipeError, ConnectionAbortedError):
+            pass
+        finally:
+            client.close()
+
+    @staticmethod
+    def __recv_exactly(client: socket.socket, nbytes: int):
+        while nbytes > 0:
+            packet = client.recv(min(nbytes, 1 << 16))
+            if not packet:
+                raise ConnectionResetError
+            nbytes -= len(packet)
+
+    def __wait_recording(self, timeout: float = 5.0) -> bool:
+        return self.__recording.wait(timeout)
+
+    @staticmethod
+    def __throttle(start: float, amount: float, rate: float):
+        if rate > 0:
+            delay = start + amount / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def __frame_pool(self, shape, dtype) -> list:
+        return [numpy.random.poisson(10, shape).astype(dtype) for _ in range(NUMBER_OF_POOL_FRAMES)]
+
+    @staticmethod
+    def create_header(frame_number: int, data_size: int, bitdepth: int, width: int, height: int) -> bytes:
+        return ("{{\"timeAtFrame\":{},\"frameNumber\":{},\"measurementID\":Null,\"dataSize\":{},\"bitDepth\":{},"
+                "\"width\":{},\"height\":{}}}\n").format(time.time(), frame_number, data_size, bitdepth, width,
+                                                         height).encode()
+
+    def stream_frames(self, client: socket.socket, config: tp3func.Timepix3Configurations):
+        shape = numpy.atleast_1d(config.get_array_shape())
+        dtype = config.get_data_receive_type()
+        frames = self.__frame_pool(tuple(shape), dtype)
+        width = int(shape[-1])
+        height = int(numpy.prod(shape[:-1])) if len(shape) > 1 else 1
+        if not self.__wait_recording():
+            return
+        start = time.perf_counter()
+        frame_number = 0
+        while self.is_recording:
+            payload = frames[frame_number % NUMBER_OF_POOL_FRAMES]
+            client.sendall(self.create_header(frame_number, payload.nbytes, dtype.itemsize * 8, width, height))
+            client.sendall(payload)
+            frame_number += 1
+            self.__count(1, 0, payload.nbytes)
+            self.__throttle(start, frame_number, self.frame_rate)
+
+    def stream_hyperspec_frames(self, client: socket.socket, config: tp3func.Timepix3Configurations):
+        dtype = config.get_data_receive_type()
+        spectra = self.__frame_pool((tp3func.SPEC_SIZE,), dtype)
+        number_of_pixels = config.xscan_size * config.yscan_size
+        if not self.__wait_recording():
+            return
+        start = time.perf_counter()
+        for pixel in range(number_of_pixels):
+            if not self.is_recording:
+                return
+            payload = spectra[pixel % NUMBER_OF_POOL_FRAMES]
+            client.sendall(self.create_header(pixel, payload.nbytes, dtype.itemsize * 8, tp3func.SPEC_SIZE, 1))
+            client.sendall(payload)
+            self.__count(1, 0, payload.nbytes)
+            self.__throttle(start, pixel + 1, self.frame_rate)
+
+    def create_event_pool(self, config: tp3func.Timepix3Configurations) -> numpy.ndarray:
+        """
+        Random events with a bright zero-loss peak. For EVENT_4DRAW, the detector index is a round spot at the center.
+        """
+        number_of_pixels = max(config.xspim_size * config.yspim_size, 1)
+        pixels = numpy.random.randint(0, number_of_pixels, EVENT_POOL_SIZE).astype(numpy.uint64)
+        if config.mode == tp3func.EVENT_4DRAW:
+            y = numpy.random.normal(tp3func.RAW4D_PIXELS_Y / 2, 20, EVENT_POOL_SIZE)
+            x = numpy.random.normal(tp3func.RAW4D_PIXELS_X / 2, 20, EVENT_POOL_SIZE)
+            y = numpy.clip(y, 0, tp3func.RAW4D_PIXELS_Y - 1).astype(numpy.uint64)
+            x = numpy.clip(x, 0, tp3func.RAW4D_PIXELS_X - 1).astype(numpy.uint64)
+            events = pixels * tp3func.RAW4D_PIXELS_Y * tp3func.RAW4D_PIXELS_X + y * tp3func.RAW4D_PIXELS_X + x
+        else:
+            channels = numpy.random.randint(0, tp3func.SPIM_SIZE, EVENT_POOL_SIZE)
+            zlp = numpy.random.rand(EVENT_POOL_SIZE) < ZLP_FRACTION
+            channels[zlp] = numpy.clip(numpy.random.normal(ZLP_CHANNEL, ZLP_WIDTH, numpy.count_nonzero(zlp)),
+                                       0, tp3func.SPIM_SIZE - 1)
+            events = pixels * tp3func.SPIM_SIZE + channels.astype(numpy.uint64)
+        return events.astype(config.get_data_receive_type())
+
+    def stream_events(self, client: socket.socket, config: tp3func.Timepix3Configurations):
+        pool = self.create_event_pool(config)
+        if not self.__wait_recording():
+            return
+        start = time.perf_counter()
+        sent = 0
+        while self.is_recording:
+            offset = numpy.random.randint(0, EVENT_POOL_SIZE - EVENT_CHUNK_SIZE)
+            chunk = pool[offset:offset + EVENT_CHUNK_SIZE]
+            client.sendall(chunk)
+            sent += EVENT_CHUNK_SIZE
+            self.__count(0, EVENT_CHUNK_SIZE, chunk.nbytes)
+            self.__throttle(start, sent, self.event_rate)
+
+    def stream_masked_frames(self, client: socket.socket, config: tp3func.Timepix3Configurations):
+        shape = (config.yscan_size, config.xscan_size, tp3func.NUMBER_OF_MASKS)
+        frames = self.__frame_pool(shape, numpy.uint16)
+        if not self.__wait_recording():
+            return
+        start = time.perf_counter()
+        frame_number = 0
+        while self.is_recording:
+            client.sendall(frames[frame_number % NUMBER_OF_POOL_FRAMES])
+            frame_number += 1
+            self.__count(1, 0, frames[0].nbytes)
+            self.__throttle(start, frame_number, self.frame_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Timepix3 Serval and TCP stream simulator.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--serval-port', type=int, default=SERVAL_PORT)
+    parser.add_argument('--stream-port', type=int, default=tp3func.PORT)
+    parser.add_argument('--event-rate', type=float, default=DEFAULT_EVENT_RATE)
+    parser.add_argument('--frame-rate', type=float, default=DEFAULT_FRAME_RATE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    simulator = ServalSimulator(args.host, args.serval_port, args.stream_port, args.event_rate, args.frame_rate)
+    simulator.start()
+    try:
+        while True:
+            time.sleep(5.0)
+            logging.info(f'***TP3_VI***: {simulator.counters}')
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,373 @@
+import logging, time, numpy
+from numba import jit, prange, get_num_threads
+
+try:
+    import rust2swift
+except ImportError:
+    rust2swift = None
+
+#Below these values the per-call overhead of the parallel and vectorized backends is larger than the work itself
+SMALL_BATCH = 65536
+BINCOUNT_RATIO = 4
+PARALLEL_RATE = 5e7
+RATE_UPDATE_PERIOD = 1.0
+#Overflow promotion
+HISTOGRAM_DTYPE = numpy.uint8 #Dense histograms start in the smallest dtype. Saturated tiles are promoted
+TILE_SIZE = 64 #Number of consecutive bins promoted together
+
+
+@jit(nopython=True)
+def update_spim_numba(array, event_list):
+    size = array.size
+    for val in event_list:
+        if val < size:
+            array[val] += 1
+
+
+@jit(nopython=True, parallel=True)
+def update_spim_numba_parallel(array, event_list, number_of_threads, scratch):
+    """
+    The events are split in number_of_threads chunks, one per thread, and sorted in scratch by histogram range, so that
+    each thread then increments only the bins of its own range. No two threads write the same bin and no private copy
+    of the histogram is needed, while every pass reads a single chunk of the events per thread.
+    """
+    size = array.size
+    number_of_events = event_list.size
+    step = max((size + number_of_threads - 1) // number_of_threads, 1)
+    chunk = (number_of_events + number_of_threads - 1) // number_of_threads
+    #counts[chunk, range], the last range being the events outside the histogram
+    counts = numpy.zeros((number_of_threads, number_of_threads + 1), dtype=numpy.int64)
+    for thread in prange(number_of_threads):
+        for index in range(thread * chunk, min((thread + 1) * chunk, number_of_events)):
+            val = numpy.int64(event_list[index])
+            counts[thread, val // step if val < size else number_of_threads] += 1
+    offsets = numpy.zeros((number_of_threads, number_of_threads + 1), dtype=numpy.int64)
+    bounds = numpy.zeros(number_of_threads + 2, dtype=numpy.int64)
+    position = 0
+    for histogram_range in range(number_of_threads + 1):
+        bounds[histogram_range] = position
+        for thread in range(number_of_threads):
+            offsets[thread, histogram_range] = position
+            position += counts[thread, histogram_range]
+    bounds[number_of_threads + 1] = position
+    for thread in prange(number_of_threads):
+        for index in range(thread * chunk, min((thread + 1) * chunk, number_of_events)):
+            val = numpy.int64(event_list[index])
+            if val < size:
+                histogram_range = val // step
+                scratch[offsets[thread, histogram_range]] = val
+                offsets[thread, histogram_range] += 1
+    for thread in prange(number_of_threads):
+        for index in range(bounds[thread], bounds[thread + 1]):
+            array[scratch[index]] += 1
+
+
+@jit(nopython=True)
+def update_spim_saturating(array, event_list, maximum, tile_size, tile_map, tiles, pending):
+    """
+    Bins stop at maximum. Further counts go to the promoted tile of the bin or, if the tile is not promoted yet, to
+    pending. Returns the number of pending events.
+    """
+    size = array.size
+    number_of_pending = 0
+    for val in event_list:
+        index = numpy.int64(val)
+        if index < size:
+            if array[index] < maximum:
+                array[index] += 1
+            else:
+                slot = tile_map[index // tile_size]
+                if slot >= 0:
+                    tiles[slot, index % tile_size] += 1
+                else:
+                    pending[number_of_pending] = index
+                    number_of_pending += 1
+    return number_of_pending
+
+
+@jit(nopython=True)
+def select_energy_window(event_list, out, spim_size, start, end, binning, channels):
+    """
+    Copies to out the events whose channel is in [start, end), renumbered for spectra of channels channels with binning
+    channels summed in each. Returns the number of events kept.
+    """
+    number_of_events = 0
+    for val in event_list:
+        index = numpy.int64(val)
+        channel = index % spim_size
+        if start <= channel < end:
+            out[number_of_events] = (index // spim_size) * channels + (channel - start) // binning
+            number_of_events += 1
+    return number_of_events
+
+
+class AccumulationBackend:
+    name = 'None'
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    def accumulate(self, array: numpy.ndarray, event_list: numpy.ndarray):
+        raise NotImplementedError
+
+
+class NumbaSerialBackend(AccumulationBackend):
+    name = 'NumbaSerial'
+
+    def accumulate(self, array, event_list):
+        update_spim_numba(array, event_list)
+
+
+class NumbaParallelBackend(AccumulationBackend):
+    name = 'NumbaParallel'
+
+    def __init__(self):
+        self.number_of_threads = get_num_threads()
+        self.__scratch = numpy.zeros(0, dtype=numpy.uint32)
+
+    def accumulate(self, array, event_list):
+        if self.__scratch.size < event_list.size or self.__scratch.dtype != event_list.dtype:
+            self.__scratch = numpy.empty(event_list.size, dtype=event_list.dtype)
+        update_spim_numba_parallel(array, event_list, self.number_of_threads, self.__scratch)
+
+
+class BincountBackend(AccumulationBackend):
+    """
+    Vectorized in numpy. Only worth it when the histogram is not much larger than the event batch, because bincount
+    allocates and adds a full-size histogram on every call.
+    """
+    name = 'Bincount'
+
+    def accumulate(self, array, event_list):
+        counts = numpy.bincount(event_list, minlength=array.size)
+        if counts.size > array.size:
+            logging.info(f'***TP3***: {numpy.count_nonzero(counts[array.size:])} events outside the histogram.')
+            counts = counts[:array.size]
+        array += counts.astype(array.dtype)
+
+
+class RustBackend(AccumulationBackend):
+    """
+    Uses accumulate_spim from the rust2swift extension (swift_rust folder). Both arrays are passed by address, with only
+    their item size, so they must be unsigned integers.
+    """
+    name = 'Rust'
+
+    @property
+    def available(self) -> bool:
+        return rust2swift is not None and hasattr(rust2swift, 'accumulate_spim')
+
+    def accumulate(self, array, event_list):
+        event_list = numpy.ascontiguousarray(event_list)
+        assert array.dtype.kind == 'u' and array.flags.c_contiguous, \
+            f'***TP3***: Rust accumulation needs a contiguous unsigned histogram, not {array.dtype}.'
+        assert event_list.dtype.kind == 'u', \
+            f'***TP3***: Rust accumulation needs unsigned events, not {event_list.dtype}.'
+        skipped = rust2swift.accumulate_spim(array.ctypes.data, array.size, array.itemsize,
+                                             event_list.ctypes.data, event_list.size, event_list.itemsize)
+        if skipped:
+            logging.info(f'***TP3***: {skipped} events outside the histogram.')
+
+
+class AccumulationEngine:
+    """
+    Histograms event lists into the SPIM array. The backend is chosen from the measured event rate and the histogram
+    size, unless a backend name is given in backend.
+
+    Small batches go to the serial numba loop, which has the lowest call overhead. Histograms that are small compared
+    to the batch go to bincount. At high event rates, the parallel numba kernel is used, or the rust extension if numba
+    has a single thread.
+    """
+
+    def __init__(self, backend: str = None):
+        self.backends = dict()
+        for backend_class in [NumbaSerialBackend, NumbaParallelBackend, BincountBackend, RustBackend]:
+            candidate = backend_class()
+            if candidate.available:
+                self.backends[candidate.name] = candidate
+        self.forced_backend = backend
+        self.reset()
+
+    def reset(self):
+        self.events_per_second = 0.0
+        self.total_events = 0
+        self.__rate_events = 0
+        self.__rate_start = time.perf_counter()
+        self.__usage = dict()
+
+    @property
+    def usage(self) -> dict:
+        """
+        Number of events histogrammed by each backend since the last reset.
+        """
+        return dict(self.__usage)
+
+    def choose_backend(self, number_of_events: int, histogram_size: int) -> AccumulationBackend:
+        if self.forced_backend in self.backends:
+            return self.backends[self.forced_backend]
+        if histogram_size <= BINCOUNT_RATIO * number_of_events:
+            return self.backends['Bincount']
+        if number_of_events < SMALL_BATCH and self.events_per_second < PARALLEL_RATE:
+            return self.backends['NumbaSerial']
+        if 'NumbaParallel' in self.backends and self.backends['NumbaParallel'].number_of_threads > 1:
+            return self.backends['NumbaParallel']
+        if 'Rust' in self.backends:
+            return self.backends['Rust']
+        return self.backends['NumbaSerial']
+
+    def accumulate(self, array: numpy.ndarray, event_list: numpy.ndarray):
+        number_of_events = event_list.size
+        backend = self.choose_backend(number_of_events, array.size)
+        backend.accumulate(array, event_list)
+        self.total_events += number_of_events
+        self.__usage[backend.name] = self.__usage.get(backend.name, 0) + number_of_events
+        self.__rate_events += number_of_events
+        elapsed = time.perf_counter() - self.__rate_start
+        if elapsed > RATE_UPDATE_PERIOD:
+            self.events_per_second = self.__rate_events / elapsed
+            self.__rate_events = 0
+            self.__rate_start = time.perf_counter()
+
+
+class EnergyWindow:
+    """
+    Energy ROI and binning applied to the event lists before they are histogrammed, so the SPIM is allocated with
+    channels channels per spectrum instead of spim_size. Events outside the ROI are counted in dropped_events.
+    """
+
+    def __init__(self, spim_size: int, start: int = 0, end: int = None, binning: int = 1):
+        self.spim_size = spim_size
+        self.start = min(max(int(start), 0), spim_size - 1)
+        self.end = spim_size if end is None else min(max(int(end), self.start + 1), spim_size)
+        self.binning = max(int(binning), 1)
+        self.channels = -(-(self.end - self.start) // self.binning)
+        self.kept_events = 0
+        self.dropped_events = 0
+        self.__out = numpy.zeros(0, dtype=numpy.uint32)
+
+    @property
+    def is_full(self) -> bool:
+        return self.start == 0 and self.end == self.spim_size and self.binning == 1
+
+    def get_calibration(self, dispersion: float, offset: float) -> (float, float):
+        """
+        Dispersion and offset, in eV, of the first channel of the reduced spectra.
+        """
+        return dispersion * self.binning, offset + dispersion * (self.start + (self.binning - 1) / 2)
+
+    def apply(self, event_list: numpy.ndarray) -> numpy.ndarray:
+        """
+        The returned array is reused by the next call.
+        """
+        if self.is_full:
+            return event_list
+        if self.__out.size < event_list.size or self.__out.dtype != event_list.dtype:
+            self.__out = numpy.empty(event_list.size, dtype=event_list.dtype)
+        number_of_events = select_energy_window(event_list, self.__out, self.spim_size, self.start, self.end,
+                                                self.binning, self.channels)
+        self.kept_events += number_of_events
+        self.dropped_events += event_list.size - number_of_events
+        return self.__out[:number_of_events]
+
+
+class OverflowHistogram:
+    """
+    Histogram that never loses counts, whatever the dtype of data. data is the dense array seen by the display. Its bins
+    saturate at the dtype maximum instead of wrapping around. The counts above the maximum are kept in uint32 tiles of
+    TILE_SIZE consecutive bins, allocated only for the tiles where a bin saturated. With a bright zero-loss peak, only a
+    few tiles per spectrum are promoted.
+
+    The events of every tile are counted. A bin cannot have reached the maximum while its tile has received fewer events
+    than that, so the events of these tiles go to the AccumulationEngine, if given, and only the events of the hot
+    tiles go to the serial saturating kernel.
+    """
+
+    def __init__(self, data: numpy.ndarray, tile_size: int = TILE_SIZE):
+        self.data = data
+        self.maximum = numpy.iinfo(data.dtype).max
+        self.tile_size = tile_size
+        self.tile_map = numpy.full(-(-data.size // tile_size), -1, dtype=numpy.int32)
+        self.tile_events = numpy.zeros(self.tile_map.size, dtype=numpy.uint64)
+        self.tiles = numpy.zeros((16, tile_size), dtype=numpy.uint32)
+        self.number_of_tiles = 0
+        self.total_events = 0
+        self.hot_events = 0
+        self.__pending = numpy.zeros(0, dtype=numpy.int64)
+        self.__counts = None
+        self.__dirty = numpy.zeros(self.tile_map.size, dtype=bool) #Tiles with events since the last get_counts
+
+    @property
+    def memory_bytes(self) -> int:
+        counts = 0 if self.__counts is None else self.__counts.nbytes
+        return self.data.nbytes + self.tile_map.nbytes + self.tile_events.nbytes + self.tiles.nbytes + \
+               self.__dirty.nbytes + counts
+
+    def accumulate(self, event_list: numpy.ndarray, engine: AccumulationEngine = None):
+        self.total_events += event_list.size
+        tiles = numpy.minimum(event_list // self.tile_size, self.tile_map.size - 1)
+        if engine is None:
+            self.__accumulate_saturating(event_list)
+        else:
+            #Tile counts go straight to a backend, so the engine only counts the events of the histogram
+            engine.choose_backend(tiles.size, self.tile_events.size).accumulate(self.tile_events, tiles)
+            hot = self.tile_events[tiles] > self.maximum
+            if not hot.any():
+                engine.accumulate(self.data, event_list)
+            else:
+                hot_events = event_list[hot]
+                self.hot_events += hot_events.size
+                engine.accumulate(self.data, event_list[~hot])
+                self.__accumulate_saturating(hot_events)
+        #Marked once the bins are written, so a get_counts running meanwhile sees the tiles again at its next call
+        self.__dirty[tiles] = True
+
+    def __accumulate_saturating(self, event_list: numpy.ndarray):
+        if self.__pending.size < event_list.size:
+            self.__pending = numpy.empty(event_list.size, dtype=numpy.int64)
+        number_of_pending = update_spim_saturating(self.data, event_list, self.maximum, self.tile_size,
+                                                   self.tile_map, self.tiles, self.__pending)
+        if number_of_pending:
+            pending = self.__pending[:number_of_pending].copy()
+            for tile in numpy.unique(pending // self.tile_size):
+                self.__promote(tile)
+            update_spim_saturating(self.data, pending, self.maximum, self.tile_size, self.tile_map, self.tiles,
+                                   self.__pending)
+
+    def __promote(self, tile: int):
+        if self.number_of_tiles == self.tiles.shape[0]:
+            self.tiles = numpy.concatenate((self.tiles, numpy.zeros_like(self.tiles)))
+        self.tile_map[tile] = self.number_of_tiles
+        self.number_of_tiles += 1
+        if self.number_of_tiles == 1:
+            logging.info(f'***TP3***: Histogram bins reached {self.maximum}. Promoting tiles of {self.tile_size} bins.')
+
+    def get_counts(self, copy: bool = False) -> numpy.ndarray:
+        """
+        Exact counts, in a dtype large enough for them. Until a tile is promoted, it is data itself, unless copy is set.
+        Otherwise it is an array kept between calls, in which only the tiles that received events since the previous
+        call are refreshed from data and the promoted tiles. Only tiles are refreshed, so a caller can change bins that
+        it recomputes at every call, like the gap columns.
+        """
+        if self.number_of_tiles == 0 and not copy:
+            return self.data
+        if self.number_of_tiles == 0:
+            dtype = self.data.dtype
+        else:
+            dtype = numpy.uint64 if self.data.dtype == numpy.uint32 else numpy.uint32
+        if self.__counts is None or self.__counts.dtype != dtype:
+            self.__counts = numpy.zeros(self.tile_map.size * self.tile_size, dtype=dtype)
+            self.__dirty[:] = True
+        dirty = numpy.flatnonzero(self.__dirty)
+        self.__dirty[dirty] = False
+        size = self.data.size
+        full = size // self.tile_size #Tiles entirely within data. The last one can be partial
+        flat = self.data.reshape(-1)
+        counts = self.__counts.reshape(-1, self.tile_size)
+        complete = dirty[dirty < full]
+        counts[complete] = flat[:full * self.tile_size].reshape(-1, self.tile_size)[complete]
+        if full < self.tile_map.size and dirty.size and dirty[-1] == full:
+            counts[full, :size - full * self.tile_size] = flat[full * self.tile_size:]
+        promoted = dirty[self.tile_map[dirty] >= 0]
+        counts[promoted] += self.tiles[self.tile_map[promoted]]
+        return self.__counts[:size]
@@ -1,10 +1,10 @@
 import json, time, requests, threading, logging, socket, numpy, struct, select
-from numba import jit
 
 from nion.swift.model import HardwareSource
 from nion.utils import Registry
 
-from ...aux_files import read_data
+from ...aux_files import read_data, disk_spim, frame_accumulation
+from . import tp3stream, tp3accumulate, tp3sparse, tp3virtual, tp3gaps
 
 def SENDMYMESSAGEFUNC(sendmessagefunc):
     return sendmessagefunc
@@ -34,7 +34,8 @@ PIXEL_THRESHOLD_FILES = ['eq-accos-03_00.dacs', 'eq-accos-03_01.dacs', 'eq-accos
                          'eq-accos-03_03.dacs', 'eq-accos-03_04.dacs', 'eq-accos-03_05.dacs',
                          'eq-accos-03_06.dacs', 'eq-accos-03_07.dacs']
 BUFFER_SIZE = 64000
-NUMBER_OF_MASKS = 4
+NUMBER_OF_MASKS = 4 #Masks applied by the server in FRAME_4DMASKED. EVENT_4DRAW uses tp3virtual instead
+CLIENT_SETTINGS = ['energy_start', 'energy_end', 'energy_binning'] #Applied by the client and not sent to the server
 
 #Modes that we receive a frame
 FRAME = 0
@@ -54,20 +55,21 @@ ISIBOX_SAVEALL = 8
 
 #TCP properties
 PORT = 8088
+MONITOR_PERIOD = 0.05
 
 
-@jit(nopython=True)
-def update_spim_numba(array, event_list):
-    for val in event_list:
-        array[val] += 1
-
 class Response:
     def __init__(self):
         self.text = '***TP3***: This is simul mode.'
 
 class Timepix3Configurations:
+    """
+    Attributes are sent to the instrument dictionary as they are set, unless publish is False.
+    """
 
-    def __init__(self):
+    def __init__(self, publish: bool = True):
+        #Set without __setattr__, which reads it
+        object.__setattr__(self, 'publish', publish)
         self.settings = dict()
 
         self.bin = False
@@ -90,17 +92,32 @@ class Timepix3Configurations:
         self.destination_port = 0
         self.sup0 = 0.0
         self.sup1 = 0.0
+        self.energy_start = 0
+        self.energy_end = SPIM_SIZE
+        self.energy_binning = 1
 
     def __setattr__(self, key, value):
         try:
             self.settings[key] = value
-            read_data.InstrumentDictSetter("Timepix3", key, value)
+            if self.publish:
+                read_data.InstrumentDictSetter("Timepix3", key, value)
         except AttributeError:
             pass
         super(Timepix3Configurations, self).__setattr__(key, value)
 
     def create_configuration_bytes(self):
-        return json.dumps(self.settings).encode()
+        settings = {key: value for key, value in self.settings.items() if key not in CLIENT_SETTINGS}
+        return json.dumps(settings).encode()
+
+    def is_event_hyperspec(self):
+        return self.mode == EVENT_HYPERSPEC or self.mode == EVENT_HYPERSPEC_COINC or self.mode == EVENT_LIST_SCAN
+
+    def get_energy_window(self):
+        """
+        Energy ROI and binning of the event hyperspec modes. The event lists are cropped and binned while they are
+        histogrammed.
+        """
+        return tp3accumulate.EnergyWindow(SPIM_SIZE, self.energy_start, self.energy_end, self.energy_binning)
 
     def get_array_size(self):
         shape = self.get_array_shape()
@@ -124,8 +141,8 @@ class Timepix3Configurations:
                 return SPEC_SIZE_Y, SPEC_SIZE
         elif self.mode == FRAME_4DMASKED:
             return self.yspim_size, self.xspim_size, NUMBER_OF_MASKS
-        elif self.mode == EVENT_HYPERSPEC or self.mode == EVENT_HYPERSPEC_COINC or self.mode == EVENT_LIST_SCAN:
-            return self.yspim_size, self.xspim_size, SPIM_SIZE
+        elif self.is_event_hyperspec():
+            return self.yspim_size, self.xspim_size, self.get_energy_window().channels
         elif self.mode == HYPERSPEC_FRAME_BASED: #Frame based measurement
             return self.yscan_size, self.xscan_size, SPEC_SIZE
         elif self.mode == EVENT_4DRAW:
@@ -147,50 +164,60 @@ class Timepix3Configurations:
 class Timepix3DataManager:
     def __init__(self):
         self.data = None
+        self.sparse = None
+        self.sink = None
+        self.histogram = None
+
+    def allocate(self, array_size: int, dtype):
+        """
+        Large cubes go to a memory-mapped file.
+        """
+        self.data, self.sink = disk_spim.create_spim_array((array_size,), dtype)
+        return self.data
 
     def get_data(self, config: Timepix3Configurations):
         data_depth = config.get_data_receive_type()
         array_size = config.get_array_size()
-        if config.mode == EVENT_HYPERSPEC or config.mode == EVENT_HYPERSPEC_COINC or config.mode == EVENT_LIST_SCAN:
-            max_val = max(config.xspim_size, config.yspim_size)
-            if max_val <= 64:
-                self.data = numpy.zeros(array_size, dtype=numpy.uint32)
-            elif max_val <= 1024:
-                self.data = numpy.zeros(array_size, dtype=numpy.uint16)
-            else:
-                self.data = numpy.zeros(array_size, dtype=numpy.uint8)
-        elif config.mode == EVENT_4DRAW:
-            self.data = numpy.zeros(array_size, dtype=numpy.uint8)
+        self.sparse = None
+        self.histogram = None
+        if self.sink is not None: #The file of the previous acquisition is released
+            self.sink.close()
+            self.sink = None
+        if config.is_event_hyperspec():
+            #Cubes start in the smallest dtype. Saturated bins are promoted by the histogram
+            self.allocate(array_size, tp3accumulate.HISTOGRAM_DTYPE)
+            self.histogram = tp3accumulate.OverflowHistogram(self.data)
+        elif config.mode == EVENT_4DRAW: #Events are kept sparse. Data is only the binned live preview
+            self.sparse = tp3sparse.SparseEventStore(config.yspim_size, config.xspim_size,
+                                                     (RAW4D_PIXELS_Y, RAW4D_PIXELS_X))
+            self.data = self.sparse.preview
         elif config.mode == FRAME or config.mode == FRAME_BASED \
                 or config.mode == FRAME_4DMASKED or config.mode == FASTCHRONO \
                 or config.mode == COINC_CHRONO or config.mode == HYPERSPEC_FRAME_BASED or config.mode == ISIBOX_SAVEALL:
-            self.data = numpy.zeros(array_size, dtype=data_depth)
+            self.allocate(array_size, data_depth)
         else:
             raise TypeError("***TP3_CONFIG***: Attempted mode ({self.mode}) that is not configured in get_data.")
         logging.info(f"***TP3_CONFIG***: Returning data for acquisition with shape {self.data.shape}.")
         return self.data
 
-    def correct_data_or_not(self, gapsMode: int, config: Timepix3Configurations):
-        if gapsMode == 1:
-            if config.mode == FRAME or config.mode == FRAME_BASED:
-                if config.bin:
-                    for start_index in [255, 511, 767]:
-                        self.data[start_index] = (2 * self.data[start_index - 1] + self.data[start_index + 2]) / 3.0
-                        self.data[start_index + 1] = (2 * self.data[start_index + 2] + self.data[start_index - 1]) / 3.0
-                else:
-                    for start_index in [255, 511, 767]:
-                        self.data[start_index::SPEC_SIZE] = (2 * self.data[start_index - 1::SPEC_SIZE] + self.data[start_index + 2::SPEC_SIZE]) / 3.0
-                        self.data[start_index + 1::SPEC_SIZE] = (2 * self.data[start_index + 2::SPEC_SIZE] + self.data[start_index - 1::SPEC_SIZE]) / 3.0
-            elif config.mode == COINC_CHRONO:
-                for start_index in [255, 511, 767]:
-                    self.data[start_index::SPEC_SIZE] = (2 * self.data[start_index - 1::SPEC_SIZE] + self.data[
-                                                                                                     start_index + 2::SPEC_SIZE]) / 3.0
-                    self.data[start_index + 1::SPEC_SIZE] = (2 * self.data[start_index + 2::SPEC_SIZE] + self.data[
-                                                                                                         start_index - 1::SPEC_SIZE]) / 3.0
-            else:
-                logging.info("***TPX3***: No gap correction has been set for this mode.")
+    def correct_data_or_not(self, gapsMode: int, config: Timepix3Configurations, start: int = 0, end: int = None):
+        """
+        Interpolates the chip gaps of the frame modes along the energy axis, in place, once a frame (or the channels
+        between start and end) is received. The event hyperspec cubes are accumulated, so their gaps are only corrected
+        in the counts array of their histogram, in create_spimimage.
+        """
+        if gapsMode != tp3gaps.INTERPOLATE or self.data is None:
+            return False
+        if config.mode == FRAME or config.mode == FRAME_BASED or config.mode == ISIBOX_SAVEALL \
+                or config.mode == FASTCHRONO or config.mode == COINC_CHRONO or config.mode == HYPERSPEC_FRAME_BASED:
+            length = numpy.atleast_1d(config.get_array_shape())[-1]
+            tp3gaps.correct_gaps(self.data[start:end].reshape((-1, length)))
+            return True
+        return False
 
     def create_reshaped_array(self, config: Timepix3Configurations):
+        if config.mode == EVENT_4DRAW and self.sparse is not None:
+            return self.sparse.get_preview()
         shape = config.get_array_shape()
         return self.data.reshape(shape)
 
@@ -210,6 +237,11 @@ class TimePix3():
         self.__spimData = None
         self.__detector_config = Timepix3Configurations()
         self.__data_manager = Timepix3DataManager()
+        self.__receiver = tp3stream.JsonImageReceiver()
+        self.__accumulator = tp3accumulate.AccumulationEngine()
+        self.__pipeline = tp3stream.EventStreamPipeline()
+        self.__virtual_detectors = tp3virtual.VirtualDetectorEngine()
+        self.__frame_accumulator = frame_accumulation.FrameAccumulator()
 
         self.__frame_based = False
         self.__isPlaying = False
@@ -600,6 +632,7 @@ class TimePix3():
         self.__detector_config.bin = True if displaymode == '1d' else False
         self.__detector_config.mode = 10 if self.__frame_based else 0
         self.__detector_config.cumul = bool(accumulate)
+        self.__frame_accumulator.reset()
         if self.__port == 3:
             self.__detector_config.mode = 8
         self.__detector_config.bytedepth = 4
@@ -977,6 +1010,28 @@ class TimePix3():
     def getTp3Modes(self):
         return ['Standard', 'Coincidence', 'Raw 4D Image']
 
+    def set_energy_roi(self, start: int = 0, end: int = SPIM_SIZE, binning: int = 1):
+        """
+        Energy channels [start, end) kept in the event hyperspec modes, summed by groups of binning channels. Takes
+        effect at the next StartSpimFromScan. The default is the whole spectrum.
+        """
+        window = tp3accumulate.EnergyWindow(SPIM_SIZE, start, end, binning)
+        self.__detector_config.energy_start = window.start
+        self.__detector_config.energy_end = window.end
+        self.__detector_config.energy_binning = window.binning
+        logging.info(f'***TP3***: Energy ROI is [{window.start}, {window.end}) binned by {window.binning}. '
+                     f'Spectra have {window.channels} channels.')
+
+    def get_energy_roi(self):
+        window = self.__detector_config.get_energy_window()
+        return window.start, window.end, window.binning
+
+    def get_energy_calibration(self, dispersion: float, offset: float) -> (float, float):
+        window = self.__detector_config.get_energy_window()
+        if window.is_full:
+            return dispersion, offset
+        return window.get_calibration(float(dispersion), float(offset))
+
     @property
     def gaps_mode(self)-> int:
         return self.__gapsMode
@@ -1095,6 +1150,7 @@ class TimePix3():
 
         self.__dt = self.__detector_config.get_data_receive_type()
         self.__data = self.__data_manager.get_data(self.__detector_config)
+        self.__receiver.ensure_capacity(self.__detector_config.get_array_size(), self.__dt.itemsize)
         client.send(config_bytes)
 
         logging.info(f"Creating data type as {self.__dt} and array shape with {self.__data.shape} for the acquisition.")
@@ -1113,96 +1169,51 @@ class TimePix3():
         many bytes we collect within each loop interaction; frame_number is the frame counter and frame_time is when the
         whole frame began.
 
-        check string value is a convenient function to detect the values using the header standard format for jsonimage.
+        The header is parsed once by tp3stream.parse_header and the frame is received directly in the data array.
         """
 
         cam_properties = dict()
         inputs, outputs = self._prepare_for_acquisition()
 
-        def check_string_value(header, prop):
-            """
-            Check the value in the header dictionary. Some values are not number so a valueError
-            exception handles this.
-            """
-
-            start_index = header.index(prop)
-            end_index = start_index + len(prop)
-            begin_value = header.index(':', end_index, len(header)) + 1
-            if prop == 'height':
-                end_value = header.index('}', end_index, len(header))
-            else:
-                end_value = header.index(',', end_index, len(header))
-            try:
-                if prop == 'timeAtFrame':
-                    value = float(header[begin_value:end_value])
-                else:
-                    value = int(header[begin_value:end_value])
-            except ValueError:
-                value = str(header[begin_value:end_value])
-            return value
-
-        def check_data_and_send_message(cam_prop, frame):
+        def check_data_and_send_message(cam_prop, data_size):
             try:
                 assert int(cam_properties['width']) * int(
                     cam_properties['height']) * int(
                     cam_properties['bitDepth'] / 8) == int(cam_properties['dataSize'])
-                assert cam_properties['dataSize'] == len(frame)
+                assert cam_properties['dataSize'] == data_size
                 self.sendmessage(message)
                 return True
             except AssertionError:
                 logging.info(
-                    f'***TP3***: Problem in size/len assertion. Properties are {cam_properties} and data is {len(frame)}')
+                    f'***TP3***: Problem in size/len assertion. Properties are {cam_properties} and data is {data_size}')
                 return False
 
+        receiver = self.__receiver
+        receiver.attach(inputs[0])
+        itemsize = self.__dt.itemsize
+
         while True:
             try:
                 read, _, _ = select.select(inputs, outputs, inputs)
                 for s in read:
                     if s == inputs[0]:
-                        packet_data = s.recv(128)
-                        if packet_data == b'':
-                            logging.info("***TP3***: No data received. Closing connection.")
-                            self.stopTimepix3Measurement()
-                            return
-                        while (packet_data.find(b'{"time') == -1) or (packet_data.find(b'}\n') == -1):
-                            temp = s.recv(BUFFER_SIZE)
-                            if temp == b'':
-                                logging.info("***TP3***: No data received. Closing connection.")
-                                self.stopTimepix3Measurement()
-                                return
-                            else:
-                                packet_data += temp
-
-                        begin_header = packet_data.index(b'{"time')
-                        end_header = packet_data.index(b'}\n', begin_header)
-                        header = packet_data[begin_header:end_header + 1].decode('latin-1')
-
-                        for properties in ["timeAtFrame", "frameNumber", "measurementID", "dataSize", "bitDepth",
-                                           "width",
-                                           "height"]:
-                            cam_properties[properties] = (check_string_value(header, properties))
+                        cam_properties = receiver.receive_header()
 
                         data_size = int(cam_properties['dataSize'])
 
-                        assert (begin_header == 0)
-                        how_many_more_bytes = data_size + len(header) - len(packet_data) + 1
-                        while how_many_more_bytes != 0:
-                            bytes_to_receive = min(BUFFER_SIZE, how_many_more_bytes)
-                            packet_data += s.recv(bytes_to_receive)
-                            how_many_more_bytes = data_size + len(header) - len(packet_data) + 1
-
-                        frame_data = packet_data[end_header + 2:end_header + 2 + data_size]
-
-                        event_list = numpy.frombuffer(frame_data, dtype=self.__dt)
                         if message == 1 or message == 3:
-                            self.__data[:] = event_list[:]
-                            self.__frame = cam_properties['frameNumber']
-                            check_data_and_send_message(cam_properties, frame_data)
+                            #Payload lands directly in the array shared with the camera device
+                            if receiver.receive_into(self.__data, 0, data_size):
+                                self.__frame = cam_properties['frameNumber']
+                                self.__data_manager.correct_data_or_not(self.__gapsMode, self.__detector_config)
+                                check_data_and_send_message(cam_properties, data_size)
                         if message == 2:
                             start_channel = int(cam_properties['frameNumber']) * SPEC_SIZE #Spatial pixel * number of energy channels
                             number_of_channels = int((data_size * 8 / int(cam_properties['bitDepth'])))
                             extra_pixels = int(number_of_channels / SPEC_SIZE)
-                            self.__data[start_channel:start_channel + number_of_channels] = event_list[:]
+                            receiver.receive_into(self.__data, start_channel * itemsize, data_size)
+                            self.__data_manager.correct_data_or_not(self.__gapsMode, self.__detector_config,
+                                                                    start_channel, start_channel + number_of_channels)
                             #print(f'***TP3***: Acquiring hyperspecimage. Header is {header}. Start and number of channels is {start_channel} and {number_of_channels}. Number of pixels per call is {extra_pixels}.')
                             self.__frame = min(cam_properties['frameNumber'] + extra_pixels, self.__detector_config.xscan_size * self.__detector_config.yscan_size)
                             self.sendmessage(2)
@@ -1211,6 +1222,10 @@ class TimePix3():
                                 logging.info("***TP3***: Spim is over. Closing connection.")
                                 return
 
+            except tp3stream.StreamClosedError:
+                logging.info("***TP3***: No data received. Closing connection.")
+                self.stopTimepix3Measurement()
+                return
             except ConnectionResetError:
                 self.stopTimepix3Measurement()
                 logging.info("***TP3***: Socket reseted. Closing connection.")
@@ -1239,11 +1254,13 @@ class TimePix3():
         total_frames = self.getAccumulateNumber()
         start = time.time()
         logging.info(f'***TPX3***: Number of frames to be acquired is {total_frames}.')
+        self.__accumulator.reset()
 
         # If its a list scan, you should inform the value
         # TODO: random scan does not work here because we change the list after starting the sequence below.
         if scanInstrument.hardware_source_id == "open_scan_device":
-            array_to_send = scanInstrument.scan_device.scan_engine.get_ordered_array().astype('uint32')
+            array_to_send = numpy.ascontiguousarray(scanInstrument.scan_device.scan_engine.get_ordered_array(),
+                                                    dtype=numpy.uint32)
             inputs[0].sendall(array_to_send)
 
         try:
@@ -1254,48 +1271,66 @@ class TimePix3():
             self.stopTimepix3Measurement()
             return
 
-        while True:
-            try:
-                read, _, _ = select.select(inputs, outputs, inputs)
-                for s in read:
-                    packet_data = s.recv(BUFFER_SIZE)
-                    if len(packet_data) == 0:
-                        logging.info('***TP3***: No more packets received. Finishing SPIM.')
-                        self.stopTimepix3Measurement()
-                        return
-
-                    #Checking if its a multiple of 8 bytes (64 bit)
-                    q = len(packet_data) % 8
-                    if q:
-                        packet_data += s.recv(8 - q)
-
-                    try:
-                        event_list = numpy.frombuffer(packet_data, dtype=self.__dt)
-                        update_spim_numba(self.__data, event_list)
-                    except ValueError:
-                        logging.info(f'***TP3***: Value error.')
-                    except IndexError:
-                        logging.info(f'***TP3***: Indexing error.')
-
-            except ConnectionResetError:
-                logging.info("***TP3***: Socket reseted. Closing connection.")
-                self.stopTimepix3Measurement()
-                return
+        sparse = self.__data_manager.sparse
+        histogram = self.__data_manager.histogram
+        if sparse is not None: #Raw 4D events are stored through the virtual detectors
+            self.__virtual_detectors.configure(sparse.scan_shape, sparse.detector_shape, sparse)
+        window = self.__detector_config.get_energy_window()
+        if window.is_full or not self.__detector_config.is_event_hyperspec():
+            window = None
+
+        def decode(buffer):
+            event_list = numpy.frombuffer(buffer, dtype=self.__dt)
+            if window is not None:
+                event_list = window.apply(event_list)
+            if sparse is not None:
+                self.__virtual_detectors.add_events(event_list, self.__accumulator)
+            elif histogram is not None:
+                histogram.accumulate(event_list, self.__accumulator)
+            else:
+                self.__accumulator.accumulate(self.__data, event_list)
 
-            if not self.__isPlaying or not scanInstrument.is_playing:
-                self.stopTimepix3Measurement()
-                logging.info('***TP3***: Scanning is halted. Finishing SPIM.')
-                return
-            read_frames = scanInstrument.get_sequence_buffer_count()
-            if time.time() - start > 5.0:
-                start = time.time()
-                logging.info(f'***TP3***: Number of scans performed is {read_frames} out of {total_frames}.')
-            if read_frames >= total_frames:
-                self.stopTimepix3Measurement()
-                scanInstrument.stop_playing()
-                logging.info('***TP3***: Buffer complete. Halting scan.')
-                return
-        return
+        #Socket is drained by the pipeline reader thread. This thread only follows the scan.
+        self.__pipeline.start(inputs[0], decode)
+        try:
+            while True:
+                if self.__pipeline.finished.wait(MONITOR_PERIOD):
+                    logging.info('***TP3***: No more packets received. Finishing SPIM.')
+                    self.stopTimepix3Measurement()
+                    return
+
+                if not self.__isPlaying or not scanInstrument.is_playing:
+                    self.stopTimepix3Measurement()
+                    logging.info('***TP3***: Scanning is halted. Finishing SPIM.')
+                    return
+                read_frames = scanInstrument.get_sequence_buffer_count()
+                if time.time() - start > 5.0:
+                    start = time.time()
+                    logging.info(f'***TP3***: Number of scans performed is {read_frames} out of {total_frames}.')
+                    logging.info(f'***TP3***: Histogramming {self.__accumulator.events_per_second:.3g} events/s. '
+                                 f'Events per backend: {self.__accumulator.usage}.')
+                    logging.info(f'***TP3***: Stream counters: {self.__pipeline.counters}.')
+                    if window is not None:
+                        logging.info(f'***TP3***: Energy ROI kept {window.kept_events} events and dropped '
+                                     f'{window.dropped_events}.')
+                    if histogram is not None and histogram.number_of_tiles:
+                        logging.info(f'***TP3***: {histogram.number_of_tiles} histogram tiles promoted. '
+                                     f'Histogram uses {histogram.memory_bytes / 1e9:.2f} GB.')
+                    if sparse is not None:
+                        logging.info(f'***TP3***: Sparse 4D store has {sparse.number_of_events} events in '
+                                     f'{sparse.memory_bytes / 1e9:.2f} GB. Dropped events: {sparse.dropped_events}.')
+                if read_frames >= total_frames:
+                    self.stopTimepix3Measurement()
+                    scanInstrument.stop_playing()
+                    logging.info('***TP3***: Buffer complete. Halting scan.')
+                    return
+        finally:
+            self.__pipeline.stop()
+            counters = self.__pipeline.counters
+            logging.info(f'***TP3***: Stream counters: {counters}.')
+            if counters['dropped_buffers']:
+                logging.info(f'***TP3***: {counters["dropped_bytes"]} bytes in {counters["dropped_buffers"]} buffers '
+                             f'were dropped. The SPIM misses these events.')
 
     def acquire_4dstreamed_frame_from_scan_frame(self):
         """
@@ -1319,7 +1354,8 @@ class TimePix3():
         # If its a list scan, you should inform the value
         # TODO: random scan does not work here because we change the list after starting the sequence below.
         if scanInstrument.hardware_source_id == "open_scan_device":
-            array_to_send = scanInstrument.scan_device.scan_engine.get_ordered_array().astype('uint32')
+            array_to_send = numpy.ascontiguousarray(scanInstrument.scan_device.scan_engine.get_ordered_array(),
+                                                    dtype=numpy.uint32)
             inputs[0].sendall(array_to_send)
 
         try:
@@ -1330,49 +1366,75 @@ class TimePix3():
             self.stopTimepix3Measurement()
             return
 
-        while True:
-            try:
-                read, _, _ = select.select(inputs, outputs, inputs)
-                for s in read:
-                    packet_data = s.recv(BUFFER_SIZE)
-
-                    if len(packet_data) == 0:
-                        logging.info('***TP3***: No more packets received. Finishing SPIM.')
-                        return
-
-                    how_many_more_bytes = self.__detector_config.xscan_size * \
-                                          self.__detector_config.yscan_size * \
-                                          NUMBER_OF_MASKS * 2 - len(packet_data)
-                    while how_many_more_bytes != 0:
-                        bytes_to_receive = min(BUFFER_SIZE, how_many_more_bytes)
-                        packet_data += s.recv(bytes_to_receive)
-                        how_many_more_bytes = self.__detector_config.xscan_size * \
-                                              self.__detector_config.yscan_size * \
-                                              NUMBER_OF_MASKS * 2 - len(packet_data)
-                    try:
-                        event_list = numpy.frombuffer(packet_data, dtype=dt)
-                        self.__data[:] = event_list[:]
-                    except ValueError:
-                        logging.info(f'***TP3***: Value error.')
-                    except IndexError:
-                        logging.info(f'***TP3***: Indexing error.')
+        #Masked frames are written in place as they arrive. A new frame starts over at the beginning of the array.
+        #A dropped buffer would shift every later frame, so the stream is lossless and the socket pushes back instead.
+        frame_bytes = self.__data.reshape(-1).view(numpy.uint8)
+        offset = 0
+
+        def decode(buffer):
+            nonlocal offset
+            pos = 0
+            while pos < len(buffer):
+                nbytes = min(len(buffer) - pos, frame_bytes.size - offset)
+                frame_bytes[offset:offset + nbytes] = numpy.frombuffer(buffer[pos:pos + nbytes], dtype=numpy.uint8)
+                pos += nbytes
+                offset = (offset + nbytes) % frame_bytes.size
+
+        self.__pipeline.start(inputs[0], decode, lossless=True)
+        try:
+            while True:
+                if self.__pipeline.finished.wait(MONITOR_PERIOD):
+                    logging.info('***TP3***: No more packets received. Finishing SPIM.')
+                    return
+
+                if not self.__isPlaying or not scanInstrument.is_playing:
+                    self.stopTimepix3Measurement()
+                    logging.info('***TP3***: Scanning is halted. Finishing SPIM.')
+                    return
+        finally:
+            self.__pipeline.stop()
+            logging.info(f'***TP3***: Stream counters: {self.__pipeline.counters}.')
 
-            except ConnectionResetError:
-                logging.info("***TP3***: Socket reseted. Closing connection.")
-                return
+    def update_spim(self, event_list):
+        if self.__data_manager.histogram is not None:
+            self.__data_manager.histogram.accumulate(event_list, self.__accumulator)
+        else:
+            self.__accumulator.accumulate(self.__data, event_list)
 
-            if not self.__isPlaying or not scanInstrument.is_playing:
-                self.stopTimepix3Measurement()
-                logging.info('***TP3***: Scanning is halted. Finishing SPIM.')
-                return
-        return
+    @property
+    def accumulation_engine(self) -> tp3accumulate.AccumulationEngine:
+        return self.__accumulator
 
-    def update_spim(self, event_list):
-        unique, counts = numpy.unique(event_list, return_counts=True)
-        counts = counts.astype(numpy.uint32)
-        self.__data[unique] += counts
+    @property
+    def stream_counters(self) -> dict:
+        return self.__pipeline.counters
+
+    @property
+    def frame_counters(self) -> dict:
+        """
+        Counters of the jsonimage modes since the last acquisition started. last_header is the last frame header.
+        """
+        return {'frames_received': self.__receiver.frames_received, 'bytes_received': self.__receiver.bytes_received,
+                'last_header': dict(self.__receiver.last_header)}
+
+    @property
+    def sparse_4d(self) -> tp3sparse.SparseEventStore:
+        """
+        Event list of the last EVENT_4DRAW acquisition. None for the other modes.
+        """
+        return self.__data_manager.sparse
+
+    @property
+    def virtual_detectors(self) -> tp3virtual.VirtualDetectorEngine:
+        return self.__virtual_detectors
 
     def get_current(self, frame_int, frame_number):
+        """
+        The frame is also counted by the frame accumulator. With its statistics, the counts come out of the same pass
+        over the frame, and in Cumul the current is averaged over the frames accumulated. Otherwise the frame is summed.
+        """
+        if self.__frame_accumulator.add(frame_int, self.__detector_config.cumul) is not None:
+            return self.__frame_accumulator.get_current(self.__expTime, average=self.__detector_config.cumul)
         if self.__detector_config.cumul and frame_number:
             eps = (numpy.sum(frame_int) / self.__expTime) / frame_number
         else:
@@ -1380,12 +1442,28 @@ class TimePix3():
         cur_pa = eps / (6.242 * 1e18) * 1e12
         return cur_pa
 
+    @property
+    def frame_accumulator(self) -> frame_accumulation.FrameAccumulator:
+        return self.__frame_accumulator
+
     def create_specimage(self):
-        self.__data_manager.correct_data_or_not(self.__gapsMode, self.__detector_config)
         return self.__data_manager.create_reshaped_array(self.__detector_config)
 
     def create_spimimage(self):
-        return self.__data_manager.create_reshaped_array(self.__detector_config)
+        """
+        Cube of the SPIM modes, as read by the TPX3 scan channel and the Event Hyperspec acquisition. Once bins of the
+        event hyperspec histogram saturate, the exact counts are returned instead, in an array kept between calls.
+        With gaps_mode set and the full energy window, the gaps of the event hyperspec cube are interpolated in that
+        array, never in the histogram that is still being accumulated.
+        """
+        histogram = self.__data_manager.histogram
+        if histogram is None:
+            return self.__data_manager.create_reshaped_array(self.__detector_config)
+        shape = self.__detector_config.get_array_shape()
+        if self.__gapsMode == tp3gaps.INTERPOLATE and self.__detector_config.get_energy_window().is_full:
+            #Only the tiles with new events are refreshed, and the gaps are recomputed from their raw neighbours
+            return tp3gaps.correct_gaps(histogram.get_counts(copy=True).reshape(shape))
+        return histogram.get_counts().reshape(shape)
 
     def get_frame(self):
         return self.__frame
@@ -0,0 +1,32 @@
+import functools, numpy
+
+CHIP_WIDTH = 256 #Columns of one chip. The last column of a chip and the first of the next one form a gap
+INTERPOLATE = 1 #gaps_mode that interpolates the gaps
+
+
+@functools.lru_cache(maxsize=16)
+def gap_columns(length: int, chip_width: int = CHIP_WIDTH) -> numpy.ndarray:
+    """
+    First column of every gap along an axis of length columns, so 255, 511 and 767 for a four-chip detector. Gaps
+    without a column on both sides, like the one at the end of a single chip, are left out.
+    """
+    columns = numpy.arange(chip_width - 1, length - 2, chip_width)
+    columns.flags.writeable = False
+    return columns
+
+
+def correct_gaps(data: numpy.ndarray, chip_width: int = CHIP_WIDTH) -> numpy.ndarray:
+    """
+    Interpolates, in place, the two columns of every gap along the last axis from the column before and the column after
+    the gap. The last axis is the energy axis, so the same call does a binned frame, a 2D frame, a chrono or a spectrum
+    image cube. Every gap of every spectrum is done in a single gather and scatter.
+    """
+    columns = gap_columns(data.shape[-1], chip_width)
+    if columns.size == 0:
+        return data
+    dtype = numpy.result_type(data.dtype, numpy.float32)
+    before = data[..., columns - 1].astype(dtype)
+    after = data[..., columns + 2].astype(dtype)
+    data[..., columns] = (2 * before + after) / 3.0
+    data[..., columns + 1] = (2 * after + before) / 3.0
+    return data
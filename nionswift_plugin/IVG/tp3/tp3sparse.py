@@ -0,0 +1,182 @@
+import logging, threading, numpy
+
+from . import tp3accumulate
+from ...aux_files import read_data
+
+RAW4D_PIXELS_X = 512
+RAW4D_PIXELS_Y = 512
+CHUNK_EVENTS = 1 << 24 #128 MB of uint64 events per chunk
+MEMORY_BUDGET = 8 * (1 << 30) #Bytes kept for the event list, unless SPARSE_4D_BUDGET_GB is set in global_settings
+PREVIEW_BUDGET = 512 * (1 << 20) #Bytes kept for the binned live preview
+
+
+def get_memory_budget() -> int:
+    """
+    Bytes kept for the event list, from the SPARSE_4D_BUDGET_GB entry of the memory section of global_settings.
+    """
+    budget = read_data.get_global_setting("memory", "SPARSE_4D_BUDGET_GB", None)
+    return MEMORY_BUDGET if budget is None else int(float(budget) * (1 << 30))
+
+
+class SparseEventStore:
+    """
+    Sparse 4D-STEM container for EVENT_4DRAW acquisitions. Events are the raw uint64 indices sent by the detector,
+    probe_index * detector_size + detector_y * detector_x_size + detector_x, and are kept as they arrive in chunks of
+    CHUNK_EVENTS. Each chunk remembers the range of probe positions it contains, so a single probe position can be
+    densified without reading the whole list.
+
+    Memory is bounded by memory_budget, read from global_settings if not given. Once it is reached, new events are
+    counted in dropped_events and discarded. A dense live preview is kept with the detector binned by a power of two so
+    that it fits preview_budget. Its bins saturate instead of wrapping around.
+    """
+
+    def __init__(self, yspim_size: int, xspim_size: int, detector_shape: (int, int) = (RAW4D_PIXELS_Y, RAW4D_PIXELS_X),
+                 memory_budget: int = None, preview_budget: int = PREVIEW_BUDGET):
+        memory_budget = get_memory_budget() if memory_budget is None else memory_budget
+        self.scan_shape = (yspim_size, xspim_size)
+        self.detector_shape = detector_shape
+        self.number_of_probes = yspim_size * xspim_size
+        self.detector_size = detector_shape[0] * detector_shape[1]
+        self.max_events = memory_budget // numpy.dtype(numpy.uint64).itemsize
+        self.total_events = 0
+        self.dropped_events = 0
+        self.__stored_events = 0
+        self.__lock = threading.Lock()
+        self.__chunks = list()
+        self.__chunk_ranges = list()
+        self.__current = numpy.zeros(0, dtype=numpy.uint64)
+        self.__filled = 0
+        self.__current_range = [self.number_of_probes, -1]
+
+        binning = 1
+        while self.number_of_probes * (detector_shape[0] // binning) * (detector_shape[1] // binning) * 2 > \
+                preview_budget and binning < min(detector_shape):
+            binning *= 2
+        self.preview_binning = binning
+        self.preview_shape = (yspim_size, xspim_size, detector_shape[0] // binning, detector_shape[1] // binning)
+        self.preview = numpy.zeros(int(numpy.prod(self.preview_shape)), dtype=numpy.uint16)
+        self.__preview_histogram = tp3accumulate.OverflowHistogram(self.preview)
+        logging.info(f'***TP3***: Sparse 4D store for {self.scan_shape} probes. Budget is {self.max_events} events '
+                     f'and the live preview is binned by {binning} with shape {self.preview_shape}.')
+
+    @property
+    def number_of_events(self) -> int:
+        return self.__stored_events
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        Allocated memory, including the preview and the chunk being filled.
+        """
+        allocated = sum(chunk.nbytes for chunk in self.__chunks) + self.__current.nbytes
+        return allocated + self.__preview_histogram.memory_bytes
+
+    def split_events(self, event_list: numpy.ndarray):
+        """
+        Returns probe index, detector y and detector x of each event.
+        """
+        event_list = event_list.astype(numpy.uint64, copy=False)
+        probe = event_list // numpy.uint64(self.detector_size)
+        detector = event_list % numpy.uint64(self.detector_size)
+        return probe, detector // numpy.uint64(self.detector_shape[1]), detector % numpy.uint64(self.detector_shape[1])
+
+    def add_events(self, event_list: numpy.ndarray, accumulator: tp3accumulate.AccumulationEngine = None):
+        event_list = event_list[event_list < self.number_of_probes * self.detector_size]
+        if event_list.size == 0:
+            return
+        probe, y, x = self.split_events(event_list)
+        binning = numpy.uint64(self.preview_binning)
+        preview_events = ((probe * numpy.uint64(self.preview_shape[2]) + y // binning) *
+                          numpy.uint64(self.preview_shape[3]) + x // binning).astype(numpy.int64)
+        self.__preview_histogram.accumulate(preview_events, accumulator)
+
+        with self.__lock:
+            self.total_events += event_list.size
+            room = self.max_events - self.number_of_events
+            if room < event_list.size:
+                self.dropped_events += event_list.size - max(room, 0)
+                event_list = event_list[:max(room, 0)]
+                probe = probe[:max(room, 0)]
+            pos = 0
+            while pos < event_list.size:
+                if self.__filled == self.__current.size:
+                    self.__close_chunk()
+                    self.__current = numpy.empty(min(CHUNK_EVENTS, self.max_events - self.number_of_events),
+                                                 dtype=numpy.uint64)
+                count = min(event_list.size - pos, self.__current.size - self.__filled)
+                self.__current[self.__filled:self.__filled + count] = event_list[pos:pos + count]
+                self.__current_range[0] = min(self.__current_range[0], int(probe[pos:pos + count].min()))
+                self.__current_range[1] = max(self.__current_range[1], int(probe[pos:pos + count].max()))
+                self.__filled += count
+                self.__stored_events += count
+                pos += count
+
+    def __close_chunk(self):
+        if self.__filled:
+            self.__chunks.append(self.__current[:self.__filled])
+            self.__chunk_ranges.append(tuple(self.__current_range))
+        self.__current = numpy.zeros(0, dtype=numpy.uint64)
+        self.__filled = 0
+        self.__current_range = [self.number_of_probes, -1]
+
+    def iterate_events(self, first_probe: int = 0, last_probe: int = None):
+        """
+        Yields the stored event chunks that may contain probes between first_probe and last_probe (inclusive).
+        """
+        last_probe = self.number_of_probes - 1 if last_probe is None else last_probe
+        with self.__lock:
+            chunks = list(zip(self.__chunks, self.__chunk_ranges))
+            if self.__filled:
+                chunks.append((self.__current[:self.__filled], tuple(self.__current_range)))
+        for chunk, (low, high) in chunks:
+            if high >= first_probe and low <= last_probe:
+                yield chunk
+
+    def iterate_range(self, start: int, stop: int):
+        """
+        Yields the stored events with indices in [start, stop), in the order they were stored, as views of the chunks.
+        Events below number_of_events are never moved or changed, so they can be read while new ones are added.
+        """
+        with self.__lock:
+            chunks = list(self.__chunks)
+            if self.__filled:
+                chunks.append(self.__current[:self.__filled])
+        position = 0
+        for chunk in chunks:
+            low, high = max(start - position, 0), min(stop - position, chunk.size)
+            if low < high:
+                yield chunk[low:high]
+            position += chunk.size
+            if position >= stop:
+                return
+
+    def get_diffraction(self, y: int, x: int) -> numpy.ndarray:
+        """
+        Densifies the diffraction pattern of a single probe position.
+        """
+        probe_index = y * self.scan_shape[1] + x
+        pattern = numpy.zeros(self.detector_size, dtype=numpy.uint32)
+        low = numpy.uint64(probe_index * self.detector_size)
+        high = numpy.uint64((probe_index + 1) * self.detector_size)
+        for chunk in self.iterate_events(probe_index, probe_index):
+            selected = chunk[(chunk >= low) & (chunk < high)] - low
+            pattern += numpy.bincount(selected.astype(numpy.int64), minlength=self.detector_size).astype(numpy.uint32)
+        return pattern.reshape(self.detector_shape)
+
+    def integrate(self, mask: numpy.ndarray, start: int = 0, stop: int = None) -> numpy.ndarray:
+        """
+        Virtual detector image of the stored events with indices in [start, stop), all of them by default. mask has the
+        detector shape and weights each detector pixel.
+        """
+        weights = numpy.asarray(mask, dtype=numpy.float32).reshape(-1)
+        image = numpy.zeros(self.number_of_probes, dtype=numpy.float64)
+        stop = self.number_of_events if stop is None else stop
+        for chunk in self.iterate_range(start, stop):
+            probe = chunk // numpy.uint64(self.detector_size)
+            detector = chunk % numpy.uint64(self.detector_size)
+            image += numpy.bincount(probe.astype(numpy.int64), weights=weights[detector.astype(numpy.int64)],
+                                    minlength=self.number_of_probes)
+        return image.reshape(self.scan_shape)
+
+    def get_preview(self) -> numpy.ndarray:
+        return self.preview.reshape(self.preview_shape)
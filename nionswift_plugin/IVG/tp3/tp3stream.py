@@ -0,0 +1,312 @@
+import logging, socket, re, threading, time, queue, numpy
+
+HEADER_BUFFER_SIZE = 512
+HEADER_START = b'{"time'
+HEADER_END = b'}\n'
+HEADER_PATTERN = re.compile(rb'"(\w+)"\s*:\s*("[^"]*"|[^,}]*)')
+
+PIPELINE_BUFFER_SIZE = 1 << 20
+PIPELINE_NUMBER_OF_BUFFERS = 64
+EVENT_ALIGNMENT = 8
+SOCKET_TIMEOUT = 0.1
+
+
+class StreamClosedError(Exception):
+    pass
+
+
+def parse_header(header) -> dict:
+    """
+    Parses a jsonimage header in a single pass over its bytes. Numbers are converted to int or float and anything else
+    (as measurementID, which is not valid json) is kept as a string.
+    """
+    properties = dict()
+    for key, value in HEADER_PATTERN.findall(header):
+        value = value.strip()
+        try:
+            properties[key.decode()] = int(value)
+        except ValueError:
+            try:
+                properties[key.decode()] = float(value)
+            except ValueError:
+                properties[key.decode()] = value.strip(b'"').decode('latin-1')
+    return properties
+
+
+class JsonImageReceiver:
+    """
+    Receives the jsonimage stream (a json header terminated by '}\n' followed by dataSize bytes) without building
+    intermediate bytes objects.
+
+    The header is peeked with MSG_PEEK and only its own bytes are consumed, so the payload that follows is left in the
+    kernel buffer and lands directly in the destination array through recv_into. The header buffer and the scratch
+    buffer used for frames that do not fit the destination are allocated once and reused across acquisitions.
+    """
+
+    def __init__(self, array_size: int = 0, bytedepth: int = 4):
+        self.__header_buffer = bytearray(HEADER_BUFFER_SIZE)
+        self.__header_view = memoryview(self.__header_buffer)
+        self.__scratch = numpy.zeros(0, dtype=numpy.uint8)
+        self.__socket = None
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.last_header = dict()
+        self.ensure_capacity(array_size, bytedepth)
+
+    def ensure_capacity(self, array_size: int, bytedepth: int):
+        """
+        Makes sure the scratch buffer can hold a whole frame. It only grows, so switching between modes does not
+        trigger new allocations.
+        """
+        nbytes = int(array_size) * int(bytedepth)
+        if nbytes > self.__scratch.size:
+            self.__scratch = numpy.zeros(nbytes, dtype=numpy.uint8)
+
+    def attach(self, sock: socket.socket):
+        self.__socket = sock
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    def receive_header(self) -> dict:
+        """
+        Returns the parsed header. Only the header bytes are removed from the socket.
+        """
+        sock = self.__socket
+        view = self.__header_view
+        filled = 0
+        while True:
+            if filled >= HEADER_BUFFER_SIZE:
+                raise ValueError(f'***TP3***: Header larger than {HEADER_BUFFER_SIZE} bytes.')
+            peeked = sock.recv_into(view[filled:], HEADER_BUFFER_SIZE - filled, socket.MSG_PEEK)
+            if peeked == 0:
+                raise StreamClosedError
+            # The terminator can start on the last byte already consumed
+            search_from = max(filled - 1, 0)
+            end = self.__header_buffer.find(HEADER_END, search_from, filled + peeked)
+            if end == -1:
+                consumed = peeked
+            else:
+                consumed = end + len(HEADER_END) - filled
+            self.__recv_exactly(view[filled:filled + consumed])
+            filled += consumed
+            if end != -1:
+                break
+        begin = self.__header_buffer.find(HEADER_START, 0, filled)
+        if begin == -1:
+            raise ValueError(f'***TP3***: Could not find the start of the header in {bytes(view[:filled])}.')
+        self.last_header = parse_header(view[begin:filled - 1])
+        return self.last_header
+
+    def receive_into(self, destination: numpy.ndarray, offset: int, nbytes: int) -> bool:
+        """
+        Receives nbytes of payload at the byte offset of destination. If the payload does not fit in destination, it
+        is drained into the scratch buffer and False is returned.
+        """
+        target = destination.reshape(-1).view(numpy.uint8)
+        if offset < 0 or offset + nbytes > target.size:
+            self.ensure_capacity(nbytes, 1)
+            self.__recv_exactly(memoryview(self.__scratch)[:nbytes])
+            logging.info(f'***TP3***: Payload of {nbytes} bytes at offset {offset} does not fit the data array of '
+                         f'{target.size} bytes. Frame discarded.')
+            return False
+        self.__recv_exactly(memoryview(target)[offset:offset + nbytes])
+        self.frames_received += 1
+        return True
+
+    def __recv_exactly(self, view: memoryview):
+        sock = self.__socket
+        total = len(view)
+        received = 0
+        while received < total:
+            nbytes = sock.recv_into(view[received:], total - received)
+            if nbytes == 0:
+                raise StreamClosedError
+            received += nbytes
+        self.bytes_received += total
+
+
+class EventStreamPipeline:
+    """
+    Separates network reception from decoding. A reader thread drains the socket with recv_into into a pool of
+    preallocated buffers and hands them to a decode thread through a bounded queue. When the decoder falls behind and
+    the pool is empty, the reader keeps draining the socket into a discard buffer and counts the buffer and its bytes as
+    dropped, so a slow histogram or GUI refresh never backs up the detector link.
+
+    Streams whose position in the data matters, as masked frames written at a rolling offset, are started lossless. The
+    reader then waits for a free buffer instead, and the socket pushes back on the detector.
+
+    Buffers always hold a whole number of events (multiple of alignment bytes). The memoryview given to decode is only
+    valid during the call.
+    """
+
+    def __init__(self, buffer_size: int = PIPELINE_BUFFER_SIZE, number_of_buffers: int = PIPELINE_NUMBER_OF_BUFFERS,
+                 alignment: int = EVENT_ALIGNMENT):
+        self.__alignment = alignment
+        self.__buffer_size = buffer_size - buffer_size % alignment
+        self.__buffers = [bytearray(self.__buffer_size) for _ in range(number_of_buffers)]
+        self.__discard = bytearray(self.__buffer_size)
+        self.__free = queue.Queue()
+        self.__filled = queue.Queue()
+        self.__stop = threading.Event()
+        self.finished = threading.Event()
+        self.__reader_thread = None
+        self.__decoder_thread = None
+        self.__lossless = False
+        self.__lock = threading.Lock()
+        self.__reset_counters()
+
+    def __reset_counters(self):
+        self.__counters = {'buffers_received': 0, 'buffers_decoded': 0, 'dropped_buffers': 0, 'dropped_bytes': 0,
+                           'bytes_received': 0,
+                           'max_queue_depth': 0, 'receive_time': 0.0, 'queue_time': 0.0, 'max_queue_time': 0.0,
+                           'decode_time': 0.0}
+
+    @property
+    def counters(self) -> dict:
+        """
+        Queue depth, dropped buffers and per-stage latency. Times are in milliseconds.
+        """
+        with self.__lock:
+            c = dict(self.__counters)
+        received = max(c['buffers_received'], 1)
+        decoded = max(c['buffers_decoded'], 1)
+        return {'queue_depth': self.__filled.qsize(), 'max_queue_depth': c['max_queue_depth'],
+                'buffers_received': c['buffers_received'], 'buffers_decoded': c['buffers_decoded'],
+                'dropped_buffers': c['dropped_buffers'], 'dropped_bytes': c['dropped_bytes'],
+                'bytes_received': c['bytes_received'],
+                'mean_receive_ms': c['receive_time'] / received * 1e3,
+                'mean_queue_ms': c['queue_time'] / decoded * 1e3, 'max_queue_ms': c['max_queue_time'] * 1e3,
+                'mean_decode_ms': c['decode_time'] / decoded * 1e3}
+
+    @property
+    def is_running(self) -> bool:
+        return self.__reader_thread is not None and not self.finished.is_set()
+
+    def start(self, sock: socket.socket, decode, lossless: bool = False):
+        """
+        Starts the reader and decode threads. decode is called with a memoryview of every received buffer. If lossless,
+        no buffer is ever dropped.
+        """
+        self.stop()
+        self.__lossless = lossless
+        self.__reset_counters()
+        while not self.__filled.empty():
+            self.__filled.get_nowait()
+        while not self.__free.empty():
+            self.__free.get_nowait()
+        for index in range(len(self.__buffers)):
+            self.__free.put(index)
+        self.__stop.clear()
+        self.finished.clear()
+        sock.settimeout(SOCKET_TIMEOUT)
+        self.__reader_thread = threading.Thread(target=self.__reader, args=(sock,))
+        self.__decoder_thread = threading.Thread(target=self.__decoder, args=(decode,))
+        self.__decoder_thread.start()
+        self.__reader_thread.start()
+
+    def stop(self):
+        """
+        Stops reception and waits for the buffers already received to be decoded.
+        """
+        self.__stop.set()
+        if self.__reader_thread is not None:
+            self.__reader_thread.join()
+            self.__decoder_thread.join()
+            self.__reader_thread = None
+            self.__decoder_thread = None
+
+    def __recv_aligned(self, sock, view) -> int:
+        """
+        Receives at least one byte in view and completes the buffer up to a multiple of the alignment. Returns 0 when
+        the connection is closed and -1 on timeout.
+        """
+        try:
+            nbytes = sock.recv_into(view)
+        except socket.timeout:
+            return -1
+        if nbytes == 0:
+            return 0
+        while nbytes % self.__alignment:
+            try:
+                more = sock.recv_into(view[nbytes:], self.__alignment - nbytes % self.__alignment)
+            except socket.timeout:
+                if self.__stop.is_set():
+                    break
+                continue
+            if more == 0:
+                break
+            nbytes += more
+        return nbytes
+
+    def __get_free_buffer(self):
+        """
+        Index of a free buffer, or None if the received bytes must be discarded. Lossless streams wait for the decoder
+        and return None only once stopped.
+        """
+        if not self.__lossless:
+            try:
+                return self.__free.get_nowait()
+            except queue.Empty:
+                return None
+        while not self.__stop.is_set():
+            try:
+                return self.__free.get(timeout=SOCKET_TIMEOUT)
+            except queue.Empty:
+                continue
+        return None
+
+    def __reader(self, sock):
+        try:
+            while not self.__stop.is_set():
+                index = self.__get_free_buffer()
+                if index is None and self.__lossless:
+                    break
+                view = memoryview(self.__discard if index is None else self.__buffers[index])
+                start = time.perf_counter()
+                nbytes = self.__recv_aligned(sock, view)
+                if nbytes == -1:
+                    if index is not None:
+                        self.__free.put(index)
+                    continue
+                if nbytes == 0:
+                    if index is not None:
+                        self.__free.put(index)
+                    logging.info('***TP3***: No more packets received. Finishing the stream.')
+                    break
+                received_at = time.perf_counter()
+                with self.__lock:
+                    self.__counters['buffers_received'] += 1
+                    self.__counters['bytes_received'] += nbytes
+                    self.__counters['receive_time'] += received_at - start
+                    if index is None:
+                        self.__counters['dropped_buffers'] += 1
+                        self.__counters['dropped_bytes'] += nbytes
+                    else:
+                        self.__counters['max_queue_depth'] = max(self.__counters['max_queue_depth'],
+                                                                 self.__filled.qsize() + 1)
+                if index is not None:
+                    self.__filled.put((index, nbytes, received_at))
+        except (ConnectionResetError, OSError):
+            logging.info("***TP3***: Socket reseted. Closing connection.")
+        finally:
+            self.__filled.put(None)
+            self.finished.set()
+
+    def __decoder(self, decode):
+        while True:
+            item = self.__filled.get()
+            if item is None:
+                return
+            index, nbytes, received_at = item
+            start = time.perf_counter()
+            try:
+                decode(memoryview(self.__buffers[index])[:nbytes])
+            except (ValueError, IndexError) as e:
+                logging.info(f'***TP3***: Could not decode buffer: {e}.')
+            end = time.perf_counter()
+            self.__free.put(index)
+            with self.__lock:
+                self.__counters['buffers_decoded'] += 1
+                self.__counters['queue_time'] += start - received_at
+                self.__counters['max_queue_time'] = max(self.__counters['max_queue_time'], start - received_at)
+                self.__counters['decode_time'] += end - start
@@ -0,0 +1,208 @@
+import logging, threading, numpy
+from numba import jit
+
+from . import tp3sparse
+
+RAW4D_PIXELS_X = 512
+RAW4D_PIXELS_Y = 512
+BF_RADIUS_FRACTION = 1 / 16 #Default bright field radius, in units of the detector size
+ADF_RADII = (2.0, 4.0) #Default annular dark field, in units of the bright field radius
+
+
+@jit(nopython=True)
+def apply_detectors_numba(images, counts, weights, event_list, detector_size):
+    """
+    Sparse dot product of one event batch with every mask. weights is (detector_size, number_of_detectors), so the
+    weights of a single detector pixel are contiguous. images is float64, so long acquisitions keep adding single
+    counts exactly.
+    """
+    number_of_probes = counts.size
+    number_of_detectors = weights.shape[1]
+    for val in event_list:
+        probe = val // detector_size
+        if probe < number_of_probes:
+            pixel = val % detector_size
+            counts[probe] += 1
+            for detector in range(number_of_detectors):
+                images[probe, detector] += weights[pixel, detector]
+
+
+def detector_coordinates(detector_shape: (int, int), center: (float, float)):
+    """
+    Distances to center along y and x for every detector pixel.
+    """
+    y, x = numpy.indices(detector_shape, dtype=numpy.float32)
+    return y - center[0], x - center[1]
+
+
+def _ellipse_distance(y: numpy.ndarray, x: numpy.ndarray, radius) -> numpy.ndarray:
+    ry, rx = (radius, radius) if numpy.isscalar(radius) else radius
+    if ry <= 0 or rx <= 0:
+        return numpy.full(y.shape, numpy.inf, dtype=numpy.float32)
+    return (y / ry) ** 2 + (x / rx) ** 2
+
+
+def create_annular_mask(detector_shape: (int, int), center: (float, float), inner_radius=0.0,
+                        outer_radius=None) -> numpy.ndarray:
+    """
+    Ones between inner_radius and outer_radius. Radii are either a number or (radius_y, radius_x) for elliptical masks.
+    inner_radius of 0 gives a disk and outer_radius of None extends the mask to the detector edges.
+    """
+    y, x = detector_coordinates(detector_shape, center)
+    mask = _ellipse_distance(y, x, inner_radius) >= 1
+    if outer_radius is not None:
+        mask &= _ellipse_distance(y, x, outer_radius) < 1
+    return mask.astype(numpy.float32)
+
+
+def create_segmented_mask(detector_shape: (int, int), center: (float, float), inner_radius, outer_radius,
+                          number_of_segments: int, segment: int, rotation: float = 0.0) -> numpy.ndarray:
+    """
+    One angular segment of an annular detector. Segments are counted counterclockwise from rotation (in radians).
+    """
+    y, x = detector_coordinates(detector_shape, center)
+    angle = numpy.mod(numpy.arctan2(y, x) - rotation, 2 * numpy.pi)
+    width = 2 * numpy.pi / number_of_segments
+    in_segment = (angle >= segment * width) & (angle < (segment + 1) * width)
+    return create_annular_mask(detector_shape, center, inner_radius, outer_radius) * in_segment
+
+
+def create_com_masks(detector_shape: (int, int), center: (float, float) = None):
+    """
+    Returns the x and y weights of a center of mass detector. They must be normalized by the total counts.
+    """
+    if center is None:
+        center = ((detector_shape[0] - 1) / 2, (detector_shape[1] - 1) / 2)
+    y, x = detector_coordinates(detector_shape, center)
+    return x, y
+
+
+class VirtualDetector:
+    def __init__(self, name: str, mask: numpy.ndarray, normalized: bool = False):
+        self.name = name
+        self.mask = numpy.asarray(mask, dtype=numpy.float32)
+        self.normalized = normalized
+
+
+def create_default_detectors(detector_shape: (int, int)) -> list:
+    center = ((detector_shape[0] - 1) / 2, (detector_shape[1] - 1) / 2)
+    radius = min(detector_shape) * BF_RADIUS_FRACTION
+    comx, comy = create_com_masks(detector_shape, center)
+    return [VirtualDetector('BF', create_annular_mask(detector_shape, center, 0.0, radius)),
+            VirtualDetector('ADF', create_annular_mask(detector_shape, center, ADF_RADII[0] * radius,
+                                                       ADF_RADII[1] * radius)),
+            VirtualDetector('CoMx', comx, normalized=True),
+            VirtualDetector('CoMy', comy, normalized=True)]
+
+
+class VirtualDetectorEngine:
+    """
+    Computes virtual detector images from EVENT_4DRAW event lists as they arrive. Every batch is multiplied by all
+    masks at once, so the cost does not depend on the mask shapes.
+
+    When a sparse event store is given to configure, events are also stored through this engine. Masks can then be
+    changed during an acquisition: the image of the new mask is integrated from the events stored so far without
+    holding the lock of the incoming batches, so decoding goes on. The few events stored in the meantime are then
+    integrated under the lock and the image is swapped in, so no event is lost or counted twice. Events the store had
+    to drop, beyond its memory budget, are only in the images of the masks that were set when they arrived.
+
+    The default detectors are set from the start, so names can be read before the first acquisition (as the scan
+    channels do).
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__change_lock = threading.Lock()
+        self.scan_shape = (0, 0)
+        self.detector_shape = (RAW4D_PIXELS_Y, RAW4D_PIXELS_X)
+        self.__detectors = {detector.name: detector for detector in create_default_detectors(self.detector_shape)}
+        self.store = None
+        self.__images = numpy.zeros((0, len(self.__detectors)), dtype=numpy.float64)
+        self.__counts = numpy.zeros(0, dtype=numpy.uint32)
+        self.__update_weights()
+
+    @property
+    def names(self) -> list:
+        return list(self.__detectors.keys())
+
+    def configure(self, scan_shape: (int, int), detector_shape: (int, int),
+                  store: tp3sparse.SparseEventStore = None):
+        with self.__lock:
+            if detector_shape != self.detector_shape or not self.__detectors:
+                self.__detectors = {detector.name: detector for detector in create_default_detectors(detector_shape)}
+            self.scan_shape = scan_shape
+            self.detector_shape = detector_shape
+            self.store = store
+            self.__counts = numpy.zeros(scan_shape[0] * scan_shape[1], dtype=numpy.uint32)
+            self.__images = numpy.zeros((self.__counts.size, len(self.__detectors)), dtype=numpy.float64)
+            self.__update_weights()
+        logging.info(f'***TP3***: Virtual detectors {self.names} for a scan of {scan_shape}.')
+
+    def __update_weights(self):
+        weights = [detector.mask.reshape(-1) for detector in self.__detectors.values()]
+        if weights:
+            self.__weights = numpy.ascontiguousarray(numpy.stack(weights, axis=1))
+        else:
+            self.__weights = numpy.zeros((self.detector_shape[0] * self.detector_shape[1], 0), dtype=numpy.float32)
+
+    def __integrate_again(self, previous_names: list, changed: str = None, image: numpy.ndarray = None):
+        """
+        Rebuilds the image columns after the detector list changed. The changed detector gets image, already
+        integrated from the store, the others keep their previous column.
+        """
+        images = numpy.zeros((self.__counts.size, len(self.__detectors)), dtype=numpy.float64)
+        for index, name in enumerate(self.__detectors.keys()):
+            if name == changed:
+                if image is not None:
+                    images[:, index] = image
+            elif name in previous_names:
+                images[:, index] = self.__images[:, previous_names.index(name)]
+        self.__images = images
+        self.__update_weights()
+
+    def set_detector(self, name: str, mask: numpy.ndarray, normalized: bool = False):
+        """
+        Adds a virtual detector or replaces its mask. This can be called while acquiring.
+        """
+        mask = numpy.asarray(mask, dtype=numpy.float32)
+        if mask.shape != self.detector_shape:
+            raise ValueError(f'***TP3***: Mask shape {mask.shape} does not match the detector {self.detector_shape}.')
+        with self.__change_lock:
+            with self.__lock:
+                store = self.store
+                stored = 0 if store is None else store.number_of_events
+            image = None if store is None else store.integrate(mask, 0, stored).reshape(-1)
+            with self.__lock:
+                if image is not None and self.store is store and image.size == self.__counts.size:
+                    image += store.integrate(mask, stored).reshape(-1)
+                else: #Reconfigured meanwhile, the column starts empty
+                    image = None
+                previous_names = self.names
+                self.__detectors[name] = VirtualDetector(name, mask, normalized)
+                self.__integrate_again(previous_names, name, image)
+
+    def remove_detector(self, name: str):
+        with self.__change_lock, self.__lock:
+            previous_names = self.names
+            self.__detectors.pop(name, None)
+            self.__integrate_again(previous_names)
+
+    def add_events(self, event_list: numpy.ndarray, accumulator=None):
+        event_list = event_list.astype(numpy.uint64, copy=False)
+        with self.__lock:
+            if self.store is not None:
+                self.store.add_events(event_list, accumulator)
+            if self.__counts.size:
+                apply_detectors_numba(self.__images, self.__counts, self.__weights, event_list,
+                                      numpy.uint64(self.detector_shape[0] * self.detector_shape[1]))
+
+    def get_image(self, name: str) -> numpy.ndarray:
+        with self.__lock:
+            index = self.names.index(name)
+            image = self.__images[:, index].copy()
+            if self.__detectors[name].normalized:
+                image /= numpy.maximum(self.__counts, 1)
+        return image.reshape(self.scan_shape)
+
+    def get_counts(self) -> numpy.ndarray:
+        return self.__counts.reshape(self.scan_shape)
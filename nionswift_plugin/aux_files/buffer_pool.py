@@ -0,0 +1,142 @@
+import sys, ctypes, logging, threading, weakref, numpy
+
+ALIGNMENT = 4096 #Buffers start on a page boundary
+POOL_BUDGET = 4 * (1 << 30) #Free buffers beyond this many bytes are released, oldest first
+
+
+def aligned_zeros(shape: tuple, dtype, alignment: int = ALIGNMENT) -> numpy.ndarray:
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    raw = numpy.zeros(nbytes + alignment, dtype=numpy.uint8)
+    offset = (-raw.ctypes.data) % alignment
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def _lock_pages(array: numpy.ndarray, lock: bool) -> bool:
+    """
+    Locks (or unlocks) the pages of array in physical memory, with VirtualLock on Windows and mlock elsewhere. This
+    can fail if the working set or RLIMIT_MEMLOCK is too small, and the buffer is then only pre-faulted.
+    """
+    address, size = ctypes.c_void_p(array.ctypes.data), ctypes.c_size_t(array.nbytes)
+    try:
+        if sys.platform.startswith('win'):
+            function = ctypes.windll.kernel32.VirtualLock if lock else ctypes.windll.kernel32.VirtualUnlock
+            return bool(function(address, size))
+        libc = ctypes.CDLL(None)
+        function = libc.mlock if lock else libc.munlock
+        return function(address, size) == 0
+    except (AttributeError, OSError):
+        return False
+
+
+class _Lease:
+    """
+    Owner of the memory of one leased array. numpy does not look through it, so every view of the leased array refers
+    to the leased array, which is then alive as long as any consumer holds the data.
+    """
+
+    def __init__(self, storage: numpy.ndarray, shape: tuple, dtype):
+        self.storage = storage
+        self.__array_interface__ = {"shape": tuple(shape), "typestr": numpy.dtype(dtype).str, "version": 3,
+                                    "data": (storage.ctypes.data, False)}
+
+
+class BufferPool:
+    """
+    Page-aligned buffers for the camera DLLs, kept between acquisitions and keyed by shape and dtype. A buffer is
+    leased for one acquisition, its pointer given to the DLL, and given back when the next acquisition starts. Starting
+    live view again with the same settings then reuses pages that are already mapped, instead of allocating and
+    faulting in a new array. Two leases never share a buffer, so the DLL can write one while the previous one is read.
+
+    Leased arrays are handed out as they are, so give_back does not make a buffer free. It becomes free, and is zeroed
+    by its next lease, only once the leased array and all its views are gone. clear releases the free buffers and the
+    pool keeps no buffer given back afterwards, until the next lease.
+    """
+
+    def __init__(self, budget: int = POOL_BUDGET, pin: bool = True):
+        self.budget = budget
+        self.pin = pin
+        self.__lock = threading.RLock() #Leases can end in the garbage collector, while the lock is held
+        self.__free = dict()
+        self.__leased = dict()
+        self.__pinned = set()
+        self.__order = list()
+        self.__retain = True
+        self.free_bytes = 0
+
+    @staticmethod
+    def __key(shape: tuple, dtype) -> tuple:
+        return tuple(shape), numpy.dtype(dtype).str
+
+    def lease(self, shape: tuple, dtype, zero: bool = True) -> numpy.ndarray:
+        key = self.__key(shape, dtype)
+        with self.__lock:
+            self.__retain = True
+            buffers = self.__free.get(key)
+            storage = buffers.pop() if buffers else None
+            if storage is not None:
+                self.__order = [item for item in self.__order if item[1] is not storage]
+                self.free_bytes -= storage.nbytes
+        reused = storage is not None
+        if not reused:
+            storage = aligned_zeros((int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize,), numpy.uint8)
+            if self.pin and _lock_pages(storage, True):
+                self.__pinned.add(id(storage))
+        array = numpy.asarray(_Lease(storage, shape, dtype))
+        if reused and zero:
+            array.fill(0)
+        lease = {"key": key, "storage": storage, "given_back": False}
+        with self.__lock:
+            self.__leased[id(array)] = lease
+        finalizer = weakref.finalize(array, self.__end_lease, id(array), lease)
+        finalizer.atexit = False
+        return array
+
+    def give_back(self, array: numpy.ndarray) -> bool:
+        """
+        Ends the lease of array. Its buffer is reused once no one holds array or a view of it. Arrays that were not
+        leased from this pool, like the Timepix3 arrays, are ignored and False is returned.
+        """
+        if array is None:
+            return False
+        with self.__lock:
+            lease = self.__leased.get(id(array))
+            if lease is None:
+                return False
+            lease["given_back"] = True
+            return True
+
+    def __end_lease(self, array_id: int, lease: dict):
+        storage = lease["storage"]
+        with self.__lock:
+            self.__leased.pop(array_id, None)
+            if lease["given_back"] and self.__retain:
+                self.__free.setdefault(lease["key"], list()).append(storage)
+                self.__order.append((lease["key"], storage))
+                self.free_bytes += storage.nbytes
+                self.__trim()
+            else:
+                self.__release(storage)
+
+    def __release(self, storage: numpy.ndarray):
+        if id(storage) in self.__pinned:
+            self.__pinned.discard(id(storage))
+            _lock_pages(storage, False)
+
+    def __trim(self):
+        while self.free_bytes > self.budget and self.__order:
+            key, storage = self.__order.pop(0)
+            self.__free[key] = [buffer for buffer in self.__free[key] if buffer is not storage]
+            self.free_bytes -= storage.nbytes
+            self.__release(storage)
+            logging.info(f'***BUFFER POOL***: Released a buffer of {key[0]} {numpy.dtype(key[1])}.')
+
+    def clear(self):
+        """
+        Releases the free buffers. Buffers given back later are released as well, until the next lease.
+        """
+        with self.__lock:
+            self.__retain = False
+            budget, self.budget = self.budget, 0
+            self.__trim()
+            self.budget = budget
@@ -0,0 +1,133 @@
+import os, sys, mmap, time, logging, numpy
+
+from . import read_data
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+if sys.platform.startswith('win'):
+    DEFAULT_SPIM_PATH = os.path.abspath('C:\\ProgramData\\Microscope\\spim\\')
+else:
+    DEFAULT_SPIM_PATH = os.path.abspath('/srv/data/spim/')
+MEMORY_THRESHOLD = 2 * (1 << 30) #Default size (in bytes) above which spectrum images go to disk, if enabled
+WINDOW_ROWS = 4 #Scan rows kept resident behind the last valid row
+#Entries of the "memory" section of global_settings. The disk sink is off unless SPIM_ON_DISK is set
+SETTINGS_SECTION = "memory"
+
+
+def get_disk_settings() -> (bool, str, int):
+    """
+    Whether large spectrum images go to disk, the folder of their files and the size (in bytes) above which they do.
+    """
+    enabled = bool(read_data.get_global_setting(SETTINGS_SECTION, "SPIM_ON_DISK", 0))
+    path = read_data.get_global_setting(SETTINGS_SECTION, "SPIM_PATH", "") or DEFAULT_SPIM_PATH
+    threshold = read_data.get_global_setting(SETTINGS_SECTION, "SPIM_DISK_THRESHOLD_GB", None)
+    threshold = MEMORY_THRESHOLD if threshold is None else int(float(threshold) * (1 << 30))
+    return enabled, os.path.abspath(path), threshold
+
+
+def should_use_disk(nbytes: int, enabled: bool = True, threshold: int = MEMORY_THRESHOLD) -> bool:
+    return enabled and threshold is not None and nbytes > threshold
+
+
+class DiskSpectrumImage:
+    """
+    Spectrum image backed by a memory-mapped file in path. data is a normal ndarray over the mapping, so it can be
+    given to DataAndMetadata, to numba or to the camera DLLs by pointer.
+
+    The cube is written row by row. advance(rows) flushes the rows that are complete and no longer in the working
+    window, and releases their pages, so only WINDOW_ROWS scan rows stay resident. Released rows are read back from the
+    file when the display touches them.
+    """
+
+    def __init__(self, shape: tuple, dtype, window_rows: int = WINDOW_ROWS, path: str = DEFAULT_SPIM_PATH):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.window_rows = window_rows
+        self.nbytes = int(numpy.prod(self.shape)) * self.dtype.itemsize
+        self.row_bytes = self.nbytes // self.shape[0]
+        os.makedirs(path, exist_ok=True)
+        self.filename = os.path.join(path, time.strftime('spim_%Y%m%d_%H%M%S_') + str(os.getpid()) + '.dat')
+        self.__file = open(self.filename, 'w+b')
+        self.__file.truncate(self.nbytes) #Sparse file. Disk is only used as rows are written
+        self.__mmap = mmap.mmap(self.__file.fileno(), self.nbytes)
+        self.data = numpy.frombuffer(self.__mmap, dtype=self.dtype).reshape(self.shape)
+        self.released_rows = 0
+        self.bytes_flushed = 0
+        logging.info(f'***SPIM***: Spectrum image of shape {self.shape} ({self.nbytes / 1e9:.2f} GB) is written to '
+                     f'{self.filename}.')
+
+    def __aligned_range(self, first_row: int, last_row: int):
+        """
+        Byte range covering whole pages inside rows [first_row, last_row).
+        """
+        granularity = mmap.ALLOCATIONGRANULARITY
+        start = -(-first_row * self.row_bytes // granularity) * granularity
+        end = (last_row * self.row_bytes // granularity) * granularity
+        return start, end - start
+
+    def advance(self, rows: int):
+        """
+        rows is the number of valid scan rows. Rows before rows - window_rows are flushed and released.
+        """
+        last_row = min(rows - self.window_rows, self.shape[0])
+        if last_row <= self.released_rows:
+            return
+        start, size = self.__aligned_range(self.released_rows, last_row)
+        if size > 0:
+            self.__mmap.flush(start, size)
+            self.bytes_flushed += size
+            advice = getattr(mmap, 'MADV_PAGEOUT', getattr(mmap, 'MADV_DONTNEED', None))
+            if advice is not None:
+                self.__mmap.madvise(advice, start, size)
+        self.released_rows = last_row
+
+    def flush(self):
+        self.__mmap.flush()
+
+    def close(self, remove: bool = True):
+        """
+        Flushes and closes the file. If some data item still refers to the data, the mapping is left to the garbage
+        collector. On Windows, a file still mapped cannot be removed and is kept.
+        """
+        self.flush()
+        self.data = None
+        try:
+            self.__mmap.close()
+            self.__file.close()
+        except BufferError:
+            pass
+        if remove:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                logging.info(f'***SPIM***: {self.filename} is still in use and was not removed.')
+
+
+def create_spim_array(shape: tuple, dtype, allocate=numpy.zeros, copies: int = 1):
+    """
+    Returns (array, sink). sink is None when the spectrum image is kept in memory, and the array then comes from
+    allocate(shape, dtype), which can lease it from a buffer pool. It goes to disk only if enabled in global_settings
+    and above the threshold. If the file cannot be created, the spectrum image is kept in memory.
+
+    copies is the number of arrays of this size the acquisition needs, like the reordered copy of a SPIM with a scan
+    pattern. The threshold applies to all of them, and MemoryError is raised if they do not fit in the available memory
+    (when psutil is there), instead of swapping during the acquisition.
+
+    The owner of the sink closes it, which removes the file, once the acquisition ends or before the next one.
+    """
+    nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    enabled, path, threshold = get_disk_settings()
+    if should_use_disk(nbytes * copies, enabled, threshold):
+        try:
+            sink = DiskSpectrumImage(shape, dtype, path=path)
+            return sink.data, sink
+        except (OSError, ValueError) as e:
+            logging.info(f'***SPIM***: Could not create the spectrum image file in {path} ({e}). Keeping it in '
+                         f'memory.')
+    if psutil is not None and nbytes * copies > psutil.virtual_memory().available:
+        raise MemoryError(f'***SPIM***: {copies} spectrum images of {nbytes / 1e9:.2f} GB do not fit in the available '
+                          f'memory. Enable SPIM_ON_DISK or reduce the scan or the camera size.')
+    return allocate(shape, dtype), None
@@ -0,0 +1,152 @@
+import numpy
+
+from . import read_data
+
+try:
+    from numba import jit
+except ImportError:
+    jit = None
+
+ELECTRONS_PER_COULOMB = 6.242e18
+SETTINGS_SECTION = "memory" #Section of global_settings with FRAME_STATISTICS
+
+
+def get_statistics_enabled() -> bool:
+    """
+    Whether global_settings asks for per-pixel frame statistics. They are on unless FRAME_STATISTICS is 0.
+    """
+    return bool(read_data.get_global_setting(SETTINGS_SECTION, "FRAME_STATISTICS", 1))
+
+
+def update_frame_statistics_numpy(frame, total, mean, m2, ema, count, alpha, cumulative):
+    frame = frame.astype(numpy.float64)
+    increment = frame - total if cumulative else frame
+    if cumulative:
+        total[:] = frame
+    else:
+        total += frame
+    delta = increment - mean
+    mean += delta / count
+    m2 += delta * (increment - mean)
+    if count == 1:
+        ema[:] = increment
+    elif alpha > 0:
+        ema += alpha * (increment - ema)
+    return float(increment.sum())
+
+
+if jit is not None:
+    @jit(nopython=True)
+    def update_frame_statistics_numba(frame, total, mean, m2, ema, count, alpha, cumulative):
+        """
+        Welford update of the mean and of the sum of squared deviations, in a single pass over the frame. Returns the
+        counts of the new frame.
+        """
+        frame_total = 0.0
+        for index in range(frame.size):
+            value = float(frame[index])
+            if cumulative:
+                increment = value - total[index]
+                total[index] = value
+            else:
+                increment = value
+                total[index] += value
+            frame_total += increment
+            delta = increment - mean[index]
+            mean[index] += delta / count
+            m2[index] += delta * (increment - mean[index])
+            if count == 1:
+                ema[index] = increment
+            elif alpha > 0:
+                ema[index] += alpha * (increment - ema[index])
+        return frame_total
+
+    update_frame_statistics = update_frame_statistics_numba
+else:
+    update_frame_statistics = update_frame_statistics_numpy
+
+
+def counts_to_current(counts: float, exposure: float) -> float:
+    """
+    Beam current in pA from the electrons counted during exposure (in seconds).
+    """
+    return counts / exposure / ELECTRONS_PER_COULOMB * 1e12
+
+
+class FrameAccumulator:
+    """
+    Number of frames of a Focus or Cumul acquisition. Without statistics, only this count is kept. Statistics cost 32
+    bytes per pixel and a pass over every frame, in the callback of the camera, but that pass also gives the counts of
+    the frame, so the beam current needs no other reduction.
+
+    With statistics, it also keeps the per-pixel sum, mean and variance of the frames, and an exponential average if
+    ema_alpha is above 0. Each frame is read once, and its total counts come out of the same pass. In cumulative mode
+    the frames given are running sums made by the DLL or by Serval. The statistics are then those of the difference
+    between consecutive frames. statistics defaults to FRAME_STATISTICS of global_settings.
+    """
+
+    def __init__(self, statistics: bool = None, ema_alpha: float = 0.0):
+        self.statistics = get_statistics_enabled() if statistics is None else bool(statistics)
+        self.ema_alpha = ema_alpha
+        self.reset()
+
+    def reset(self, shape: tuple = None):
+        self.shape = shape
+        self.count = 0
+        self.frame_total = 0.0
+        self.counts_total = 0.0
+        self.__total = self.__mean = self.__m2 = self.__ema = None
+        if shape is not None and self.statistics:
+            size = int(numpy.prod(shape))
+            self.__total = numpy.zeros(size, dtype=numpy.float64)
+            self.__mean = numpy.zeros(size, dtype=numpy.float64)
+            self.__m2 = numpy.zeros(size, dtype=numpy.float64)
+            self.__ema = numpy.zeros(size, dtype=numpy.float64)
+
+    def add(self, frame: numpy.ndarray, cumulative: bool = False):
+        """
+        Counts a frame. With statistics, adds it and returns its total counts, otherwise returns None.
+        """
+        if not self.statistics:
+            self.count += 1
+            return None
+        if frame.shape != self.shape:
+            self.reset(frame.shape)
+        self.count += 1
+        self.frame_total = update_frame_statistics(numpy.ascontiguousarray(frame).reshape(-1), self.__total,
+                                                   self.__mean, self.__m2, self.__ema, self.count,
+                                                   float(self.ema_alpha), cumulative)
+        self.counts_total += self.frame_total
+        return self.frame_total
+
+    def __reshaped(self, array):
+        return None if array is None else array.reshape(self.shape)
+
+    @property
+    def sum(self) -> numpy.ndarray:
+        return self.__reshaped(self.__total)
+
+    @property
+    def mean(self) -> numpy.ndarray:
+        return self.__reshaped(self.__mean)
+
+    @property
+    def variance(self) -> numpy.ndarray:
+        if self.__m2 is None:
+            return None
+        if self.count < 2:
+            return numpy.zeros(self.shape, dtype=numpy.float64)
+        return (self.__m2 / (self.count - 1)).reshape(self.shape)
+
+    @property
+    def exponential_average(self) -> numpy.ndarray:
+        return self.__reshaped(self.__ema)
+
+    def get_current(self, exposure: float, average: bool = False):
+        """
+        Beam current of the last frame, or of the mean frame if average, in pA. None without statistics.
+        """
+        if not self.statistics:
+            return None
+        counts = self.counts_total / max(self.count, 1) if average else self.frame_total
+        return counts_to_current(counts, exposure)
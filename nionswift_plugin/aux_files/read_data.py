@@ -1,6 +1,9 @@
-import os, logging, json, sys
+import os, logging, json, sys, threading, time, atexit, weakref
 from nion.utils import Registry
 
+WRITE_DELAY = 0.5 #Seconds without changes before a deferred save is written
+MAX_WRITE_DELAY = 2.0 #A deferred save is never postponed longer than this
+
 def InstrumentDictSetter(type, name, value):
     main_controller = Registry.get_component("stem_controller")
     if main_controller:
@@ -11,6 +14,16 @@ def InstrumentDictSetter(type, name, value):
             #main_controller.SetVal(name, value)
 
 
+def get_global_setting(section: str, key: str, default):
+    """
+    Optional entry of global_settings. Files written before the entry existed give default.
+    """
+    try:
+        return FileManager('global_settings').settings.get(section, dict()).get(key, default)
+    except (OSError, ValueError, AttributeError):
+        return default
+
+
 class FileManager:
     def __init__(self, filename):
         self.filename = filename
@@ -36,7 +49,116 @@ class FileManager:
         with open(self.abs_path, 'w+') as json_file:
             json.dump(self.settings, json_file, indent=4)
 
+    def save_atomically(self, lock=None):
+        """
+        Same as save_locally, but the file is written next to the old one and then replaced. A crash during the write
+        leaves the previous settings. If the settings are changed by other threads, lock is the lock they hold while
+        doing so, and the settings are serialized under it.
+        """
+        if lock is None:
+            text = json.dumps(self.settings, indent=4)
+        else:
+            with lock:
+                text = json.dumps(self.settings, indent=4)
+        temp_path = self.abs_path + '.tmp'
+        with open(temp_path, 'w') as json_file:
+            json_file.write(text)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(temp_path, self.abs_path)
+
     def save_clone(self, new_path):
         abs_path = os.path.abspath('C:\\ProgramData\\Microscope\\' + new_path + '.json')
         with open(abs_path, 'w+') as json_file:
-            json.dump(self.settings, json_file, indent=4)
\ No newline at end of file
+            json.dump(self.settings, json_file, indent=4)
+
+_writers = weakref.WeakSet() #WriteBehind instances, flushed at exit
+
+
+def _flush_writers():
+    for writer in list(_writers):
+        writer.flush()
+
+
+atexit.register(_flush_writers)
+
+
+class WriteBehind:
+    """
+    Coalesces the saves of a FileManager. schedule marks the settings as changed, and a thread writes them once
+    WRITE_DELAY seconds have passed without changes, or MAX_WRITE_DELAY seconds after the first change. Reads are served
+    by the settings dict in memory. flush writes the pending changes at once, and is called at exit.
+
+    The settings are serialized under lock, which must also be held by everything that changes them. The file is written
+    without holding it, nor the condition used by schedule, so changes are never blocked by the disk.
+    """
+
+    def __init__(self, file_manager: FileManager, delay: float = WRITE_DELAY, max_delay: float = MAX_WRITE_DELAY):
+        self.file_manager = file_manager
+        self.delay = delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.writes = 0
+        self.lock = threading.RLock()
+        self.__condition = threading.Condition()
+        self.__write_lock = threading.Lock() #Keeps the writes, and so the snapshots they save, in order
+        self.__first_change = None
+        self.__last_change = None
+        self.__thread = None
+        _writers.add(self)
+
+    @property
+    def pending(self) -> bool:
+        return self.__first_change is not None
+
+    @property
+    def writes_avoided(self) -> int:
+        return self.requests - self.writes - int(self.pending)
+
+    def schedule(self):
+        with self.__condition:
+            self.requests += 1
+            self.__last_change = time.monotonic()
+            if self.__first_change is None:
+                self.__first_change = self.__last_change
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+            self.__condition.notify()
+
+    def __run(self):
+        with self.__condition:
+            try:
+                while self.__first_change is not None:
+                    deadline = min(self.__last_change + self.delay, self.__first_change + self.max_delay)
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        self.__condition.wait(remaining)
+                    else:
+                        self.__condition.release()
+                        try:
+                            self.__write()
+                        finally:
+                            self.__condition.acquire()
+            finally:
+                #The next schedule starts a new thread
+                self.__thread = None
+
+    def __write(self):
+        """
+        Saves the pending changes, if they were not saved meanwhile. Must be called without holding the condition.
+        """
+        with self.__write_lock:
+            with self.__condition:
+                if self.__first_change is None:
+                    return
+                self.__first_change = None
+                self.__condition.notify()
+            try:
+                self.file_manager.save_atomically(self.lock)
+                self.writes += 1
+            except Exception:
+                logging.info(f'***READ DATA***: Could not save {self.file_manager.filename}.')
+
+    def flush(self):
+        self.__write()
@@ -0,0 +1,67 @@
+import numpy
+
+from . import disk_spim
+
+
+class SpimReorder:
+    """
+    Puts a SPIM acquired with a custom scan pattern (OpenScan random or list patterns) in scan order. decode_array[i]
+    is the acquisition index of the spectrum of the scan pixel i. For camera data this is not the OpenScan mask but
+    ScanPattern.get_camera_decode, the mask shifted by one.
+
+    update(acquired) only copies the spectra acquired since the previous update, so its cost does not depend on the
+    SPIM size. The scan pixels are sorted once by acquisition index, and every update is a slice of that order. order,
+    the argsort of the decode array, can be given if it is already known.
+
+    The camera DLLs write the whole source cube in acquisition order, and a spectrum can only be moved once written, so
+    the reordered cube is a second array of the same size: a SPIM with a scan pattern takes twice the memory of a
+    raster one. The source is allocated with copies=2, so that disk_spim counts both cubes in its threshold and memory
+    check. memory_bytes is the extra memory, reported in the metadata.
+    """
+
+    def __init__(self, source: numpy.ndarray, scan_shape: tuple, decode_array: numpy.ndarray,
+                 order: numpy.ndarray = None):
+        self.scan_shape = tuple(scan_shape)
+        number_of_pixels = self.scan_shape[0] * self.scan_shape[1]
+        self.__source = source.reshape((number_of_pixels,) + source.shape[2:])
+        decode = numpy.asarray(decode_array, dtype=numpy.int64).reshape(-1)[:number_of_pixels]
+        self.__order = numpy.argsort(decode, kind='stable') if order is None else numpy.asarray(order)
+        self.__sorted = decode[self.__order]
+        self.data, self.sink = disk_spim.create_spim_array(source.shape, source.dtype)
+        self.__target = self.data.reshape(self.__source.shape)
+        self.__row_counts = numpy.zeros(self.scan_shape[0], dtype=numpy.int64)
+        self.acquired = 0
+        self.valid_rows = 0
+
+    @property
+    def memory_bytes(self) -> int:
+        return 0 if self.data is None else self.data.nbytes + self.__order.nbytes + self.__sorted.nbytes
+
+    def update(self, acquired: int) -> int:
+        """
+        acquired is the number of spectra in the source. Returns the number of scan rows that are complete, from the
+        first one.
+        """
+        acquired = min(acquired, self.__source.shape[0])
+        if acquired <= self.acquired:
+            return self.valid_rows
+        first, last = numpy.searchsorted(self.__sorted, [self.acquired, acquired])
+        pixels = self.__order[first:last]
+        self.__target[pixels] = self.__source[self.__sorted[first:last]]
+        self.__row_counts += numpy.bincount(pixels // self.scan_shape[1], minlength=self.scan_shape[0])
+        self.acquired = acquired
+        incomplete = numpy.flatnonzero(self.__row_counts < self.scan_shape[1])
+        self.valid_rows = int(incomplete[0]) if incomplete.size else self.scan_shape[0]
+        if self.sink is not None:
+            self.sink.advance(self.valid_rows)
+        return self.valid_rows
+
+    def close(self):
+        """
+        The reordered cube is dropped, and its file removed if it is on disk.
+        """
+        self.data = None
+        self.__target = None
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
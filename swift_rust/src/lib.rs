@@ -4,6 +4,8 @@ py_module_initializer!(rust2swift, |py, m| {
     m.add(py, "__doc__", "This module is implemented in Rust.")?;
     m.add(py, "hello_swift", py_fn!(py, hello_swift_py()))?;
     m.add(py, "update_spim", py_fn!(py, update_spim_py(data: &[u8])))?;
+    m.add(py, "accumulate_spim", py_fn!(py, accumulate_spim_py(address: usize, length: usize, itemsize: usize,
+        events_address: usize, events_length: usize, event_itemsize: usize)))?;
     Ok(())
 });
 
@@ -34,3 +36,41 @@ fn update_spim_py(_: Python, data: &[u8]) -> PyResult<Vec<u32>> {
 }
 
 
+
+
+/// Increments the histogram in place for every event index. Both arrays are owned by numpy and passed by address, so
+/// nothing is copied. Events outside the histogram are skipped and their number is returned.
+fn accumulate_spim(address: usize, length: usize, itemsize: usize, events_address: usize, events_length: usize,
+                   event_itemsize: usize) -> usize {
+    let mut skipped = 0usize;
+    let mut increment = |index: usize| {
+        if index >= length {
+            skipped += 1;
+            return;
+        }
+        unsafe {
+            match itemsize {
+                1 => { let p = (address as *mut u8).add(index); *p = (*p).wrapping_add(1); },
+                2 => { let p = (address as *mut u16).add(index); *p = (*p).wrapping_add(1); },
+                4 => { let p = (address as *mut u32).add(index); *p = (*p).wrapping_add(1); },
+                _ => { let p = (address as *mut u64).add(index); *p = (*p).wrapping_add(1); },
+            }
+        }
+    };
+    unsafe {
+        if event_itemsize == 8 {
+            let events = std::slice::from_raw_parts(events_address as *const u64, events_length);
+            events.iter().for_each(|&val| increment(u64::from_le(val) as usize));
+        } else {
+            let events = std::slice::from_raw_parts(events_address as *const u32, events_length);
+            events.iter().for_each(|&val| increment(u32::from_le(val) as usize));
+        }
+    }
+    skipped
+}
+
+fn accumulate_spim_py(_: Python, address: usize, length: usize, itemsize: usize, events_address: usize,
+                      events_length: usize, event_itemsize: usize) -> PyResult<usize> {
+    let out = accumulate_spim(address, length, itemsize, events_address, events_length, event_itemsize);
+    Ok(out)
+}